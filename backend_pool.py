@@ -0,0 +1,197 @@
+# backend_pool.py
+"""
+Пул бэкендов Gemini API: несколько API-ключей и упорядоченный список моделей.
+
+Бэкенд — пара (ключ, модель). Запрос уходит на бэкенд первой по приоритету модели,
+у которого больше всего осталось квоты, ниже задержка и меньше ошибок.
+На 429 (квота исчерпана) ключ отдыхает до Retry-After, после нескольких ошибок подряд —
+GEMINI_BACKEND_ERROR_COOLDOWN секунд; в это время запросы идут на другие ключи,
+а если у модели не осталось доступных ключей — на следующую модель из списка.
+"""
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# API-ключи через запятую; если не заданы, используется единственный GEMINI_API_KEY
+GEMINI_API_KEYS = [
+    key.strip() for key in os.environ.get("GEMINI_API_KEYS", os.environ.get("GEMINI_API_KEY", "")).split(",")
+    if key.strip()
+]
+# Модели в порядке предпочтения через запятую; первая — основная (по ней строится ключ кэша)
+GEMINI_MODELS = [
+    model.strip() for model in os.environ.get("GEMINI_MODELS", os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")).split(",")
+    if model.strip()
+]
+# Квота одного ключа в запросах в минуту (0 — неизвестна, остаток квоты не учитывается)
+GEMINI_KEY_RPM = float(os.environ.get("GEMINI_KEY_RPM", 0))
+# Сколько секунд ключ отдыхает после 429, если API не сообщил Retry-After
+GEMINI_KEY_COOLDOWN = float(os.environ.get("GEMINI_KEY_COOLDOWN", 60))
+# После скольких ошибок подряд бэкенд временно исключается и на сколько секунд
+GEMINI_BACKEND_ERROR_THRESHOLD = int(os.environ.get("GEMINI_BACKEND_ERROR_THRESHOLD", 3))
+GEMINI_BACKEND_ERROR_COOLDOWN = float(os.environ.get("GEMINI_BACKEND_ERROR_COOLDOWN", 30))
+
+# Коэффициент сглаживания скользящей средней задержки
+_LATENCY_ALPHA = 0.2
+# За сколько секунд хранятся исходы запросов для доли ошибок (см. recent_error_rate)
+_OUTCOME_WINDOW = 300
+
+
+class Backend:
+    """Пара (API-ключ, модель) со своей статистикой задержек, ошибок и расхода квоты."""
+
+    def __init__(self, api_key: str, model: str, rpm: float = 0):
+        self.api_key = api_key
+        self.model = model
+        self.rpm = rpm
+        self.requests = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.consecutive_errors = 0
+        self.latency_ewma = None
+        self.cooldown_until = 0.0
+        self._recent = deque()  # время отправки запросов за последнюю минуту
+
+    @property
+    def label(self) -> str:
+        """Имя для логов и статистики без раскрытия ключа."""
+        return f"{self.model}/…{self.api_key[-4:]}"
+
+    def _trim_window(self, now: float):
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+
+    def remaining_quota(self, now: float) -> float:
+        """Доля оставшейся минутной квоты (1.0, если квота неизвестна)."""
+        if not self.rpm:
+            return 1.0
+        self._trim_window(now)
+        return max(0.0, 1.0 - len(self._recent) / self.rpm)
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and self.remaining_quota(now) > 0
+
+    def available_at(self, now: float) -> float:
+        """Момент, когда бэкенд снова сможет принять запрос."""
+        if self.remaining_quota(now) > 0:
+            return self.cooldown_until
+        # Минутное окно заполнено: место освободится, когда из него выйдет самый старый запрос
+        return max(self.cooldown_until, self._recent[0] + 60)
+
+    def score(self, now: float) -> float:
+        """Чем меньше, тем лучше: ожидаемая задержка с поправкой на ошибки и остаток квоты."""
+        latency = self.latency_ewma if self.latency_ewma is not None else 1.0
+        error_rate = self.errors / self.requests if self.requests else 0.0
+        return latency * (1 + 4 * error_rate) / max(self.remaining_quota(now), 0.05)
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            'backend': self.label,
+            'requests': self.requests,
+            'errors': self.errors,
+            'quota_errors': self.quota_errors,
+            'latency_ms': 1000 * self.latency_ewma if self.latency_ewma is not None else None,
+            'remaining_quota': self.remaining_quota(now),
+            'cooldown_s': max(0.0, self.cooldown_until - now),
+        }
+
+
+class BackendPool:
+    """Выбор бэкенда для очередного запроса и учет результатов."""
+
+    def __init__(self, api_keys: list, models: list, key_rpm: float = 0):
+        self.models = models
+        # Порядок важен: сначала все ключи основной модели, затем следующей и т.д.
+        self.backends = [Backend(key, model, key_rpm) for model in models for key in api_keys]
+        self._outcomes = deque()  # (время, успех) последних запросов ко всем бэкендам
+
+    @property
+    def primary_model(self) -> str:
+        return self.models[0]
+
+    def pick(self, exclude=()) -> Backend:
+        """
+        Возвращает лучший доступный бэкенд самой приоритетной модели, у которой такой есть,
+        или None, если все бэкенды (кроме exclude) отдыхают или исчерпали квоту.
+        Выбранный бэкенд сразу учитывается в расходе квоты.
+        """
+        now = time.monotonic()
+        for model in self.models:
+            candidates = [
+                backend for backend in self.backends
+                if backend.model == model and backend not in exclude and backend.available(now)
+            ]
+            if candidates:
+                backend = min(candidates, key=lambda b: b.score(now))
+                backend.requests += 1
+                backend._recent.append(now)
+                return backend
+        return None
+
+    def _record_outcome(self, now: float, ok: bool):
+        self._outcomes.append((now, ok))
+        while self._outcomes and self._outcomes[0][0] < now - _OUTCOME_WINDOW:
+            self._outcomes.popleft()
+
+    def recent_error_rate(self, window: float) -> tuple:
+        """Доля ошибок среди запросов за последние window секунд и число этих запросов."""
+        since = time.monotonic() - window
+        # Копия очереди: метод вызывается и из потока HTTP-сервера health check
+        outcomes = [ok for at, ok in list(self._outcomes) if at >= since]
+        if not outcomes:
+            return 0.0, 0
+        return outcomes.count(False) / len(outcomes), len(outcomes)
+
+    def record_success(self, backend: Backend, latency: float):
+        self._record_outcome(time.monotonic(), True)
+        backend.consecutive_errors = 0
+        if backend.latency_ewma is None:
+            backend.latency_ewma = latency
+        else:
+            backend.latency_ewma += _LATENCY_ALPHA * (latency - backend.latency_ewma)
+
+    def record_failure(self, backend: Backend, status_code: int = None, retry_after: float = None):
+        """Учитывает ошибку бэкенда; на 429 и после серии ошибок бэкенд временно исключается."""
+        backend.errors += 1
+        backend.consecutive_errors += 1
+        now = time.monotonic()
+        self._record_outcome(now, False)
+        if status_code == 429:
+            backend.quota_errors += 1
+            cooldown = retry_after if retry_after is not None else GEMINI_KEY_COOLDOWN
+            backend.cooldown_until = now + cooldown
+            logger.warning("Квота бэкенда Gemini %s исчерпана, пауза %.0f с.", backend.label, cooldown)
+        elif backend.consecutive_errors >= GEMINI_BACKEND_ERROR_THRESHOLD:
+            backend.cooldown_until = now + GEMINI_BACKEND_ERROR_COOLDOWN
+            logger.warning(
+                "Бэкенд Gemini %s: %d ошибок подряд, исключен на %.0f с.",
+                backend.label, backend.consecutive_errors, GEMINI_BACKEND_ERROR_COOLDOWN
+            )
+
+    def next_available_in(self) -> float:
+        """Через сколько секунд освободится хотя бы один бэкенд."""
+        now = time.monotonic()
+        if not self.backends:
+            return None
+        return max(0.0, min(backend.available_at(now) for backend in self.backends) - now)
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [backend.snapshot(now) for backend in self.backends]
+
+
+# Общий пул бэкендов Gemini
+backend_pool = BackendPool(GEMINI_API_KEYS, GEMINI_MODELS, GEMINI_KEY_RPM)
+
+
+def get_backend_stats() -> list:
+    """Возвращает статистику по каждому бэкенду (ключ, модель) пула."""
+    return backend_pool.stats()
+
+
+metrics.register_stats('gemini_backend', get_backend_stats, label_key='backend')
@@ -0,0 +1,6 @@
+# bench/__init__.py
+"""
+Нагрузочный стенд, работающий без сети: локальные заглушки Gemini API и Telegram Bot API
+и прогон тысяч имитированных пользователей через настоящий ConversationHandler бота.
+Запуск: python -m bench.run --help
+"""
@@ -0,0 +1,138 @@
+# bench/fake_gemini.py
+"""
+Локальная заглушка generativelanguage API для нагрузочного стенда.
+
+Отвечает на generateContent и streamGenerateContent (SSE) с настраиваемой задержкой,
+долей ошибок 500 и ответов 429 с Retry-After. Поддерживает generationConfig.candidateCount.
+Текст ответа содержит маркер BENCH_MARKER, по которому стенд отличает ответ модели
+от сообщения об ошибке.
+
+Запуск отдельно: python -m bench.fake_gemini --port 8701 --latency 0.8 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BENCH_MARKER = "BENCHOK"
+
+
+class FakeGemini:
+    """Параметры и счетчики заглушки."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0,
+                 rate_429: float = 0.0, retry_after: float = 1.0, stream_chunks: int = 5):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def _answer(self, prompt: str, index: int = 0) -> str:
+        # Ответ по длине сопоставим с текстом пользователя, как у настоящей модели
+        words = max(5, min(len(prompt) // 12, 400))
+        return f"{BENCH_MARKER} вариант {index + 1}: " + " ".join(random.choice(("слово", "текст", "фраза", "письмо")) for _ in range(words))
+
+    def _injected_error(self):
+        roll = random.random()
+        if roll < self.rate_429:
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted (bench)", "status": "RESOURCE_EXHAUSTED"}},
+                status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        if roll < self.rate_429 + self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"code": 500, "message": "Internal error (bench)", "status": "INTERNAL"}}, status=500)
+        return None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        model, _, action = request.match_info['target'].partition(':')
+        body = await request.json()
+        prompt = "".join(part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', []))
+        count = int(body.get('generationConfig', {}).get('candidateCount', 1))
+
+        error = self._injected_error()
+        if error is not None:
+            await asyncio.sleep(self._delay() / 4)
+            return error
+
+        if action == 'streamGenerateContent':
+            return await self._stream(request, prompt)
+        await asyncio.sleep(self._delay())
+        candidates = [
+            {"content": {"parts": [{"text": self._answer(prompt, i)}], "role": "model"}, "finishReason": "STOP", "index": i}
+            for i in range(count)
+        ]
+        return web.json_response({
+            "candidates": candidates,
+            "usageMetadata": {"promptTokenCount": len(prompt) // 3, "candidatesTokenCount": 50 * count},
+            "modelVersion": model,
+        })
+
+    async def _stream(self, request: web.Request, prompt: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        text = self._answer(prompt)
+        step = max(1, len(text) // self.stream_chunks)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        delay = self._delay() / len(pieces)
+        for i, piece in enumerate(pieces):
+            await asyncio.sleep(delay)
+            chunk = {"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}]}
+            if i == len(pieces) - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = {"promptTokenCount": len(prompt) // 3, "candidatesTokenCount": 50}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode())
+        await response.write_eof()
+        return response
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'errors': self.errors, 'throttled': self.throttled}
+
+
+def build_app(fake: FakeGemini) -> web.Application:
+    app = web.Application()
+    app.router.add_post('/v1beta/models/{target}', fake.handle)
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Параметры заглушки (общие для отдельного запуска и для bench.run)."""
+    parser.add_argument('--latency', type=float, default=0.5, help="средняя задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.2, help="стандартное отклонение задержки, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="доля ответов 429 с Retry-After")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="значение Retry-After для 429, с")
+    parser.add_argument('--stream-chunks', type=int, default=5, help="на сколько фрагментов делится потоковый ответ")
+
+
+def from_arguments(args) -> FakeGemini:
+    return FakeGemini(args.latency, args.jitter, args.error_rate, args.rate_429, args.retry_after, args.stream_chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Gemini API")
+    parser.add_argument('--port', type=int, default=8701)
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info(f"Заглушка Gemini слушает порт {args.port}")
+    web.run_app(build_app(from_arguments(args)), host='127.0.0.1', port=args.port, print=None, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# bench/fake_telegram.py
+"""
+Локальная заглушка Telegram Bot API для нагрузочного стенда.
+
+Принимает вызовы бота по адресу /bot<token>/<метод>, выдает правдоподобные ответы
+(getMe, sendMessage, editMessageText, answerCallbackQuery, sendChatAction и т.д.)
+и сообщает стенду о каждом исходящем сообщении: стенд ждет в expect() сообщения,
+после которого шаг имитированного пользователя считается завершенным.
+"""
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "SpeakSmart bench", "username": "speaksmart_bench_bot"}
+
+# Методы, которые возвращают сообщение; остальные возвращают True
+_MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'sendDocument', 'editMessageReplyMarkup'}
+
+
+class FakeTelegram:
+    """Состояние заглушки: номера сообщений по чатам, ожидания стенда и счетчики вызовов."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._next_message_id = defaultdict(int)
+        # chat_id -> (predicate, future): чего ждет имитированный пользователь этого чата
+        self._waiters = {}
+
+    def expect(self, chat_id: int, predicate) -> asyncio.Future:
+        """
+        Возвращает future, которое завершится первым сообщением бота в чат chat_id,
+        для которого predicate(метод, параметры) истинно. Результат — словарь сообщения.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = (predicate, future)
+        return future
+
+    def cancel_expectation(self, chat_id: int):
+        self._waiters.pop(chat_id, None)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == 'getMe':
+            return self._ok(BOT_USER)
+        if method not in _MESSAGE_METHODS:
+            return self._ok(True)
+
+        chat_id = int(params['chat_id'])
+        if 'message_id' in params:
+            message_id = int(params['message_id'])
+        else:
+            self._next_message_id[chat_id] += 1
+            message_id = self._next_message_id[chat_id]
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get('text', ''),
+        }
+        if params.get('reply_markup'):
+            reply_markup = params['reply_markup']
+            message["reply_markup"] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+
+        waiter = self._waiters.get(chat_id)
+        if waiter is not None and waiter[0](method, message):
+            del self._waiters[chat_id]
+            if not waiter[1].done():
+                waiter[1].set_result(message)
+        return self._ok(message)
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+
+def build_app(fake: FakeTelegram) -> web.Application:
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', fake.handle)
+    return app
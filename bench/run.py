@@ -0,0 +1,340 @@
+# bench/run.py
+"""
+Нагрузочный прогон бота без сети.
+
+Поднимает заглушку Gemini (отдельным процессом, чтобы ее работа не искажала замеры)
+и заглушку Bot API, собирает настоящее приложение через speaksmart.build_application
+и прогоняет имитированных пользователей по сценарию:
+«Новый текст» → текст → выбор стиля → «Мягче» → «Сгенерировать заново».
+
+Для каждого шага измеряется время от поступления обновления до сообщения бота, которым
+шаг завершается (для шагов с Gemini — сообщения с меню доработки). В конце выводятся
+пропускная способность и p50/p95/p99 по шагам. Результат можно сохранить как эталон
+(--save) и сравнить следующий прогон с ним (--baseline); при ухудшении больше чем
+на --max-regression код выхода 1.
+
+Пример:
+    python -m bench.run --users 2000 --concurrency 200 --latency 0.8 --rate-429 0.02 --save bench/baseline.json
+    python -m bench.run --users 2000 --concurrency 200 --latency 0.8 --rate-429 0.02 --baseline bench/baseline.json
+
+Настройки бота (GEMINI_MAX_CONCURRENCY, STREAMING_RESPONSES, REGENERATE_CANDIDATES и др.)
+берутся из переменных окружения, как при обычном запуске.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from aiohttp import web
+from telegram import Update
+
+from bench import fake_gemini
+from bench.fake_gemini import BENCH_MARKER
+from bench.fake_telegram import FakeTelegram, build_app as build_telegram_app
+
+STAGES = ('new_text', 'text', 'style', 'adjust', 'regenerate')
+BENCH_TOKEN = "123456:bench"
+
+_update_ids = itertools.count(1)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Заглушка на порту {port} не запустилась")
+            await asyncio.sleep(0.05)
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    """Длительности и исходы шагов."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+
+    def record(self, stage: str, seconds: float, outcome: str):
+        self.outcomes[stage][outcome] += 1
+        if outcome == 'ok':
+            self.latencies[stage].append(seconds)
+
+    def summary(self, elapsed: float, users: int) -> dict:
+        stages = {}
+        for stage in STAGES:
+            values = sorted(self.latencies[stage])
+            stages[stage] = {
+                'count': len(values),
+                'outcomes': dict(self.outcomes[stage]),
+                'p50_ms': round(1000 * _percentile(values, 0.50), 1),
+                'p95_ms': round(1000 * _percentile(values, 0.95), 1),
+                'p99_ms': round(1000 * _percentile(values, 0.99), 1),
+                'max_ms': round(1000 * (values[-1] if values else 0.0), 1),
+            }
+        completed = self.outcomes['regenerate']['ok']
+        return {
+            'users': users,
+            'elapsed_s': round(elapsed, 2),
+            'flows_per_s': round(completed / elapsed, 2) if elapsed else 0.0,
+            'steps_per_s': round(sum(len(v) for v in self.latencies.values()) / elapsed, 2) if elapsed else 0.0,
+            'stages': stages,
+        }
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}"}
+
+
+def _message_update(user_id: int, text: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+        },
+    }
+
+
+def _callback_update(user_id: int, data: str, message: dict) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        },
+    }
+
+
+def _any_message(method: str, message: dict) -> bool:
+    return method == 'sendMessage'
+
+
+def _has_button(callback_data: str):
+    def predicate(method: str, message: dict) -> bool:
+        keyboard = message.get('reply_markup', {}).get('inline_keyboard', [])
+        return any(button.get('callback_data') == callback_data for row in keyboard for button in row)
+    return predicate
+
+
+def _track_processing(application) -> dict:
+    """Подменяет process_update приложения: возвращает словарь update_id -> future, который
+    завершается, когда бот закончил обрабатывать обновление.
+
+    Ответ пользователю отправляется изнутри обработчика, а ConversationHandler переходит в новое
+    состояние только после его возврата. Если послать следующее обновление сразу после ответа,
+    оно может попасть в старое состояние и остаться без ответа.
+    """
+    pending = {}
+    process_update = application.process_update
+
+    async def tracked_process_update(update: object) -> None:
+        try:
+            await process_update(update)
+        finally:
+            future = pending.pop(getattr(update, 'update_id', None), None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    application.process_update = tracked_process_update
+    return pending
+
+
+def _sample_text(user_id: int, chars: int) -> str:
+    words = ("привет", "коллеги", "прошу", "рассмотреть", "вопрос", "срочно", "отчет", "встреча", "спасибо", "пожалуйста")
+    text = f"Пользователь {user_id}:"
+    while len(text) < chars:
+        text += " " + random.choice(words)
+    return text
+
+
+async def _simulate_user(user_id: int, application, telegram: FakeTelegram, processing: dict,
+                         recorder: Recorder, args):
+    steps = (
+        ('new_text', lambda _: _message_update(user_id, "Новый текст"), _any_message),
+        ('text', lambda _: _message_update(user_id, _sample_text(user_id, args.text_chars)), _has_button('style_business')),
+        ('style', lambda message: _callback_update(user_id, random.choice(args.styles), message), _has_button('regenerate_text')),
+        ('adjust', lambda message: _callback_update(user_id, 'adjust_softer', message), _has_button('regenerate_text')),
+        ('regenerate', lambda message: _callback_update(user_id, 'regenerate_text', message), _has_button('regenerate_text')),
+    )
+    message = None
+    for stage, make_update, done in steps:
+        future = telegram.expect(user_id, done)
+        update = Update.de_json(make_update(message), application.bot)
+        processed = processing[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await application.update_queue.put(update)
+        try:
+            message = await asyncio.wait_for(future, args.step_timeout)
+        except asyncio.TimeoutError:
+            telegram.cancel_expectation(user_id)
+            recorder.record(stage, time.perf_counter() - started, 'timeout')
+            return
+        elapsed = time.perf_counter() - started
+        # Задержка шага — до ответа, но следующий шаг — только после перехода диалога в новое состояние
+        try:
+            await asyncio.wait_for(processed, args.step_timeout)
+        except asyncio.TimeoutError:
+            recorder.record(stage, time.perf_counter() - started, 'timeout')
+            return
+        if stage in ('style', 'adjust', 'regenerate') and BENCH_MARKER not in message['text']:
+            # Вместо ответа модели пользователь увидел сообщение об ошибке
+            recorder.record(stage, elapsed, 'error')
+        else:
+            recorder.record(stage, elapsed, 'ok')
+        if args.think_time:
+            await asyncio.sleep(random.uniform(0, args.think_time))
+
+
+async def _run(args) -> dict:
+    gemini_port = _free_port()
+    gemini_process = subprocess.Popen(
+        [sys.executable, '-m', 'bench.fake_gemini', '--port', str(gemini_port),
+         '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+         '--rate-429', str(args.rate_429), '--retry-after', str(args.retry_after), '--stream-chunks', str(args.stream_chunks)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL,
+    )
+    telegram_runner = None
+    try:
+        await _wait_for_port(gemini_port)
+
+        # Бот читает настройки при импорте, поэтому окружение задается до него
+        os.environ['GEMINI_BASE_URL'] = f"http://127.0.0.1:{gemini_port}"
+        os.environ.setdefault('GEMINI_API_KEYS', 'bench-key')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        # Общий лимит Telegram измерял бы заглушку, а не бота; лимиты отдельных чатов остаются
+        os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+        import speaksmart
+
+        telegram = FakeTelegram()
+        telegram_port = _free_port()
+        telegram_runner = web.AppRunner(build_telegram_app(telegram), access_log=None)
+        await telegram_runner.setup()
+        await web.TCPSite(telegram_runner, '127.0.0.1', telegram_port).start()
+
+        application = speaksmart.build_application(BENCH_TOKEN, base_url=f"http://127.0.0.1:{telegram_port}/bot")
+        processing = _track_processing(application)
+        await application.initialize()
+        await application.start()
+
+        recorder = Recorder()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def run_user(user_id: int):
+            async with semaphore:
+                await _simulate_user(user_id, application, telegram, processing, recorder, args)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(1000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        await application.stop()
+        await application.shutdown()
+        summary = recorder.summary(elapsed, args.users)
+        summary['telegram_calls'] = dict(telegram.calls)
+        summary['config'] = {key: value for key, value in vars(args).items() if key not in ('save', 'baseline')}
+        return summary
+    finally:
+        if telegram_runner is not None:
+            await telegram_runner.cleanup()
+        gemini_process.terminate()
+        gemini_process.wait()
+
+
+def _print_summary(summary: dict):
+    print(f"Пользователей: {summary['users']}, время: {summary['elapsed_s']} с, "
+          f"сценариев/с: {summary['flows_per_s']}, шагов/с: {summary['steps_per_s']}")
+    print(f"{'шаг':<12}{'ok':>7}{'ошибки':>8}{'таймауты':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for stage, row in summary['stages'].items():
+        outcomes = row['outcomes']
+        print(f"{stage:<12}{outcomes.get('ok', 0):>7}{outcomes.get('error', 0):>8}{outcomes.get('timeout', 0):>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+
+def compare(summary: dict, baseline: dict, max_regression: float) -> list:
+    """Сравнивает прогон с эталоном; возвращает список ухудшений сверх допуска."""
+    regressions = []
+    print("\nСравнение с эталоном (отрицательное изменение пропускной способности и рост задержек — хуже):")
+    changed = {key: value for key, value in summary['config'].items() if baseline.get('config', {}).get(key) != value}
+    if changed:
+        print(f"  Внимание: параметры прогона отличаются от эталона: {changed}")
+    old, new = baseline['flows_per_s'], summary['flows_per_s']
+    change = (new - old) / old if old else 0.0
+    print(f"  сценариев/с: {old} → {new} ({change:+.1%})")
+    if change < -max_regression:
+        regressions.append(f"пропускная способность упала на {-change:.1%}")
+    for stage, row in summary['stages'].items():
+        base_row = baseline['stages'].get(stage)
+        if not base_row:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = base_row[key], row[key]
+            change = (new - old) / old if old else 0.0
+            print(f"  {stage} {key}: {old} → {new} ({change:+.1%})")
+            if key != 'p50_ms' and change > max_regression:
+                regressions.append(f"{stage} {key} вырос на {change:.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с локальными заглушками Gemini и Telegram")
+    parser.add_argument('--users', type=int, default=500, help="сколько имитированных пользователей")
+    parser.add_argument('--concurrency', type=int, default=100, help="сколько пользователей активны одновременно")
+    parser.add_argument('--text-chars', type=int, default=400, help="длина текста пользователя")
+    parser.add_argument('--styles', nargs='+', default=['style_business', 'style_academic', 'style_personal', 'style_simplified'])
+    parser.add_argument('--think-time', type=float, default=0.0, help="пауза пользователя между шагами (до N с)")
+    parser.add_argument('--step-timeout', type=float, default=120.0, help="сколько ждать завершения шага, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help="сохранить результат в JSON (эталон)")
+    parser.add_argument('--baseline', help="сравнить с сохраненным эталоном")
+    parser.add_argument('--max-regression', type=float, default=0.10, help="допустимое ухудшение (доля)")
+    fake_gemini.add_arguments(parser)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    summary = asyncio.run(_run(args))
+    _print_summary(summary)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(summary, json.load(f), args.max_regression)
+        if regressions:
+            print("\nУхудшения: " + "; ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# boot.py
+"""
+Быстрый запуск для хостинга, который усыпляет простаивающий процесс: python boot.py
+
+Обычный запуск (python speaksmart.py) открывает порт только после импорта python-telegram-bot
+и всех модулей бота. Здесь порядок другой:
+
+1. сразу открывается порт health check (только стандартная библиотека): /healthz отвечает 200,
+   /readyz — 503, пока бот не готов; в режиме webhook обновления, пришедшие во время запуска
+   (часто именно то сообщение, которое разбудило процесс), принимаются и ставятся в очередь;
+2. импортируются модули бота и собирается приложение;
+3. состояние из pickle-файла читается в фоновом потоке (state_store.BackgroundPicklePersistence),
+   а соединения с Telegram (getMe) и Gemini (gemini_api.prewarm) открываются параллельно;
+4. в режиме опроса этот же сервер продолжает обслуживать служебные маршруты, в режиме webhook
+   его сокет без закрытия передается aiohttp-серверу вместе с принятыми обновлениями.
+
+Разбивка времени запуска по этапам пишется в лог и в /metrics (см. startup).
+"""
+import startup  # первым: отсчет этапов запуска
+
+import hmac
+import json
+import os
+import socket
+import threading
+
+with startup.stage('health_port'):
+    # Порт открыт (соединения ждут в очереди сокета) еще до импорта HTTP-сервера
+    _listen_socket = socket.create_server(("", int(os.environ.get('PORT', 8080))), backlog=128)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Те же переменные, что читает speaksmart: webhook включен, только если задан и WEBHOOK_URL
+_WEBHOOK_ENABLED = os.environ.get("RUN_MODE", "polling") == "webhook" and bool(os.environ.get("WEBHOOK_URL"))
+_WEBHOOK_PATH = "/" + os.environ.get("WEBHOOK_PATH", "telegram").strip('/')
+_WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+
+class _BootHandler(BaseHTTPRequestHandler):
+    """Служебные маршруты во время запуска и после него (в режиме опроса) и прием ранних обновлений webhook."""
+
+    def _respond(self, send_body: bool):
+        route = self.server.route
+        if route is not None:
+            status, content_type, body = route(self.path)
+        elif self.path.split('?', 1)[0] == '/healthz':
+            status, content_type, body = 200, 'text/plain', b"OK\nstarting\n"
+        else:
+            status, content_type, body = 503, 'text/plain', b"STARTING\n"
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_POST(self):
+        if not _WEBHOOK_ENABLED or self.path != _WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        received = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if _WEBHOOK_SECRET and not hmac.compare_digest(received, _WEBHOOK_SECRET):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        # 503 после передачи сокета: Telegram повторит запрос, и его примет уже webhook-сервер
+        self.send_response(200 if self.server.add_pending(data) else 503)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        return
+
+
+class BootServer(ThreadingHTTPServer):
+    """HTTP-сервер на уже открытом сокете: отвечает, пока бот запускается."""
+    daemon_threads = True
+
+    def __init__(self, sock: socket.socket):
+        super().__init__(sock.getsockname()[:2], _BootHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        # health_checker.handle_request, как только модуль импортирован; атрибут называется
+        # не handle_request, чтобы не закрыть одноименный метод socketserver.BaseServer
+        self.route = None
+        self._pending_updates = []
+        self._pending_lock = threading.Lock()
+        self._handed_over = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="boot-http", daemon=True)
+        self._thread.start()
+
+    def add_pending(self, data: dict) -> bool:
+        with self._pending_lock:
+            if self._handed_over:
+                return False
+            self._pending_updates.append(data)
+            return True
+
+    def hand_over(self) -> tuple:
+        """Останавливает прием соединений, не закрывая сокет; возвращает (сокет, принятые обновления)."""
+        self.shutdown()
+        with self._pending_lock:
+            self._handed_over = True
+            pending, self._pending_updates = self._pending_updates, []
+        return self.socket, pending
+
+
+def main():
+    with startup.stage('health_port'):
+        server = BootServer(_listen_socket)
+        server.start()
+    with startup.stage('imports'):
+        import health_checker
+        server.route = health_checker.handle_request
+        import speaksmart
+    speaksmart.main(boot_server=server)
+
+
+if __name__ == "__main__":
+    main()
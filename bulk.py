@@ -0,0 +1,360 @@
+# bulk.py
+"""
+Пакетный режим: переформулирование множества коротких текстов за раз.
+
+Пользователь присылает документ .txt/.csv или команду /bulk с нумерованным списком.
+Тексты упаковываются в как можно меньшее число запросов к Gemini (с учетом лимита
+токенов ответа), модель возвращает JSON с результатом для каждого текста, пакеты
+выполняются параллельно, а результат возвращается одним файлом.
+
+Список, ожидающий выбора стиля, хранится в памяти процесса (не в user_data): он бывает
+намного больше предельного размера состояния пользователя (retention) и не нужен после
+перезапуска — пользователь просто пришлет его снова.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters
+
+import gemini_api
+import metrics
+import prompts
+from scheduler import Superseded
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Оценка токенов исходных текстов в одном запросе: ответ примерно такой же длины
+# и должен уложиться в лимит выходных токенов модели (8192 у gemini-1.5-flash) с запасом на JSON
+BULK_MAX_BATCH_TOKENS = int(os.environ.get("BULK_MAX_BATCH_TOKENS", 3000))
+# Максимум текстов в одном запросе
+BULK_MAX_BATCH_ITEMS = int(os.environ.get("BULK_MAX_BATCH_ITEMS", 40))
+# Максимум текстов и размер файла за одну пакетную обработку
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 300))
+BULK_MAX_FILE_BYTES = int(os.environ.get("BULK_MAX_FILE_BYTES", 256 * 1024))
+
+# Сколько секунд список ждет выбора стиля
+BULK_PENDING_TTL = float(os.environ.get("BULK_PENDING_TTL", 1800))
+# Сколько списков максимум ждут выбора стиля одновременно (самые давние вытесняются)
+BULK_MAX_PENDING = int(os.environ.get("BULK_MAX_PENDING", 50))
+
+# user_id -> (тексты, формат 'txt' | 'csv', expires_at); порядок — от самого давнего к самому свежему
+_pending = OrderedDict()
+
+_JSON_OUTPUT = {"responseMimeType": "application/json"}
+# Строка нумерованного списка: «1. текст», «2) текст»
+_NUMBERED_ITEM = re.compile(r'^\s*\d+[.)]\s+')
+
+
+class BulkStats:
+    """Счетчики пакетного режима."""
+    def __init__(self):
+        self.jobs = 0
+        self.items = 0
+        self.batches = 0
+        self.fallback_items = 0
+        self.failed_items = 0
+        self.pending_evicted = 0
+
+    def snapshot(self) -> dict:
+        snapshot = dict(self.__dict__)
+        snapshot['pending'] = len(_pending)
+        return snapshot
+
+
+stats = BulkStats()
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики пакетного режима: задания, тексты, запросы, повторы по одному."""
+    return stats.snapshot()
+
+
+metrics.register_stats('bulk', get_stats)
+
+
+# --- Списки, ожидающие выбора стиля ---
+
+def _store_pending(user_id: int, items: list, output_format: str):
+    """Запоминает список пользователя до выбора стиля, вытесняя самые давние списки сверх BULK_MAX_PENDING."""
+    _pending.pop(user_id, None)
+    _pending[user_id] = (items, output_format, time.monotonic() + BULK_PENDING_TTL)
+    while len(_pending) > BULK_MAX_PENDING:
+        _pending.popitem(last=False)
+        stats.pending_evicted += 1
+
+
+def _take_pending(user_id: int):
+    """Забирает список пользователя: (тексты, формат) или None, если его нет или он устарел."""
+    item = _pending.pop(user_id, None)
+    if item is None:
+        return None
+    items, output_format, expires_at = item
+    if expires_at < time.monotonic():
+        return None
+    return items, output_format
+
+
+# --- Разбор входных данных ---
+
+def parse_numbered_list(text: str) -> list:
+    """
+    Разбирает нумерованный список. Строки без номера продолжают предыдущий пункт.
+    Если номеров нет совсем, пунктами считаются абзацы (или строки, если абзац один).
+    """
+    lines = text.splitlines()
+    if any(_NUMBERED_ITEM.match(line) for line in lines):
+        items = []
+        for line in lines:
+            if _NUMBERED_ITEM.match(line):
+                items.append(_NUMBERED_ITEM.sub('', line, count=1))
+            elif items and line.strip():
+                items[-1] += '\n' + line
+        return [item.strip() for item in items if item.strip()]
+    paragraphs = [part.strip() for part in re.split(r'\n\s*\n', text) if part.strip()]
+    if len(paragraphs) > 1:
+        return paragraphs
+    return [line.strip() for line in lines if line.strip()]
+
+
+def parse_csv(text: str) -> list:
+    """Берет тексты из столбца text (если есть заголовок с таким именем) или из первого непустого столбца."""
+    rows = list(csv.reader(io.StringIO(text)))
+    if not rows:
+        return []
+    column = None
+    header = [cell.strip().lower() for cell in rows[0]]
+    for name in ('text', 'текст'):
+        if name in header:
+            column = header.index(name)
+            rows = rows[1:]
+            break
+    items = []
+    for row in rows:
+        if column is not None:
+            cell = row[column] if column < len(row) else ''
+        else:
+            cell = next((value for value in row if value.strip()), '')
+        if cell.strip():
+            items.append(cell.strip())
+    return items
+
+
+def _decode(data: bytes) -> str:
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='replace')
+
+
+# --- Упаковка и выполнение ---
+
+def pack_batches(items: list) -> list:
+    """
+    Жадно упаковывает тексты (в исходном порядке) в пакеты не больше BULK_MAX_BATCH_TOKENS
+    и BULK_MAX_BATCH_ITEMS. Возвращает списки индексов. Слишком длинный текст идет отдельным пакетом.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for index, item in enumerate(items):
+        tokens = gemini_api.estimate_tokens(item)
+        if current and (current_tokens + tokens > BULK_MAX_BATCH_TOKENS or len(current) >= BULK_MAX_BATCH_ITEMS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _parse_batch_response(text: str) -> dict:
+    """Разбирает JSON-ответ модели в {id: текст}; некорректные элементы пропускаются."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        logger.warning("Пакетный ответ модели не является корректным JSON.")
+        return {}
+    if isinstance(data, dict):
+        # Модель иногда оборачивает массив в объект: {"items": [...]}
+        data = next((value for value in data.values() if isinstance(value, list)), [])
+    results = {}
+    for entry in data if isinstance(data, list) else []:
+        if isinstance(entry, dict) and isinstance(entry.get('text'), str):
+            try:
+                results[int(entry.get('id'))] = entry['text'].strip()
+            except (TypeError, ValueError):
+                continue
+    return results
+
+
+async def _run_batch(items: list, indexes: list, style: str, chat_id: int, results: list):
+    """
+    Выполняет один пакет. Тексты, для которых модель не вернула результат
+    (например, ответ не разобрался как JSON), обрабатываются по одному.
+    """
+    payload = json.dumps([{'id': index, 'text': items[index]} for index in indexes], ensure_ascii=False)
+    template = prompts.get_batch_template(style)
+    prompt = template.render(items=payload)
+    stats.batches += 1
+    try:
+        response = await gemini_api.generate_async(
+            prompt, chat_id=chat_id, supersede=False, generation_config=_JSON_OUTPUT, template_id=template.id
+        )
+    except (gemini_api.GeminiError, Superseded) as e:
+        # Сбой сервиса: повтор по одному лишь умножил бы число неудачных запросов
+        logger.warning("Пакет из %d текстов не обработан: %r", len(indexes), e)
+        message = e.user_message if isinstance(e, gemini_api.GeminiError) else "запрос отменен"
+        for index in indexes:
+            results[index] = f"[Не удалось обработать: {message}]"
+        stats.failed_items += len(indexes)
+        return
+    parsed = _parse_batch_response(response)
+
+    missing = [index for index in indexes if not parsed.get(index)]
+    for index in indexes:
+        if parsed.get(index):
+            results[index] = parsed[index]
+    if missing:
+        stats.fallback_items += len(missing)
+        await asyncio.gather(*(_run_single(items, index, style, chat_id, results) for index in missing))
+
+
+async def _run_single(items: list, index: int, style: str, chat_id: int, results: list):
+    template = prompts.get_style_template(style)
+    prompt = template.render(text=items[index])
+    try:
+        results[index] = await gemini_api.generate_async(prompt, chat_id=chat_id, supersede=False, template_id=template.id)
+    except gemini_api.GeminiError as e:
+        stats.failed_items += 1
+        results[index] = f"[Не удалось обработать: {e.user_message}]"
+    except Superseded:
+        # Более новый запрос этого чата вытеснил ожидавший очереди текст
+        stats.failed_items += 1
+        results[index] = "[Не удалось обработать: запрос отменен]"
+
+
+async def rewrite_items(items: list, style: str, chat_id: int) -> list:
+    """Переформулирует все тексты в стиле style; результаты возвращаются в исходном порядке."""
+    results = [None] * len(items)
+    batches = pack_batches(items)
+    logger.info("Пакетная обработка для чата %s: %d текстов в %d запросах.", chat_id, len(items), len(batches))
+    # Пакеты идут через планировщик: параллельно, но без вытеснения запросов других пользователей
+    await asyncio.gather(*(_run_batch(items, batch, style, chat_id, results) for batch in batches))
+    stats.jobs += 1
+    stats.items += len(items)
+    return results
+
+
+def render_output(items: list, results: list, output_format: str) -> bytes:
+    """Собирает файл результата: CSV с исходным и новым текстом или нумерованный текстовый список."""
+    if output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['original', 'rewritten'])
+        writer.writerows(zip(items, results))
+        # BOM, чтобы Excel правильно открыл кириллицу
+        return buffer.getvalue().encode('utf-8-sig')
+    return "\n\n".join(f"{number}. {text}" for number, text in enumerate(results, start=1)).encode('utf-8')
+
+
+# --- Обработчики Telegram ---
+
+def _style_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(name, callback_data=f"bulk_{style}")]
+        for style, name in prompts.STYLE_NAMES.items()
+    ])
+
+
+async def _accept_items(update: Update, context: ContextTypes.DEFAULT_TYPE, items: list, output_format: str):
+    if not items:
+        await update.message.reply_text("Не нашел текстов для обработки. Пришли нумерованный список или файл .txt/.csv.")
+        return
+    if len(items) > BULK_MAX_ITEMS:
+        await update.message.reply_text(f"Слишком много текстов: {len(items)}. За один раз можно обработать не больше {BULK_MAX_ITEMS}.")
+        return
+    # Символов в тексте не больше, чем байтов в файле, поэтому файл в пределах лимита всегда проходит
+    if sum(len(item) for item in items) > BULK_MAX_FILE_BYTES:
+        await update.message.reply_text("Общий объем текстов слишком большой. Пожалуйста, раздели их на несколько частей.")
+        return
+    _store_pending(update.effective_user.id, items, output_format)
+    await update.message.reply_text(
+        f"Получил текстов: {len(items)}. Выбери стиль, и я обработаю их все сразу:",
+        reply_markup=_style_keyboard()
+    )
+
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/bulk с нумерованным списком в том же сообщении."""
+    # Убираем саму команду, сохраняя переносы строк списка
+    text = re.sub(r'^/\S+', '', update.message.text, count=1)
+    if not text.strip():
+        await update.message.reply_text(
+            "Пакетный режим: отправь /bulk и нумерованный список текстов в одном сообщении "
+            "(каждый пункт начинается с «1.», «2.» …) или пришли файл .txt/.csv."
+        )
+        return
+    await _accept_items(update, context, parse_numbered_list(text), 'txt')
+
+
+async def document_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Документ .txt или .csv со списком текстов."""
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+        await update.message.reply_text(f"Файл слишком большой. Максимум — {BULK_MAX_FILE_BYTES // 1024} КБ.")
+        return
+    telegram_file = await document.get_file()
+    text = _decode(bytes(await telegram_file.download_as_bytearray()))
+    if (document.file_name or '').lower().endswith('.csv'):
+        await _accept_items(update, context, parse_csv(text), 'csv')
+    else:
+        await _accept_items(update, context, parse_numbered_list(text), 'txt')
+
+
+async def style_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    style = query.data[len('bulk_'):]
+    pending = _take_pending(query.from_user.id)
+    if not pending or style not in prompts.STYLE_NAMES:
+        await query.edit_message_text("Список для пакетной обработки не найден. Пожалуйста, пришли его снова.")
+        return
+
+    items, output_format = pending
+    await query.edit_message_text(f"Обрабатываю текстов: {len(items)} ({prompts.STYLE_NAMES[style]}). Это займет немного времени...")
+    await context.bot.send_chat_action(chat_id=query.message.chat_id, action="upload_document")
+    try:
+        results = await rewrite_items(items, style, query.message.chat_id)
+    except Exception as e:
+        logger.error("Ошибка пакетной обработки: %s", e, exc_info=True)
+        await query.edit_message_text("К сожалению, при пакетной обработке произошла ошибка. Попробуй позже.")
+        return
+
+    await context.bot.send_document(
+        chat_id=query.message.chat_id,
+        document=render_output(items, results, output_format),
+        filename=f"speaksmart_{style[len('style_'):]}.{output_format}",
+        caption=f"Готово! Обработано текстов: {len(items)}."
+    )
+
+
+def setup(application: Application):
+    """Подключает обработчики пакетного режима к приложению."""
+    application.add_handler(CommandHandler("bulk", bulk_command))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"), document_received
+    ))
+    application.add_handler(CallbackQueryHandler(
+        style_chosen, pattern='^bulk_style_(business|academic|personal|simplified)$'
+    ))
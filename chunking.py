@@ -0,0 +1,157 @@
+# chunking.py
+"""
+Обработка длинных текстов по частям.
+
+Длинный текст делится на фрагменты по границам абзацев, фрагменты переформулируются
+параллельно с общим контекстом стиля (один и тот же шаблон плюс начало всего текста),
+а результаты выдаются по порядку по мере готовности. Длинное письмо так обрабатывается
+примерно за время самого длинного фрагмента, и каждая часть помещается в одно сообщение Telegram.
+"""
+import asyncio
+import logging
+import os
+import re
+
+import gemini_api
+import metrics
+from prompts import PromptTemplate
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# С какой длины (символов) текст обрабатывается по частям
+CHUNKING_MIN_CHARS = int(os.environ.get("CHUNKING_MIN_CHARS", 3000))
+# Желаемый размер одного фрагмента (символов)
+CHUNK_TARGET_CHARS = int(os.environ.get("CHUNK_TARGET_CHARS", 1500))
+# Сколько символов начала текста передавать с каждым фрагментом как общий контекст
+CHUNK_CONTEXT_CHARS = int(os.environ.get("CHUNK_CONTEXT_CHARS", 300))
+
+# Предел длины сообщения Telegram (с запасом на префикс и разметку)
+TELEGRAM_TEXT_LIMIT = 3900
+
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+_CHUNK_CONTEXT_PREFIX = (
+    "Это фрагмент {index} из {total} длинного текста; остальные фрагменты обрабатываются отдельно. "
+    "Переформулируй ТОЛЬКО этот фрагмент, в едином стиле со всем текстом, не добавляя вступлений, "
+    "заключений и не повторяя других фрагментов. Для контекста — начало всего текста: «{head}»\n\n"
+)
+
+
+class ChunkingStats:
+    """Счетчики обработки длинных текстов."""
+    def __init__(self):
+        self.texts_chunked = 0
+        self.chunks_requested = 0
+        self.texts_failed = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+stats = ChunkingStats()
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики обработки длинных текстов: сколько текстов и фрагментов, сколько сбоев."""
+    return stats.snapshot()
+
+
+metrics.register_stats('chunking', get_stats)
+
+
+def needs_chunking(text: str) -> bool:
+    """Нужно ли обрабатывать текст по частям."""
+    return len(text) >= CHUNKING_MIN_CHARS
+
+
+def _split_long_paragraph(paragraph: str, limit: int) -> list:
+    """Делит слишком длинный абзац по предложениям, а одно огромное предложение — по длине."""
+    pieces, current = [], ""
+    for sentence in _SENTENCE_END.split(paragraph):
+        while len(sentence) > limit:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + 1 + len(sentence) > limit:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_paragraphs(text: str, target: int = CHUNK_TARGET_CHARS) -> list:
+    """
+    Делит текст на фрагменты около target символов, не разрывая абзацы.
+    Соседние короткие абзацы объединяются; абзац длиннее target делится по предложениям.
+    """
+    chunks, current = [], ""
+    for paragraph in (part.strip() for part in _PARAGRAPH_BREAK.split(text)):
+        if not paragraph:
+            continue
+        if len(paragraph) > target:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(_split_long_paragraph(paragraph, target))
+            continue
+        if current and len(current) + 2 + len(paragraph) > target:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_for_telegram(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    """Делит готовый текст на части, каждая из которых помещается в одно сообщение."""
+    if len(text) <= limit:
+        return [text]
+    return split_paragraphs(text, limit)
+
+
+def chunk_prompt(template: PromptTemplate, fields: dict, chunk: str, index: int, total: int, head: str) -> str:
+    """Промпт для одного фрагмента: общий контекст плюс обычный шаблон стиля."""
+    return _CHUNK_CONTEXT_PREFIX.format(index=index + 1, total=total, head=head) + template.render(text=chunk, **fields)
+
+
+async def rewrite_chunks(template: PromptTemplate, fields: dict, text: str, chat_id: int = None):
+    """
+    Асинхронный генератор: запускает переформулирование всех фрагментов сразу
+    и выдает (номер, всего, текст) строго по порядку, как только готов очередной фрагмент.
+    Ошибка любого фрагмента (GeminiError) отменяет оставшиеся и выбрасывается дальше.
+    """
+    chunks = split_paragraphs(text)
+    total = len(chunks)
+    head = text[:CHUNK_CONTEXT_CHARS]
+    logger.info("Длинный текст (%d символов) обрабатывается по частям: %d.", len(text), total)
+    stats.texts_chunked += 1
+    stats.chunks_requested += total
+    tasks = [
+        asyncio.ensure_future(gemini_api.generate_async(
+            chunk_prompt(template, fields, chunk, index, total, head),
+            chat_id=chat_id,
+            # Фрагменты одного текста не должны вытеснять друг друга в очереди чата
+            supersede=False,
+            template_id=template.id,
+        ))
+        for index, chunk in enumerate(chunks)
+    ]
+    try:
+        for index, task in enumerate(tasks):
+            yield index, total, (await task).strip()
+    except Exception:
+        stats.texts_failed += 1
+        raise
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
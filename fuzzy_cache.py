@@ -0,0 +1,297 @@
+# fuzzy_cache.py
+"""
+Кэш переформулировок для почти одинаковых текстов.
+
+Точный кэш ответов (response_cache) промахивается, если текст отличается пробелами,
+знаками препинания, регистром, эмодзи или именем: «Привет, Маша, извини что опоздал»
+и «привет Оля извини что опоздал!». Здесь для каждого стиля хранится индекс уже
+переформулированных текстов:
+
+- текст нормализуется (регистр, ё, пунктуация и эмодзи отбрасываются) и разбивается
+  на символьные триграммы, по которым строится MinHash-сигнатура;
+- кандидаты ищутся через LSH (сигнатура делится на полосы), похожесть оценивается по сигнатуре
+  и сравнивается с FUZZY_CACHE_THRESHOLD;
+- кандидат используется, только если после нормализации тексты совпадают слово в слово
+  или отличаются не более чем FUZZY_CACHE_MAX_SUBSTITUTIONS именами (слово с заглавной
+  буквы не в начале предложения) или числами. Тогда в сохраненном ответе старое имя
+  заменяется новым; если старого имени в ответе нет, это промах.
+
+Если пользователь сразу нажимает «Сгенерировать заново» на ответе из этого кэша, попадание
+считается ложным (false_hits): по доле таких попаданий и гистограмме похожести
+(fuzzy_cache_similarity) подбирается порог.
+
+Индекс хранится в памяти процесса и ограничен FUZZY_CACHE_MAX_ENTRIES записями (LRU) и FUZZY_CACHE_TTL.
+"""
+import logging
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+
+import metrics
+import retention
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+FUZZY_CACHE_ENABLED = os.environ.get("FUZZY_CACHE_ENABLED", "1") == "1"
+# Порог похожести (оценка коэффициента Жаккара по триграммам), начиная с которого кандидат проверяется
+FUZZY_CACHE_THRESHOLD = float(os.environ.get("FUZZY_CACHE_THRESHOLD", 0.6))
+# Сколько слов (имен или чисел) может отличаться, чтобы ответ можно было подставить с заменой
+FUZZY_CACHE_MAX_SUBSTITUTIONS = int(os.environ.get("FUZZY_CACHE_MAX_SUBSTITUTIONS", 1))
+# Тексты длиннее этого числа символов в индекс не попадают и в нем не ищутся
+FUZZY_CACHE_MAX_CHARS = int(os.environ.get("FUZZY_CACHE_MAX_CHARS", 1000))
+# Размер индекса (записей на все стили) и время жизни записи (секунды)
+FUZZY_CACHE_MAX_ENTRIES = int(os.environ.get("FUZZY_CACHE_MAX_ENTRIES", 5000))
+FUZZY_CACHE_TTL = float(os.environ.get("FUZZY_CACHE_TTL", 24 * 3600))
+
+# Размер MinHash-сигнатуры и число полос LSH (строк в полосе — NUM_PERM // BANDS)
+NUM_PERM = 64
+BANDS = 16
+_ROWS = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(2024)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+# Слова: буквы и цифры; пунктуация, пробелы и эмодзи служат только разделителями
+_WORD_RE = re.compile(r"[^\W_]+")
+# Разделитель между словами, после которого начинается новое предложение
+_SENTENCE_BREAK_RE = re.compile(r"[.!?…\n]")
+
+# Ключ user_data: похожесть, с которой показан ответ из кэша (для учета ложных попаданий)
+USER_DATA_KEY = 'fuzzy_cache_hit'
+retention.DISPOSABLE_KEYS.append(USER_DATA_KEY)
+
+
+class FuzzyCacheStats:
+    """Счетчики кэша почти одинаковых текстов."""
+    def __init__(self):
+        self.lookups = 0
+        self.exact_hits = 0
+        self.adapted_hits = 0
+        self.misses = 0
+        self.candidates_rejected = 0
+        self.false_hits = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def snapshot(self) -> dict:
+        snapshot = dict(self.__dict__)
+        hits = self.exact_hits + self.adapted_hits
+        snapshot['entries'] = len(_entries)
+        snapshot['hit_rate'] = hits / self.lookups if self.lookups else 0.0
+        snapshot['false_hit_rate'] = self.false_hits / hits if hits else 0.0
+        return snapshot
+
+
+stats = FuzzyCacheStats()
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики кэша почти одинаковых текстов: обращения, попадания, ложные попадания и т.д."""
+    return stats.snapshot()
+
+
+metrics.register_stats('fuzzy_cache', get_stats)
+
+
+class _Entry:
+    __slots__ = ('namespace', 'words', 'names', 'signature', 'response', 'expires_at')
+
+    def __init__(self, namespace: str, words: list, names: list, signature: tuple, response: str):
+        self.namespace = namespace
+        self.words = words
+        self.names = names
+        self.signature = signature
+        self.response = response
+        self.expires_at = time.monotonic() + FUZZY_CACHE_TTL
+
+
+class FuzzyHit:
+    """Ответ из кэша: текст (уже с подставленными именами) и оценка похожести исходных текстов."""
+    __slots__ = ('text', 'similarity', 'adapted')
+
+    def __init__(self, text: str, similarity: float, adapted: bool):
+        self.text = text
+        self.similarity = similarity
+        self.adapted = adapted
+
+
+# id записи -> _Entry в порядке использования (LRU)
+_entries = OrderedDict()
+# (namespace, номер полосы, значения полосы) -> id записей
+_buckets = {}
+_next_id = 0
+
+
+def _normalize(word: str) -> str:
+    return word.lower().replace('ё', 'е')
+
+
+def _token_pattern(word: str, escaped: bool = False) -> re.Pattern:
+    """Отдельное слово word (без учета регистра), не часть другого слова."""
+    return re.compile(rf"(?<!\w)(?:{word if escaped else re.escape(word)})(?!\w)", re.IGNORECASE)
+
+
+def _tokenize(text: str) -> tuple:
+    """
+    Нормализованные слова текста и признак «имя или число» для каждого: слово с заглавной
+    буквы не в начале предложения либо число.
+    """
+    words, names = [], []
+    previous_end = None
+    for match in _WORD_RE.finditer(text):
+        raw = match.group(0)
+        sentence_start = previous_end is None or _SENTENCE_BREAK_RE.search(text, previous_end, match.start()) is not None
+        previous_end = match.end()
+        words.append(_normalize(raw))
+        names.append(raw.isdigit() or (raw[0].isupper() and not sentence_start))
+    return words, names
+
+
+def _signature(words: list) -> tuple:
+    normalized = " ".join(words)
+    shingles = {normalized[i:i + 3] for i in range(max(1, len(normalized) - 2))}
+    hashes = [hash(shingle) & _PRIME for shingle in shingles]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def _bands(namespace: str, signature: tuple):
+    for band in range(BANDS):
+        yield namespace, band, signature[band * _ROWS:(band + 1) * _ROWS]
+
+
+def _similarity(first: tuple, second: tuple) -> float:
+    return sum(a == b for a, b in zip(first, second)) / NUM_PERM
+
+
+def _match_case(template: str, word: str) -> str:
+    if template.isupper() and len(template) > 1:
+        return word.upper()
+    if template[:1].isupper():
+        return word[:1].upper() + word[1:]
+    return word
+
+
+def _adapt(entry: _Entry, words: list, names: list):
+    """
+    Подстраивает сохраненный ответ под новый текст. Возвращает (ответ, были ли замены)
+    или None, если тексты отличаются не только именами и числами или подставить замену
+    безопасно нельзя.
+    """
+    if words == entry.words:
+        return entry.response, False
+    if len(words) != len(entry.words):
+        return None
+    changes = {}
+    substitutions = 0
+    for old, new, old_is_name, new_is_name in zip(entry.words, words, entry.names, names):
+        if old == new:
+            continue
+        if not (old_is_name and new_is_name) or changes.setdefault(old, new) != new:
+            # Отличается обычное слово или одно и то же имя заменено в разных местах по-разному
+            return None
+        substitutions += 1
+    if substitutions > FUZZY_CACHE_MAX_SUBSTITUTIONS:
+        return None
+    for old in changes:
+        # Имя или число должно встречаться в ответе столько же раз, сколько в исходном тексте:
+        # иначе модель его изменила (например, просклоняла) или в ответе есть такое же, но
+        # не связанное с ним слово («5 пунктов» при замене 5 на 10), и замена его испортит
+        if len(_token_pattern(old).findall(entry.response)) != entry.words.count(old):
+            return None
+    # Все замены одним проходом, чтобы подставленное значение не заменилось повторно
+    pattern = _token_pattern("|".join(re.escape(old) for old in sorted(changes, key=len, reverse=True)), escaped=True)
+    response = pattern.sub(lambda match: _match_case(match.group(0), changes[_normalize(match.group(0))]), entry.response)
+    return response, True
+
+
+def _remove(entry_id: int):
+    entry = _entries.pop(entry_id)
+    for band_key in _bands(entry.namespace, entry.signature):
+        ids = _buckets.get(band_key)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del _buckets[band_key]
+
+
+def lookup(namespace: str, text: str):
+    """Ищет ответ для почти такого же текста в том же стиле; возвращает FuzzyHit или None."""
+    if not FUZZY_CACHE_ENABLED or len(text) > FUZZY_CACHE_MAX_CHARS:
+        return None
+    words, names = _tokenize(text)
+    if not words:
+        return None
+    stats.lookups += 1
+    signature = _signature(words)
+    now = time.monotonic()
+
+    candidate_ids = set()
+    for band_key in _bands(namespace, signature):
+        candidate_ids.update(_buckets.get(band_key, ()))
+    candidates = []
+    for entry_id in candidate_ids:
+        entry = _entries[entry_id]
+        if entry.expires_at <= now:
+            _remove(entry_id)
+            continue
+        similarity = _similarity(signature, entry.signature)
+        if similarity >= FUZZY_CACHE_THRESHOLD:
+            candidates.append((similarity, entry_id, entry))
+
+    for similarity, entry_id, entry in sorted(candidates, key=lambda item: item[0], reverse=True):
+        adapted = _adapt(entry, words, names)
+        if adapted is None:
+            stats.candidates_rejected += 1
+            metrics.fuzzy_similarity.observe(similarity, 'rejected')
+            continue
+        response, substituted = adapted
+        _entries.move_to_end(entry_id)
+        if substituted:
+            stats.adapted_hits += 1
+        else:
+            stats.exact_hits += 1
+        metrics.fuzzy_similarity.observe(similarity, 'hit')
+        logger.debug("Ответ для стиля %s взят из кэша похожих текстов (похожесть %.2f, замены: %s).", namespace, similarity, substituted)
+        return FuzzyHit(response, similarity, substituted)
+
+    stats.misses += 1
+    return None
+
+
+def remember(namespace: str, text: str, response: str):
+    """Запоминает ответ модели на текст в данном стиле."""
+    global _next_id
+    if not FUZZY_CACHE_ENABLED or len(text) > FUZZY_CACHE_MAX_CHARS:
+        return
+    words, names = _tokenize(text)
+    if not words:
+        return
+    entry = _Entry(namespace, words, names, _signature(words), response)
+    entry_id = _next_id
+    _next_id += 1
+    _entries[entry_id] = entry
+    for band_key in _bands(namespace, entry.signature):
+        _buckets.setdefault(band_key, set()).add(entry_id)
+    stats.stored += 1
+    while len(_entries) > FUZZY_CACHE_MAX_ENTRIES:
+        _remove(next(iter(_entries)))
+        stats.evicted += 1
+
+
+def mark_served(user_data: dict, hit: FuzzyHit):
+    """Отмечает, что пользователю показан ответ из кэша (см. record_feedback)."""
+    user_data[USER_DATA_KEY] = hit.similarity
+
+
+def record_feedback(user_data: dict, action: str):
+    """
+    Учитывает реакцию на ответ из кэша: «Сгенерировать заново» сразу после него — ложное попадание.
+    Вызывается на каждое действие меню доработки.
+    """
+    similarity = user_data.pop(USER_DATA_KEY, None)
+    if similarity is not None and action == "regenerate_text":
+        stats.false_hits += 1
+        metrics.fuzzy_similarity.observe(similarity, 'false_hit')
@@ -1,8 +1,196 @@
-import requests
+import asyncio
+import httpx
+import email.utils
+import json
 import logging
+import os
+import time
+
+import metrics
+import profiling
+import tracing
+from backend_pool import Backend, backend_pool
+from resilience import CircuitOpenError, call_with_retries, gemini_breaker, gemini_retry_policy
+from response_cache import make_cache_key, response_cache
+from scheduler import Superseded, gemini_scheduler
+
+# Логирование настраивает приложение (tracing.setup_logging); здесь только свой логгер
+logger = logging.getLogger(__name__)
+
+# Основная модель Gemini (первая из GEMINI_MODELS, см. backend_pool); по ней строится ключ кэша,
+# и в кэш попадают только ее ответы: ответ резервной модели не должен выдаваться за ответ основной
+GEMINI_MODEL = backend_pool.primary_model
+
+# Адрес Gemini API (можно направить на локальную заглушку, см. bench/fake_gemini.py)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip('/')
+
+# Таймаут запроса к Gemini API в секундах
+REQUEST_TIMEOUT = 30
+
+# HTTP-коды, при которых запрос имеет смысл повторить: перегрузка, квота, временные сбои
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Сообщения пользователю
+CONNECTION_ERROR_MESSAGE = "Произошла ошибка при подключении к сервису переформулирования. Пожалуйста, попробуйте позже."
+SERVICE_BUSY_MESSAGE = "Сервис переформулирования сейчас перегружен. Пожалуйста, попробуйте через минуту."
+
+# --- Настройки пула соединений к generativelanguage.googleapis.com ---
+# Максимальное число одновременно открытых соединений
+GEMINI_POOL_SIZE = int(os.environ.get("GEMINI_POOL_SIZE", 20))
+# Сколько секунд держать простаивающее соединение открытым (keep-alive)
+GEMINI_KEEPALIVE_EXPIRY = float(os.environ.get("GEMINI_KEEPALIVE_EXPIRY", 120))
+# Использовать HTTP/2, если установлен пакет h2 (httpx[http2])
+GEMINI_HTTP2 = os.environ.get("GEMINI_HTTP2", "1") == "1"
+# Открывать соединение с Gemini при запуске бота, не дожидаясь первого запроса (см. prewarm), и таймаут этого запроса
+GEMINI_PREWARM = os.environ.get("GEMINI_PREWARM", "1") == "1"
+GEMINI_PREWARM_TIMEOUT = float(os.environ.get("GEMINI_PREWARM_TIMEOUT", 10))
+
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+# Поддерживает ли модель generationConfig.candidateCount > 1 (сбрасывается при первом отказе)
+_multi_candidates_supported = True
+
+# Общий асинхронный HTTP-клиент. Создается лениво при первом запросе и переиспользуется
+# всеми обработчиками, чтобы не блокировать цикл событий и не открывать соединение заново.
+_async_client = None
+
+
+class PoolStats:
+    """
+    Статистика пула соединений асинхронного клиента:
+    сколько запросов ушло по уже открытому соединению и сколько времени
+    заняли установки новых соединений (TCP + TLS).
+    """
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.handshake_time_total = 0.0
+        self.handshake_time_max = 0.0
+
+    def record(self, new_connection: bool, handshake_time: float):
+        self.requests += 1
+        if new_connection:
+            self.new_connections += 1
+            self.handshake_time_total += handshake_time
+            self.handshake_time_max = max(self.handshake_time_max, handshake_time)
+
+    def snapshot(self) -> dict:
+        reused = self.requests - self.new_connections
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': reused,
+            'reuse_ratio': reused / self.requests if self.requests else 0.0,
+            'avg_handshake_ms': 1000 * self.handshake_time_total / self.new_connections if self.new_connections else 0.0,
+            'max_handshake_ms': 1000 * self.handshake_time_max,
+            'http2': GEMINI_HTTP2 and _HTTP2_AVAILABLE,
+            'pool_size': GEMINI_POOL_SIZE,
+        }
+
+
+pool_stats = PoolStats()
+
+
+def get_pool_stats() -> dict:
+    """Возвращает статистику пула соединений к Gemini API."""
+    return pool_stats.snapshot()
+
+
+metrics.register_stats('gemini_pool', get_pool_stats)
+
+
+# --- Учет токенов ---
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без обращения к API.
+    Кириллица в токенизаторе Gemini дробится мельче латиницы,
+    поэтому считаем примерно 3 символа на токен для кириллицы и 4 — для остального.
+    """
+    if not text:
+        return 0
+    cyrillic = sum(1 for ch in text if '\u0400' <= ch <= '\u04ff')
+    return max(1, round(cyrillic / 3 + (len(text) - cyrillic) / 4))
+
+
+class TokenStats:
+    """Накопленная статистика токенов: оценка по тексту и фактические значения из usageMetadata."""
+    def __init__(self):
+        self.calls = 0
+        self.estimated_input = 0
+        self.estimated_output = 0
+        self.reported_input = 0
+        self.reported_output = 0
+
+    def record(self, prompt: str, response_text: str, usage: dict = None):
+        estimated_input = estimate_tokens(prompt)
+        estimated_output = estimate_tokens(response_text)
+        self.calls += 1
+        self.estimated_input += estimated_input
+        self.estimated_output += estimated_output
+        if usage:
+            self.reported_input += usage.get('promptTokenCount', 0)
+            self.reported_output += usage.get('candidatesTokenCount', 0)
+            logger.info(
+                "Токены Gemini: оценка вход=%d выход=%d; usageMetadata вход=%s выход=%s всего=%s",
+                estimated_input, estimated_output, usage.get('promptTokenCount'),
+                usage.get('candidatesTokenCount'), usage.get('totalTokenCount')
+            )
+        else:
+            logger.info("Токены Gemini: оценка вход=%d выход=%d", estimated_input, estimated_output)
+
+    def snapshot(self) -> dict:
+        return {
+            'calls': self.calls,
+            'estimated_input_tokens': self.estimated_input,
+            'estimated_output_tokens': self.estimated_output,
+            'reported_input_tokens': self.reported_input,
+            'reported_output_tokens': self.reported_output,
+        }
+
+
+token_stats = TokenStats()
+
+
+def get_token_stats() -> dict:
+    """Возвращает накопленную статистику входных и выходных токенов."""
+    return token_stats.snapshot()
+
+
+metrics.register_stats('gemini_tokens', get_token_stats)
+if response_cache is not None:
+    metrics.register_stats('response_cache', response_cache.stats)
+
+
+class GeminiError(Exception):
+    """
+    Ошибка обращения к Gemini API.
+    В user_message хранится текст, который можно показать пользователю.
+    retryable — ошибка временная (сеть, перегрузка, квота) и запрос можно повторить;
+    retry_after — сколько секунд API просит подождать перед повтором, если он это сообщил.
+    """
+    # Ошибка говорит о неполадках самого Gemini и учитывается circuit breaker'ом
+    service_failure = True
+
+    def __init__(self, user_message: str, status_code: int = None, retryable: bool = False, retry_after: float = None):
+        super().__init__(user_message)
+        self.user_message = user_message
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class PoolExhausted(GeminiError):
+    """
+    Все бэкенды пула отдыхают или исчерпали квоту. Это состояние самого бота, а не сбой
+    Gemini, поэтому circuit breaker такую ошибку не учитывает (service_failure = False).
+    """
+    service_failure = False
 
-# Настройка базового логирования (опционально, но полезно для отладки на сервере)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def get_api_headers():
     """
@@ -14,20 +202,20 @@ def get_api_headers():
         # 'User-Agent': 'SpeakSmartBot/1.0 (Telegram Bot)' # Можно добавить User-Agent для идентификации вашего бота
     }
 
-def ask_gemini(prompt: str, api_key: str) -> str:
-    """
-    Отправляет запрос к Google Gemini API и возвращает текстовый ответ.
-
-    Args:
-        prompt: Текстовый промпт для модели.
-        api_key: Ваш API-ключ для Gemini API.
 
-    Returns:
-        Строка с ответом от модели или сообщение об ошибке.
+def _build_request(prompt: str, api_key: str, stream: bool = False, model: str = GEMINI_MODEL,
+                   generation_config: dict = None):
+    """
+    Возвращает URL и тело запроса к модели.
+    При stream=True используется потоковый метод streamGenerateContent в формате SSE.
+    generation_config — параметры генерации, например {"candidateCount": 3}
+    (несколько вариантов за один вызов) или {"responseMimeType": "application/json"}.
     """
-    # URL для модели gemini-1.5-flash (или другой, если потребуется)
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}"
-    
+    if stream:
+        url = f"{GEMINI_BASE_URL}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+    else:
+        url = f"{GEMINI_BASE_URL}/v1beta/models/{model}:generateContent?key={api_key}"
+
     # Тело запроса к API
     payload = {
         "contents": [
@@ -39,74 +227,634 @@ def ask_gemini(prompt: str, api_key: str) -> str:
                 ]
             }
         ]
-        # Здесь можно добавить и другие параметры, если потребуется, 
+        # Здесь можно добавить и другие параметры, если потребуется,
         # например, generationConfig для управления генерацией.
     }
-    
-    try:
-        response = requests.post(url, headers=get_api_headers(), json=payload, timeout=30)
-        response.raise_for_status()
-        
-        result = response.json()
-        # ВАЖНО: Логируем полный ответ для отладки, особенно при неожиданном поведении
-        logging.info("Полный ответ от Gemini API: %s", result)
-
-        # --- НАЧАЛО ИЗМЕНЕНИЙ ---
-        # Сначала проверяем, не был ли запрос заблокирован
-        if 'promptFeedback' in result and 'blockReason' in result['promptFeedback']:
-            block_reason = result['promptFeedback']['blockReason']
-            block_reason_message = result['promptFeedback'].get('blockReasonMessage', 'Причина не указана.') # Если есть более подробное сообщение
-            
-            logging.warning(
-                f"Запрос заблокирован Gemini API. Причина: {block_reason}. Сообщение: {block_reason_message}. Полный ответ: {result}"
-            )
-            if block_reason == 'PROHIBITED_CONTENT' or block_reason == 'SAFETY': # 'SAFETY' это более общий термин для блокировки по безопасности
-                return ("К сожалению, ваш запрос не может быть обработан из-за потенциально провокационного или "
-                        "недопустимого содержания. Пожалуйста, попробуйте изменить текст или описание адресата.")
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    return url, payload
+
+
+def _check_prompt_feedback(result: dict):
+    """Выбрасывает GeminiError, если Gemini API заблокировал запрос (promptFeedback.blockReason)."""
+    if 'promptFeedback' in result and 'blockReason' in result['promptFeedback']:
+        block_reason = result['promptFeedback']['blockReason']
+        block_reason_message = result['promptFeedback'].get('blockReasonMessage', 'Причина не указана.') # Если есть более подробное сообщение
+        metrics.blocked_total.inc(block_reason)
+
+        logger.warning("Запрос заблокирован Gemini API. Причина: %s. Сообщение: %s.", block_reason, block_reason_message)
+        logger.debug("Ответ Gemini API с блокировкой: %s", result)
+        if block_reason == 'PROHIBITED_CONTENT' or block_reason == 'SAFETY': # 'SAFETY' это более общий термин для блокировки по безопасности
+            raise GeminiError("К сожалению, ваш запрос не может быть обработан из-за потенциально провокационного или "
+                              "недопустимого содержания. Пожалуйста, попробуйте изменить текст или описание адресата.")
+        else:
+            # Для других причин блокировки (если они будут)
+            raise GeminiError(f"Ваш запрос не может быть обработан (причина блокировки: {block_reason}). "
+                              "Пожалуйста, попробуйте изменить текст.")
+
+
+def _parse_gemini_result(result: dict) -> str:
+    """
+    Извлекает текст ответа из JSON Gemini API.
+    Если запрос заблокирован или ответ имеет неожиданный формат, выбрасывает GeminiError.
+    """
+    # Полный ответ пишется только на уровне DEBUG: на каждом запросе это заметная нагрузка
+    logger.debug("Полный ответ от Gemini API: %s", result)
+
+    # Сначала проверяем, не был ли запрос заблокирован
+    _check_prompt_feedback(result)
+
+    if 'candidates' in result and len(result['candidates']) > 0:
+        candidate = result['candidates'][0]
+        if 'content' in candidate and 'parts' in candidate['content'] and len(candidate['content']['parts']) > 0:
+            # Проверяем наличие 'text' в первой части
+            if 'text' in candidate['content']['parts'][0]:
+                return candidate['content']['parts'][0]['text']
             else:
-                # Для других причин блокировки (если они будут)
-                return (f"Ваш запрос не может быть обработан (причина блокировки: {block_reason}). "
-                        "Пожалуйста, попробуйте изменить текст.")
-
-        if 'candidates' in result and len(result['candidates']) > 0:
-            candidate = result['candidates'][0]
-            if 'content' in candidate and 'parts' in candidate['content'] and len(candidate['content']['parts']) > 0:
-                # Проверяем наличие 'text' в первой части
-                if 'text' in candidate['content']['parts'][0]:
-                    return candidate['content']['parts'][0]['text']
-                else:
-                    logging.warning("Ответ API не содержит 'text' в ожидаемом месте: %s", result)
-                    return "Получен ответ от API в неожиданном формате (отсутствует текст)."
-            # Обработка случая, если ответ заблокирован из-за safetySettings или другого
-            elif 'finishReason' in candidate and candidate['finishReason'] == 'SAFETY':
-                logging.warning("Запрос был заблокирован настройками безопасности API: %s", result)
-                # Можно также проверить candidate.get('safetyRatings')
-                return "Ваш запрос не может быть обработан из-за настроек безопасности."
-
-        logging.warning("Ответ API не содержит ожидаемых 'candidates': %s", result)
-        return "Не удалось извлечь ответ из данных API."
-
-    except requests.exceptions.RequestException as e:
-        # Обработка сетевых ошибок или ошибок HTTP
-        logging.error(f"Ошибка при запросе к Gemini API: {e}")
-        # В response может быть дополнительная информация, если ошибка HTTP
-        if hasattr(e, 'response') and e.response is not None:
+                logger.warning("Ответ API не содержит 'text' в ожидаемом месте: %s", result)
+                raise GeminiError("Получен ответ от API в неожиданном формате (отсутствует текст).")
+        # Обработка случая, если ответ заблокирован из-за safetySettings или другого
+        elif 'finishReason' in candidate and candidate['finishReason'] == 'SAFETY':
+            metrics.blocked_total.inc('finish_SAFETY')
+            logger.warning("Запрос был заблокирован настройками безопасности API: %s", candidate.get('safetyRatings'))
+            # Можно также проверить candidate.get('safetyRatings')
+            raise GeminiError("Ваш запрос не может быть обработан из-за настроек безопасности.")
+
+    logger.warning("Ответ API не содержит ожидаемых 'candidates': %s", result)
+    raise GeminiError("Не удалось извлечь ответ из данных API.")
+
+
+def _parse_gemini_candidates(result: dict) -> list:
+    """
+    Извлекает тексты всех кандидатов ответа (generationConfig.candidateCount).
+    Первый кандидат разбирается как обычно, с теми же ошибками; из остальных берутся
+    только непустые и не повторяющиеся тексты.
+    """
+    texts = [_parse_gemini_result(result)]
+    for candidate in result['candidates'][1:]:
+        if candidate.get('finishReason') == 'SAFETY':
+            continue
+        parts = candidate.get('content', {}).get('parts') or []
+        text = "".join(part.get('text', '') for part in parts)
+        if text and text not in texts:
+            texts.append(text)
+    return texts
+
+
+def _parse_retry_after(header_value, body_json) -> float:
+    """
+    Возвращает паузу перед повтором в секундах: из заголовка Retry-After
+    или из RetryInfo.retryDelay (например, "30s") в деталях ошибки Gemini API.
+    """
+    if header_value:
+        try:
+            return max(0.0, float(header_value))
+        except ValueError:
+            # Retry-After в формате HTTP-даты
             try:
-                error_details = e.response.json()
-                error_message = error_details.get('error', {}).get('message', e.response.text)
-                # Проверка на геоблокировку, хотя на Render это маловероятно
-                if "User location is not supported" in error_message:
-                     logging.error("Ошибка геолокации API даже на сервере! Проверьте настройки сервера/проекта.")
-                     return "Сервис временно недоступен из-за ограничений геолокации. Разработчик уведомлен."
-                return f"Ошибка API ({e.response.status_code}): {error_message}"
-            except ValueError: # Если ответ не JSON
-                return f"Ошибка API ({e.response.status_code}): {e.response.text}"
-        return "Произошла ошибка при подключении к сервису переформулирования. Пожалуйста, попробуйте позже."
+                return max(0.0, email.utils.parsedate_to_datetime(header_value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if body_json:
+        for detail in body_json.get('error', {}).get('details', []):
+            delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith('s'):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
+
+
+def _http_error_to_gemini_error(status_code: int, body_json, body_text: str, retry_after_header: str = None) -> GeminiError:
+    """Преобразует HTTP-ошибку API в GeminiError с понятным пользователю сообщением."""
+    retryable = status_code in RETRYABLE_STATUS_CODES
+    retry_after = _parse_retry_after(retry_after_header, body_json) if retryable else None
+    if body_json is None:
+        # Если ответ не JSON
+        return GeminiError(f"Ошибка API ({status_code}): {body_text}", status_code, retryable, retry_after)
+    error_message = body_json.get('error', {}).get('message', body_text)
+    # Проверка на геоблокировку, хотя на Render это маловероятно
+    if "User location is not supported" in error_message:
+        logger.error("Ошибка геолокации API даже на сервере! Проверьте настройки сервера/проекта.")
+        return GeminiError("Сервис временно недоступен из-за ограничений геолокации. Разработчик уведомлен.", status_code)
+    return GeminiError(f"Ошибка API ({status_code}): {error_message}", status_code, retryable, retry_after)
+
+
+def _response_to_gemini_error(response: httpx.Response) -> GeminiError:
+    """Преобразует неуспешный ответ httpx (тело уже прочитано) в GeminiError."""
+    try:
+        body_json = response.json()
+    except ValueError:
+        body_json = None
+    return _http_error_to_gemini_error(
+        response.status_code, body_json, response.text, response.headers.get('Retry-After')
+    )
+
+
+def _pick_backend(api_key: str, tried: set) -> Backend:
+    """
+    Выбирает бэкенд для очередной попытки. Если api_key задан явно, используется только он
+    с основной моделью; иначе — лучший доступный бэкенд пула, кроме уже опробованных.
+    Если выбрать не из чего, выбрасывает PoolExhausted с паузой до освобождения квоты.
+    """
+    if api_key is not None:
+        backend = Backend(api_key, GEMINI_MODEL) if not tried else None
+    else:
+        backend = backend_pool.pick(exclude=tried)
+    if backend is None:
+        raise PoolExhausted(SERVICE_BUSY_MESSAGE, 429, retryable=True, retry_after=backend_pool.next_available_in())
+    tried.add(backend)
+    return backend
+
+
+async def _acquire_backend(api_key: str, tried: set, deadline: float, last_error: GeminiError = None) -> Backend:
+    """
+    Асинхронный _pick_backend: если свободных бэкендов нет, ждет, пока какой-нибудь освободится,
+    но не дольше deadline (time.monotonic()). Если этот запрос уже получил ошибку от бэкенда
+    (last_error), а других свободных нет, выбрасывается она: пользователь и повторы видят
+    настоящую ошибку Gemini, а не «сервис занят».
+    """
+    while True:
+        try:
+            return _pick_backend(api_key, tried)
+        except PoolExhausted as e:
+            if last_error is not None:
+                raise last_error
+            if e.retry_after is None or time.monotonic() + e.retry_after >= deadline:
+                raise
+            await asyncio.sleep(max(e.retry_after, 0.05))
+
+
+def _error_class(error: GeminiError) -> str:
+    """Класс ошибки для метрик: HTTP-код, сетевая (повторяемая без кода) или отказ по существу."""
+    if error.status_code:
+        return f"gemini_http_{error.status_code}"
+    return "gemini_network" if error.retryable else "gemini_rejected"
+
+
+def _log_attempt_error(error: GeminiError, message: str, *args):
+    """
+    Записывает ошибку одной попытки. Временные ошибки повторяются, и в лог ошибкой попадает
+    только окончательный отказ (call_with_retries, _stream_generate), поэтому здесь они идут
+    на уровне debug; ошибки, которые повторять не будут, — сразу на уровне error.
+    """
+    logger.log(logging.DEBUG if error.retryable else logging.ERROR, message, *args)
+
+
+def _should_failover(error: GeminiError) -> bool:
+    """Ошибка относится к конкретному ключу или модели, и запрос стоит отправить на другой бэкенд."""
+    # 404 — модель из списка недоступна; сетевые ошибки (без кода) касаются всех бэкендов сразу
+    return error.status_code is not None and (error.retryable or error.status_code == 404)
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    """Возвращает общий асинхронный HTTP-клиент, создавая его при необходимости."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=GEMINI_POOL_SIZE,
+            max_keepalive_connections=GEMINI_POOL_SIZE,
+            keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+        )
+        _async_client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT,
+            limits=limits,
+            http2=GEMINI_HTTP2 and _HTTP2_AVAILABLE,
+        )
+    return _async_client
+
+
+def _make_connection_trace():
+    """
+    Создает trace-обработчик httpx для одного запроса.
+    Он отмечает, было ли открыто новое соединение, и замеряет время TCP- и TLS-рукопожатия.
+    """
+    state = {'new_connection': False, 'handshake_time': 0.0, 'started': None}
+
+    # Асинхронный клиент httpcore принимает только асинхронный trace-обработчик
+    async def trace(event_name: str, info: dict):
+        if event_name in ('connection.connect_tcp.started', 'connection.start_tls.started'):
+            state['new_connection'] = True
+            state['started'] = time.perf_counter()
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            if state['started'] is not None:
+                state['handshake_time'] += time.perf_counter() - state['started']
+                state['started'] = None
+
+    return trace, state
+
+
+async def _post_async(url: str, payload: dict, timeout: float = REQUEST_TIMEOUT) -> httpx.Response:
+    """Отправляет POST-запрос через общий пул и учитывает его в статистике соединений."""
+    trace, state = _make_connection_trace()
+    try:
+        return await _get_async_client().post(
+            url, headers=get_api_headers(), json=payload, timeout=timeout, extensions={'trace': trace}
+        )
+    finally:
+        pool_stats.record(state['new_connection'], state['handshake_time'])
+
+
+async def prewarm():
+    """
+    Открывает соединение с Gemini заранее (TCP, TLS и при HTTP/2 — согласование протокола),
+    чтобы первый запрос после запуска не ждал рукопожатия. Отправляется HEAD-запрос к корню
+    GEMINI_BASE_URL без ключа: он не расходует квоту, а соединение остается в пуле (keep-alive).
+    Ошибки не мешают запуску и только пишутся в лог.
+    """
+    if not GEMINI_PREWARM or not backend_pool.backends:
+        return
+    trace, state = _make_connection_trace()
+    try:
+        await _get_async_client().head(f"{GEMINI_BASE_URL}/", timeout=GEMINI_PREWARM_TIMEOUT, extensions={'trace': trace})
+        logger.info("Соединение с Gemini открыто заранее (рукопожатие %.0f мс).", 1000 * state['handshake_time'])
+    except httpx.HTTPError as e:
+        logger.warning("Не удалось заранее открыть соединение с Gemini: %s", e)
+    finally:
+        pool_stats.record(state['new_connection'], state['handshake_time'])
+
+
+async def close_async_client():
+    """Закрывает общий асинхронный HTTP-клиент. Вызывается при остановке бота."""
+    global _async_client
+    if _async_client is not None and not _async_client.is_closed:
+        await _async_client.aclose()
+    _async_client = None
+
+
+@profiling.timed("gemini:ask_gemini_async")
+async def ask_gemini_async(prompt: str, api_key: str = None, use_cache: bool = True, chat_id: int = None,
+                           template_id: str = None) -> str:
+    """
+    Отправляет запрос к Google Gemini API и возвращает текстовый ответ.
+    Не блокирует цикл событий: пока один пользователь ждет ответа модели,
+    бот продолжает обрабатывать сообщения остальных.
+
+    Args:
+        prompt: Текстовый промпт для модели.
+        api_key: API-ключ для Gemini API. None — использовать пул ключей и моделей (backend_pool).
+        use_cache: Искать ли ответ в кэше. False для «Сгенерировать заново»,
+            когда нужен новый вариант; свежий ответ все равно попадет в кэш.
+        chat_id: Чат, от имени которого идет запрос. Если указан, запрос проходит
+            через планировщик (очередь, квота, справедливость между чатами) и может
+            завершиться исключением scheduler.Superseded, если чат отправил более новый запрос.
+        template_id: Шаблон, из которого собран промпт (prompts.PromptTemplate.id); входит в ключ кэша.
+
+    Временные ошибки API повторяются (см. resilience); если API недоступен и цепь
+    circuit breaker разомкнута, сразу возвращается SERVICE_BUSY_MESSAGE.
+
+    Returns:
+        Строка с ответом от модели или сообщение об ошибке.
+    """
+    try:
+        return await generate_async(prompt, api_key, use_cache, chat_id, template_id=template_id)
+    except GeminiError as e:
+        return e.user_message
+    except Superseded:
+        raise
     except Exception as e:
         # Обработка других непредвиденных ошибок
-        logging.error(f"Непредвиденная ошибка в ask_gemini: {e}")
+        logger.error("Непредвиденная ошибка в ask_gemini_async: %s", e)
         return "Произошла внутренняя ошибка. Пожалуйста, попробуйте позже."
 
+
+@profiling.timed("gemini:generate_async")
+async def generate_async(prompt: str, api_key: str = None, use_cache: bool = True, chat_id: int = None,
+                         supersede: bool = True, generation_config: dict = None, template_id: str = None) -> str:
+    """
+    То же, что ask_gemini_async, но ошибка выбрасывается как GeminiError, а не возвращается строкой:
+    так вызывающий код может отличить ответ модели от сообщения об ошибке.
+    supersede=False — запрос не отменяет другие ожидающие запросы чата (для фоновых запросов).
+    generation_config — параметры генерации (см. _build_request).
+    """
+    cache_key = make_cache_key(prompt, GEMINI_MODEL, template_id)
+    if use_cache and response_cache is not None:
+        cached = await response_cache.aget(cache_key)
+        if cached is not None:
+            return cached
+
+    if gemini_breaker.is_open():
+        # Не занимаем очередь планировщика запросом, который все равно не будет выполнен
+        raise GeminiError(SERVICE_BUSY_MESSAGE, retryable=True)
+    if chat_id is not None:
+        texts = await gemini_scheduler.submit(
+            chat_id, cache_key, estimate_tokens(prompt),
+            lambda: _generate_async(prompt, api_key, cache_key, generation_config), supersede=supersede
+        )
+    else:
+        texts = await _generate_async(prompt, api_key, cache_key, generation_config)
+    return texts[0]
+
+
+@profiling.timed("gemini:generate_candidates_async")
+async def generate_candidates_async(prompt: str, count: int, api_key: str = None, chat_id: int = None,
+                                    template_id: str = None) -> list:
+    """
+    Запрашивает у модели до count разных вариантов ответа одним вызовом
+    (generationConfig.candidateCount): вход оплачивается и передается один раз,
+    а задержка как у одного запроса. Кэш не читается — нужны новые варианты.
+    Если модель не поддерживает несколько кандидатов, возвращается один вариант.
+    Ошибка выбрасывается как GeminiError.
+    """
+    global _multi_candidates_supported
+    if not _multi_candidates_supported:
+        count = 1
+    cache_key = make_cache_key(prompt, GEMINI_MODEL, template_id)
+    generation_config = {"candidateCount": count} if count > 1 else None
+    if gemini_breaker.is_open():
+        raise GeminiError(SERVICE_BUSY_MESSAGE, retryable=True)
+    try:
+        if chat_id is not None:
+            return await gemini_scheduler.submit(
+                chat_id, ('candidates', cache_key), estimate_tokens(prompt),
+                lambda: _generate_async(prompt, api_key, cache_key, generation_config)
+            )
+        return await _generate_async(prompt, api_key, cache_key, generation_config)
+    except GeminiError as e:
+        if count == 1 or e.status_code != 400 or 'candidate' not in e.user_message.lower():
+            raise
+        # Некоторые модели отвечают 400 на candidateCount > 1: дальше просим по одному варианту
+        logger.warning("Модель не поддерживает несколько кандидатов (%s); переходим на один вариант за запрос.", e)
+        _multi_candidates_supported = False
+        return await generate_candidates_async(prompt, 1, api_key, chat_id, template_id)
+
+
+async def _generate_async(prompt: str, api_key: str, cache_key: str, generation_config: dict = None) -> list:
+    """
+    Выполняет запрос к Gemini API с повторами и сохраняет первый вариант ответа в кэш,
+    если ответила основная модель. Возвращает список вариантов (один, если не запрошено несколько кандидатов).
+    """
+    try:
+        texts, model = await call_with_retries(
+            lambda timeout: _request_once(prompt, api_key, timeout, generation_config), gemini_breaker, gemini_retry_policy
+        )
+    except CircuitOpenError:
+        raise GeminiError(SERVICE_BUSY_MESSAGE, retryable=True)
+    if response_cache is not None and model == GEMINI_MODEL:
+        await response_cache.aset(cache_key, texts[0])
+    return texts
+
+
+async def _request_once(prompt: str, api_key: str, timeout: float, generation_config: dict = None) -> tuple:
+    """
+    Одна попытка запроса к Gemini API, ограниченная timeout секундами целиком.
+    Возвращает (варианты ответа, модель, которая ответила).
+    Если ключ исчерпал квоту или бэкенд ответил ошибкой, запрос сразу уходит на следующий
+    бэкенд пула. Любая ошибка выбрасывается как GeminiError; сетевые сбои и таймауты
+    помечены как повторяемые.
+    """
+    try:
+        return await asyncio.wait_for(_request_with_failover(prompt, api_key, timeout, generation_config), timeout)
+    except asyncio.TimeoutError as e:
+        metrics.errors_total.inc("gemini_timeout")
+        # Попытку повторит call_with_retries; ошибкой в лог пишется только окончательный отказ
+        logger.debug("Попытка запроса к Gemini API не уложилась в %.1f с.", timeout)
+        raise GeminiError(CONNECTION_ERROR_MESSAGE, retryable=True) from e
+
+
+async def _request_with_failover(prompt: str, api_key: str, timeout: float, generation_config: dict) -> tuple:
+    tried = set()
+    last_error = None
+    deadline = time.monotonic() + timeout
+    while True:
+        backend = None
+        try:
+            backend = await _acquire_backend(api_key, tried, deadline, last_error)
+            started = time.monotonic()
+            texts = await _request_backend(prompt, backend, timeout, generation_config)
+        except GeminiError as e:
+            if backend is None:
+                # Бэкенд не выбран: пул исчерпан (или выброшена ошибка предыдущего бэкенда)
+                raise
+            metrics.errors_total.inc(_error_class(e))
+            backend_pool.record_failure(backend, e.status_code, e.retry_after)
+            if api_key is None and _should_failover(e):
+                logger.debug("Бэкенд Gemini %s ответил ошибкой %s, пробуем следующий.", backend.label, e.status_code)
+                last_error = e
+                continue
+            raise
+        backend_pool.record_success(backend, time.monotonic() - started)
+        return texts, backend.model
+
+
+async def _request_backend(prompt: str, backend: Backend, timeout: float, generation_config: dict) -> list:
+    """Запрос к одному бэкенду (ключ и модель); возвращает список вариантов ответа."""
+    url, payload = _build_request(prompt, backend.api_key, model=backend.model, generation_config=generation_config)
+    try:
+        with metrics.in_flight.track_inprogress('upstream'), metrics.stage_timer('upstream'), \
+                tracing.span('upstream', backend=backend.label):
+            response = await _post_async(url, payload, timeout)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        error = _response_to_gemini_error(e.response)
+        _log_attempt_error(error, "Ошибка при запросе к Gemini API: %s", e)
+        raise error
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        # Обработка сетевых ошибок и таймаутов; попытку повторят, поэтому уровень debug
+        logger.debug("Ошибка при запросе к Gemini API: %r", e)
+        raise GeminiError(CONNECTION_ERROR_MESSAGE, retryable=True) from e
+    try:
+        result = response.json()
+    except ValueError as e:
+        # Испорченный ответ 200 — сбой сервиса, а не отказ по существу: повторяем
+        logger.debug("Ответ Gemini API не является корректным JSON: %r", e)
+        raise GeminiError(CONNECTION_ERROR_MESSAGE, retryable=True) from e
+    texts = _parse_gemini_candidates(result)
+    token_stats.record(prompt, "".join(texts), result.get('usageMetadata'))
+    return texts
+
+
+def _parse_stream_chunk(chunk: dict) -> str:
+    """
+    Извлекает фрагмент текста из одного события потокового ответа.
+    Пустая строка — нормальная ситуация (например, последнее событие только с finishReason).
+    """
+    _check_prompt_feedback(chunk)
+    candidates = chunk.get('candidates') or []
+    if not candidates:
+        return ""
+    candidate = candidates[0]
+    if candidate.get('finishReason') == 'SAFETY':
+        metrics.blocked_total.inc('finish_SAFETY')
+        logger.warning("Потоковый ответ был заблокирован настройками безопасности API: %s", candidate.get('safetyRatings'))
+        raise GeminiError("Ваш запрос не может быть обработан из-за настроек безопасности.")
+    parts = candidate.get('content', {}).get('parts') or []
+    return "".join(part.get('text', '') for part in parts)
+
+
+@profiling.timed("gemini:ask_gemini_stream")
+async def ask_gemini_stream(prompt: str, api_key: str = None, use_cache: bool = True, chat_id: int = None,
+                            template_id: str = None):
+    """
+    Потоковая версия ask_gemini_async: асинхронный генератор, который по мере
+    поступления фрагментов от streamGenerateContent выдает накопленный на данный момент текст.
+    Последнее выданное значение — окончательный ответ или сообщение об ошибке
+    (ошибка, как и в ask_gemini_async, возвращается строкой, а не исключением).
+
+    Args:
+        prompt: Текстовый промпт для модели.
+        api_key: API-ключ для Gemini API. None — использовать пул ключей и моделей (backend_pool).
+        use_cache: Искать ли ответ в кэше. При попадании весь ответ выдается одним значением.
+        chat_id: Чат, от имени которого идет запрос. Если указан, поток занимает слот
+            планировщика на все время генерации (см. ask_gemini_async).
+        template_id: Шаблон, из которого собран промпт; входит в ключ кэша.
+    """
+    try:
+        async for text in generate_stream(prompt, api_key, use_cache, chat_id, template_id):
+            yield text
+    except GeminiError as e:
+        yield e.user_message
+    except Superseded:
+        raise
+    except Exception as e:
+        # Обработка других непредвиденных ошибок (в т.ч. некорректного JSON в потоке)
+        logger.error("Непредвиденная ошибка в ask_gemini_stream: %s", e)
+        yield "Произошла внутренняя ошибка. Пожалуйста, попробуйте позже."
+
+
+@profiling.timed("gemini:generate_stream")
+async def generate_stream(prompt: str, api_key: str = None, use_cache: bool = True, chat_id: int = None,
+                          template_id: str = None):
+    """
+    То же, что ask_gemini_stream, но ошибка выбрасывается как GeminiError
+    (в том числе после уже выданных фрагментов), а не выдается последним значением.
+    """
+    cache_key = make_cache_key(prompt, GEMINI_MODEL, template_id)
+    if use_cache and response_cache is not None:
+        cached = await response_cache.aget(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    if gemini_breaker.is_open():
+        raise GeminiError(SERVICE_BUSY_MESSAGE, retryable=True)
+    if chat_id is None:
+        async for text in _stream_generate(prompt, api_key, cache_key):
+            yield text
+        return
+    async with gemini_scheduler.slot(chat_id, cache_key, estimate_tokens(prompt)):
+        async for text in _stream_generate(prompt, api_key, cache_key):
+            yield text
+
+
+async def _stream_generate(prompt: str, api_key: str, cache_key: str):
+    """
+    Выполняет потоковый запрос к Gemini API, выдавая накопленный текст; ответ основной модели
+    сохраняется в кэш. Временная ошибка повторяется, только если пользователь еще не увидел
+    ни одного фрагмента.
+    """
+    retry_state = gemini_retry_policy.start()
+    served_by = {}
+    while True:
+        if not gemini_breaker.allow():
+            raise GeminiError(SERVICE_BUSY_MESSAGE, retryable=True)
+        accumulated = ""
+        try:
+            async for accumulated in _stream_once(prompt, api_key, retry_state.attempt_timeout(), served_by):
+                yield accumulated
+        except GeminiError as e:
+            if not e.retryable:
+                # Запрос отклонен по существу (блокировка и т.п.), сам сервис работает
+                gemini_breaker.record_success()
+                raise
+            if e.service_failure:
+                gemini_breaker.record_failure()
+            delay = None if accumulated else retry_state.next_delay(e.retry_after)
+            if delay is None:
+                logger.error("Потоковый запрос к Gemini API не выполнен (повторов: %d): %s", retry_state.retries, e)
+                raise
+            logger.warning("Повтор потокового запроса к Gemini API через %.2f с: %s", delay, e)
+            await asyncio.sleep(delay)
+            continue
+        gemini_breaker.record_success()
+        if response_cache is not None and served_by.get('model') == GEMINI_MODEL:
+            await response_cache.aset(cache_key, accumulated)
+        return
+
+
+async def _stream_once(prompt: str, api_key: str, timeout: float, served_by: dict):
+    """
+    Одна попытка потокового запроса. timeout ограничивает установку соединения и паузы
+    между фрагментами, а не всю генерацию. Пока не получен первый фрагмент, ошибка бэкенда
+    переводит запрос на следующий бэкенд пула. Ошибки выбрасываются как GeminiError.
+    Модель, которая ответила, записывается в served_by['model'].
+    """
+    tried = set()
+    last_error = None
+    deadline = time.monotonic() + timeout
+    while True:
+        backend = None
+        accumulated = ""
+        try:
+            backend = await _acquire_backend(api_key, tried, deadline, last_error)
+            served_by['model'] = backend.model
+            started = time.monotonic()
+            async for accumulated in _stream_backend(prompt, backend, timeout):
+                yield accumulated
+        except GeminiError as e:
+            if backend is None:
+                raise
+            metrics.errors_total.inc(_error_class(e))
+            backend_pool.record_failure(backend, e.status_code, e.retry_after)
+            if not accumulated and api_key is None and _should_failover(e):
+                logger.debug("Бэкенд Gemini %s ответил ошибкой %s, пробуем следующий.", backend.label, e.status_code)
+                last_error = e
+                continue
+            raise
+        backend_pool.record_success(backend, time.monotonic() - started)
+        return
+
+
+async def _stream_backend(prompt: str, backend: Backend, timeout: float):
+    """Потоковый запрос к одному бэкенду (ключ и модель)."""
+    url, payload = _build_request(prompt, backend.api_key, stream=True, model=backend.model)
+    trace, state = _make_connection_trace()
+    accumulated = ""
+    usage = None
+    started = time.perf_counter()
+
+    try:
+        with metrics.in_flight.track_inprogress('upstream'), tracing.span('upstream_stream', backend=backend.label):
+            async with _get_async_client().stream(
+                "POST", url, headers=get_api_headers(), json=payload, timeout=timeout, extensions={'trace': trace}
+            ) as response:
+                pool_stats.record(state['new_connection'], state['handshake_time'])
+                if response.status_code >= 400:
+                    await response.aread()
+                    error = _response_to_gemini_error(response)
+                    _log_attempt_error(error, "Ошибка при потоковом запросе к Gemini API: HTTP %s", response.status_code)
+                    raise error
+
+                async for line in response.aiter_lines():
+                    # Формат SSE: полезные данные приходят в строках "data: {...}"
+                    if not line.startswith('data:'):
+                        continue
+                    try:
+                        chunk = json.loads(line[len('data:'):])
+                    except ValueError as e:
+                        # Оборванная или испорченная строка потока — сбой сервиса, попытку можно повторить
+                        logger.debug("Некорректный фрагмент потокового ответа Gemini API: %r", e)
+                        raise GeminiError(CONNECTION_ERROR_MESSAGE, retryable=True) from e
+                    usage = chunk.get('usageMetadata', usage)
+                    piece = _parse_stream_chunk(chunk)
+                    if piece:
+                        if not accumulated:
+                            # Полная длительность потока включает показ фрагментов пользователю,
+                            # поэтому для потока измеряем время до первого фрагмента
+                            metrics.stage_seconds.observe(time.perf_counter() - started, 'upstream_first_chunk')
+                        accumulated += piece
+                        yield accumulated
+    except httpx.HTTPError as e:
+        # Обработка сетевых ошибок и таймаутов; попытку повторят, поэтому уровень debug
+        logger.debug("Ошибка при потоковом запросе к Gemini API: %r", e)
+        raise GeminiError(CONNECTION_ERROR_MESSAGE, retryable=True) from e
+
+    if not accumulated:
+        logger.warning("Потоковый ответ API не содержит текста.")
+        raise GeminiError("Не удалось извлечь ответ из данных API.")
+    token_stats.record(prompt, accumulated, usage)
+
 # Функции setup_proxy() и check_proxy() здесь больше не нужны,
 # так как на Render.com мы не используем локальный VPN и SOCKS-прокси.
 # Также удалена функция get_masked_headers(), так как маскировка больше не требуется.
@@ -2,31 +2,55 @@
 import logging
 import os
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import loop_watchdog
+import metrics
+import profiling
+import resilience
 
 logger = logging.getLogger(__name__)
 
 HEALTH_CHECK_PORT = int(os.environ.get('PORT', 8080))
 
+def handle_request(path: str):
+    """
+    Обрабатывает служебный HTTP-запрос и возвращает (код ответа, Content-Type, тело).
+    Используется и потоковым HTTPServer, и webhook-сервером, чтобы маршруты были одни и те же.
+    """
+    parsed_path = urlparse(path)
+    if parsed_path.path == '/healthz':
+        # Процесс жив (200) даже при недоступном Gemini API; состояние circuit breaker — для мониторинга
+        body = f"OK\ngemini_breaker: {resilience.gemini_breaker.state}\n"
+        return 200, 'text/plain', body.encode()
+    if parsed_path.path == '/readyz':
+        # В отличие от /healthz, учитывает, успевает ли бот на самом деле обрабатывать обновления
+        ready, report = loop_watchdog.readiness()
+        body = ("READY" if ready else "NOT READY") + "\n" + "".join(f"{line}\n" for line in report)
+        return (200 if ready else 503), 'text/plain', body.encode()
+    if parsed_path.path == '/metrics':
+        return 200, 'text/plain', metrics.render().encode()
+    if parsed_path.path == '/debug/profile':
+        # Профилирование на ?seconds=N; отвечает, только если задан PROFILE_TOKEN и передан ?token=
+        status, body = profiling.handle_http(parse_qs(parsed_path.query))
+        return status, 'text/plain', body
+    return 404, 'text/plain', b"Not Found"
+
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
     """
     Обработчик HTTP-запросов для health check.
-    Отвечает 200 OK на GET и HEAD запросы к /healthz.
+    Отвечает 200 OK на GET и HEAD запросы к /healthz, готовность — на /readyz (200 или 503),
+    метрики Prometheus — на /metrics, свернутые стеки профилировщика — на /debug/profile.
     """
     def do_GET(self):
         """Обрабатывает GET-запросы."""
-        parsed_path = urlparse(self.path)
-        if parsed_path.path == '/healthz':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b"OK") # Отправляем тело ответа
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b"Not Found")
+        status, content_type, body = handle_request(self.path)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        self.wfile.write(body) # Отправляем тело ответа
 
     def do_HEAD(self):
         """
@@ -34,15 +58,10 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
         Логика та же, что и у GET, но тело ответа не отправляется.
         Именно это и нужно для UptimeRobot.
         """
-        parsed_path = urlparse(self.path)
-        if parsed_path.path == '/healthz':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers() # Заголовки отправили, тело - нет.
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
+        status, content_type, _ = handle_request(self.path)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.end_headers() # Заголовки отправили, тело - нет.
 
     def log_message(self, format, *args):
         """Подавляем стандартное логирование запросов."""
@@ -52,7 +71,8 @@ def _run_server():
     """Внутренняя функция для запуска HTTP-сервера."""
     try:
         server_address = ('', HEALTH_CHECK_PORT)
-        httpd = HTTPServer(server_address, HealthCheckHandler)
+        # Каждый запрос в своем потоке: /debug/profile длится секунды и не должен задерживать /healthz
+        httpd = ThreadingHTTPServer(server_address, HealthCheckHandler)
         logger.info(f"Health Check HTTP-сервер запущен и слушает порт {HEALTH_CHECK_PORT}")
         httpd.serve_forever()
     except Exception as e:
@@ -0,0 +1,205 @@
+# loop_watchdog.py
+"""
+Сторож цикла событий и проверка готовности (/readyz).
+
+- heartbeat-задача просыпается каждые WATCHDOG_INTERVAL секунд и записывает, насколько позже
+  срока она проснулась (запаздывание цикла) в гистограмму loop_lag_seconds и в статистику;
+- отдельный поток следит за heartbeat: если цикл не отвечает дольше WATCHDOG_BLOCK_THRESHOLD,
+  в лог пишется стек потока цикла — видно, какой синхронный вызов его держит;
+- readiness() сообщает, готов ли бот обслуживать пользователей: запаздывание цикла,
+  доля ошибок Gemini и очередь необработанных обновлений не превышают заданных пределов.
+
+/healthz отвечает из своего потока и только подтверждает, что процесс жив;
+мониторинг (UptimeRobot и т.п.) должен проверять /readyz.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import metrics
+from backend_pool import backend_pool
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Период heartbeat (секунды)
+WATCHDOG_INTERVAL = float(os.environ.get("WATCHDOG_INTERVAL", 0.25))
+# Через сколько секунд без heartbeat цикл считается заблокированным и в лог пишется стек
+WATCHDOG_BLOCK_THRESHOLD = float(os.environ.get("WATCHDOG_BLOCK_THRESHOLD", 0.5))
+# Окно (секунды), за которое /readyz оценивает запаздывание цикла и долю ошибок Gemini
+READY_WINDOW = float(os.environ.get("READY_WINDOW", 60))
+# /readyz: наибольшее допустимое запаздывание цикла за окно (секунды)
+READY_MAX_LOOP_LAG = float(os.environ.get("READY_MAX_LOOP_LAG", 1.0))
+# /readyz: наибольшая доля ошибок Gemini за окно; учитывается, если запросов не меньше READY_MIN_UPSTREAM_REQUESTS
+READY_MAX_ERROR_RATE = float(os.environ.get("READY_MAX_ERROR_RATE", 0.5))
+READY_MIN_UPSTREAM_REQUESTS = int(os.environ.get("READY_MIN_UPSTREAM_REQUESTS", 10))
+# /readyz: наибольшее число обновлений в очереди и в обработке
+READY_MAX_BACKLOG = int(os.environ.get("READY_MAX_BACKLOG", 500))
+
+
+class LoopWatchdog:
+    """Heartbeat цикла событий, поток-сторож и накопленная статистика запаздывания."""
+
+    def __init__(self, interval: float = WATCHDOG_INTERVAL, block_threshold: float = WATCHDOG_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self._task = None
+        self._thread = None
+        self._loop_thread_id = None
+        self._backlog = None
+        self._last_beat = None
+        self._reported_beat = None   # heartbeat, на котором уже записан стек блокировки
+        self._recent = deque()       # (время, запаздывание) за READY_WINDOW
+        # Статистика
+        self.beats = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.blocked_total = 0
+        self.last_block_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, backlog=None):
+        """
+        Запускает heartbeat в текущем цикле событий и поток-сторож.
+        backlog — функция без аргументов, возвращающая число необработанных обновлений.
+        """
+        if self.running:
+            return
+        self._backlog = backlog
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        if self._thread is None:
+            # Поток живет до конца процесса и при остановленном heartbeat просто ждет
+            self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._last_beat = now
+            self.beats += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            metrics.loop_lag_seconds.observe(lag)
+            self._recent.append((now, lag))
+            while self._recent and self._recent[0][0] < now - READY_WINDOW:
+                self._recent.popleft()
+            if lag >= self.block_threshold:
+                self.blocked_total += 1
+                self.last_block_seconds = lag
+                logger.warning("Цикл событий был заблокирован %.2f с.", lag)
+
+    def _monitor(self):
+        """Поток-сторож: записывает стек потока цикла, пока тот заблокирован."""
+        while True:
+            time.sleep(self.interval)
+            if not self.running:
+                continue
+            last_beat = self._last_beat
+            stalled = time.monotonic() - last_beat - self.interval
+            if stalled < self.block_threshold or last_beat == self._reported_beat:
+                continue
+            self._reported_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(стек недоступен)\n"
+            logger.warning("Цикл событий не отвечает уже %.2f с. Стек потока цикла:\n%s", stalled, stack.rstrip())
+
+    def current_lag(self) -> float:
+        """Наибольшее запаздывание за окно, включая текущую блокировку, если она еще длится."""
+        if self._last_beat is None:
+            return 0.0
+        stalled = max(0.0, time.monotonic() - self._last_beat - self.interval)
+        return max([stalled] + [lag for _, lag in list(self._recent)])
+
+    def backlog(self) -> int:
+        if self._backlog is None:
+            return 0
+        try:
+            return int(self._backlog())
+        except Exception as e:
+            logger.debug("Не удалось получить очередь обновлений: %s", e)
+            return 0
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'beats': self.beats,
+            'lag_avg_ms': 1000 * self.lag_total / self.beats if self.beats else 0.0,
+            'lag_max_ms': 1000 * self.lag_max,
+            'lag_window_max_ms': 1000 * self.current_lag(),
+            'blocked_total': self.blocked_total,
+            'last_block_ms': 1000 * self.last_block_seconds,
+            'backlog': self.backlog(),
+        }
+
+
+# Сторож цикла событий бота
+watchdog = LoopWatchdog()
+metrics.register_stats('loop', watchdog.stats)
+
+# Дополнительные проверки готовности (например, процессов-обработчиков в приемнике, см. workers)
+_checks = []
+
+
+def register_check(check):
+    """Добавляет проверку в /readyz: check() возвращает (строки с причинами неготовности "FAIL ...", строки отчета)."""
+    _checks.append(check)
+
+
+def readiness() -> tuple:
+    """
+    Проверка готовности. Возвращает (готов ли, строки отчета); строки с причинами
+    неготовности начинаются с "FAIL". Вызывается из потока HTTP-сервера health check.
+    """
+    problems = []
+    lines = []
+
+    if not watchdog.running:
+        problems.append("FAIL event_loop: сторож цикла событий не запущен")
+    lag = watchdog.current_lag()
+    lines.append(f"loop_lag_max: {lag:.3f}s (limit {READY_MAX_LOOP_LAG:.3f}s)")
+    if lag > READY_MAX_LOOP_LAG:
+        problems.append(f"FAIL loop_lag: {lag:.3f}s > {READY_MAX_LOOP_LAG:.3f}s")
+
+    error_rate, requests = backend_pool.recent_error_rate(READY_WINDOW)
+    lines.append(f"upstream_error_rate: {error_rate:.2f} of {requests} (limit {READY_MAX_ERROR_RATE:.2f})")
+    if requests >= READY_MIN_UPSTREAM_REQUESTS and error_rate > READY_MAX_ERROR_RATE:
+        problems.append(f"FAIL upstream_error_rate: {error_rate:.2f} > {READY_MAX_ERROR_RATE:.2f}")
+
+    backlog = watchdog.backlog()
+    lines.append(f"update_backlog: {backlog} (limit {READY_MAX_BACKLOG})")
+    if backlog > READY_MAX_BACKLOG:
+        problems.append(f"FAIL update_backlog: {backlog} > {READY_MAX_BACKLOG}")
+
+    for check in list(_checks):
+        check_problems, check_lines = check()
+        problems.extend(check_problems)
+        lines.extend(check_lines)
+
+    return not problems, problems + lines
+
+
+def application_backlog(application) -> int:
+    """Обновления в очереди приложения и в обработке."""
+    return application.update_queue.qsize() + int(metrics.in_flight.value('updates'))
@@ -0,0 +1,292 @@
+# metrics.py
+"""
+Метрики бота в текстовом формате Prometheus (маршрут /metrics на порту health check).
+
+- stage_seconds — гистограммы задержек по этапам: обработка обновления, сборка промпта,
+  ожидание очереди планировщика, ответ Gemini, вызовы Telegram (отправка и правка),
+  сохранение состояния;
+- счетчики выбранных стилей, доработок, блокировок Gemini и ошибок по классам;
+- in_flight — сколько обновлений и запросов к Gemini выполняется прямо сейчас;
+- накопленная статистика подсистем (кэш, пул соединений, планировщик, бэкенды и т.д.),
+  которую модули регистрируют через register_stats и которая читается в момент запроса.
+
+При нескольких процессах (см. workers) обработчики периодически присылают приемнику снимок
+своих метрик (snapshot), и /metrics приемника выводит их вместе со своими с меткой worker.
+
+Модуль не зависит от остальных модулей бота, поэтому его можно импортировать откуда угодно.
+Значения обновляются из цикла событий, а читаются из потока HTTP-сервера, поэтому под блокировкой.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Префикс имен всех метрик
+NAMESPACE = "speaksmart"
+
+# Границы корзин гистограмм задержек (секунды): от быстрых правок Telegram до долгих генераций
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_lock = threading.Lock()
+# Все метрики в порядке регистрации
+_metrics = []
+# (префикс, функция статистики, имя поля-метки или None)
+_stats_sources = []
+# Последние снимки метрик процессов-обработчиков: номер процесса -> snapshot()
+_worker_snapshots = {}
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание, имена меток и значения по наборам меток."""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labelvalues: tuple) -> tuple:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получено {labelvalues}")
+        return tuple(str(value) for value in labelvalues)
+
+    def _render_series(self, labelvalues: tuple, value, extra: str = "") -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}"]
+
+    def render(self, workers: dict = None) -> list:
+        """Строки метрики; workers — значения той же метрики в процессах-обработчиках (номер -> значения)."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in sorted(self._values.items()):
+            lines.extend(self._render_series(labelvalues, value))
+        for worker, values in sorted((workers or {}).items()):
+            extra = f'worker="{_escape_label(worker)}"'
+            for labelvalues, value in sorted(values.items()):
+                lines.extend(self._render_series(labelvalues, value, extra))
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        key = self._key(labelvalues)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое может расти и убывать."""
+    kind = "gauge"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        key = self._key(labelvalues)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float, *labelvalues):
+        key = self._key(labelvalues)
+        with _lock:
+            self._values[key] = value
+
+    def value(self, *labelvalues) -> float:
+        key = self._key(labelvalues)
+        with _lock:
+            return self._values.get(key, 0)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, *labelvalues):
+        """Увеличивает значение на время выполнения блока."""
+        self.inc(*labelvalues)
+        try:
+            yield
+        finally:
+            self.dec(*labelvalues)
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (кумулятивные счетчики, сумма и количество)."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, *labelvalues):
+        key = self._key(labelvalues)
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                # [счетчики корзин..., сумма, количество]
+                series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues):
+        """Измеряет длительность блока (в том числе завершившегося исключением)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def _render_series(self, labelvalues: tuple, series: list, extra: str = "") -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            bucket_labels = _format_labels(self.labelnames, labelvalues, f"{extra},{le}" if extra else le)
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        labels = _format_labels(self.labelnames, labelvalues, extra)
+        lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+        lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+# --- Метрики бота ---
+
+stage_seconds = Histogram(
+    "stage_seconds",
+    "Длительность этапов обработки: handler, prompt_build, queue_wait, upstream, upstream_first_chunk, telegram_send, telegram_edit, persistence_flush.",
+    ("stage",),
+)
+styles_total = Counter("styles_total", "Выбор стиля переформулирования.", ("style",))
+adjustments_total = Counter("adjustments_total", "Нажатия кнопок доработки (включая «Сгенерировать заново»).", ("action",))
+blocked_total = Counter("gemini_blocked_total", "Ответы Gemini, заблокированные по причине blockReason/finishReason.", ("reason",))
+errors_total = Counter("errors_total", "Ошибки по классам (ответы Gemini, сеть, необработанные исключения обработчиков).", ("error_class",))
+loop_lag_seconds = Histogram(
+    "loop_lag_seconds",
+    "Запаздывание цикла событий: на сколько позже срока проснулся heartbeat (см. loop_watchdog).",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+fuzzy_similarity = Histogram(
+    "fuzzy_cache_similarity",
+    "Похожесть текста на найденный в fuzzy_cache: hit — ответ показан, rejected — отличия не только в именах, false_hit — после показа нажато «Сгенерировать заново».",
+    ("outcome",),
+    buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0),
+)
+call_seconds = Histogram(
+    "call_seconds",
+    "Длительность вызовов, обернутых profiling.timed: обработчики диалога (handler:<имя>) и запросы к Gemini (gemini:<имя>).",
+    ("function",),
+)
+prompts_total = Counter("prompts_total", "Собранные промпты по шаблонам (имя@версия, см. prompts.PromptTemplate.id).", ("template",))
+in_flight = Gauge("in_flight", "Сколько операций выполняется прямо сейчас: updates — обновления Telegram, upstream — запросы к Gemini.", ("kind",))
+
+
+def stage_timer(stage: str):
+    """Контекстный менеджер: записывает длительность блока в stage_seconds{stage=...}."""
+    return stage_seconds.time(stage)
+
+
+def register_stats(prefix: str, get_stats, label_key: str = None):
+    """
+    Регистрирует источник накопленной статистики модуля. get_stats вызывается при каждом
+    запросе /metrics и возвращает словарь; числовые значения выводятся как gauge
+    speaksmart_<prefix>_<ключ>, логические — как 0/1, остальные пропускаются.
+    Если указан label_key, get_stats возвращает список словарей, а значение поля label_key
+    становится меткой (например, статистика каждого бэкенда Gemini).
+    """
+    with _lock:
+        _stats_sources.append((prefix, get_stats, label_key))
+
+
+def _collect_stats(sources: list) -> list:
+    """Вызывает источники статистики: [(префикс, имя поля-метки, результат get_stats)]."""
+    collected = []
+    for prefix, get_stats, label_key in sources:
+        try:
+            collected.append((prefix, label_key, get_stats()))
+        except Exception as e:
+            # Сбой одного источника не должен ломать весь ответ /metrics
+            logger.error(f"Не удалось получить статистику '{prefix}' для /metrics: {e}", exc_info=True)
+    return collected
+
+
+def _add_stats_series(series: dict, prefix: str, label_key: str, rows, extra: str = ""):
+    """Добавляет в series (имя метрики -> строки) значения одного источника статистики."""
+    if label_key is None:
+        rows = [rows]
+    for row in rows:
+        labels = _format_labels((label_key,), (row[label_key],), extra) if label_key else _format_labels((), (), extra)
+        for key, value in row.items():
+            if key == label_key or value is None or isinstance(value, str):
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                series.setdefault(f"{NAMESPACE}_{prefix}_{key}", []).append(
+                    f"{NAMESPACE}_{prefix}_{key}{labels} {_format_value(value)}"
+                )
+
+
+def snapshot() -> dict:
+    """Значения всех метрик и статистики модулей в виде, который можно передать в другой процесс."""
+    with _lock:
+        values = {
+            metric.name: {key: list(value) if isinstance(value, list) else value for key, value in metric._values.items()}
+            for metric in _metrics
+        }
+        sources = list(_stats_sources)
+    return {'metrics': values, 'stats': _collect_stats(sources)}
+
+
+def set_worker_snapshot(worker: str, worker_snapshot: dict):
+    """Запоминает последний снимок метрик процесса-обработчика для вывода в /metrics."""
+    with _lock:
+        _worker_snapshots[worker] = worker_snapshot
+
+
+def render() -> str:
+    """Возвращает все метрики в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        workers = dict(_worker_snapshots)
+        for metric in _metrics:
+            lines.extend(metric.render({
+                worker: worker_snapshot['metrics'][metric.name]
+                for worker, worker_snapshot in workers.items() if metric.name in worker_snapshot['metrics']
+            }))
+        sources = list(_stats_sources)
+    # Одна и та же статистика приемника и обработчиков выводится одной метрикой с разными метками
+    series = {}
+    for prefix, label_key, rows in _collect_stats(sources):
+        _add_stats_series(series, prefix, label_key, rows)
+    for worker, worker_snapshot in sorted(workers.items()):
+        for prefix, label_key, rows in worker_snapshot['stats']:
+            _add_stats_series(series, prefix, label_key, rows, f'worker="{_escape_label(worker)}"')
+    for name, samples in series.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
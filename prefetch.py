@@ -0,0 +1,182 @@
+# prefetch.py
+"""
+Упреждающая генерация вариантов тона (включается PREFETCH_VARIANTS=1).
+
+Как только пользователь получил первый ответ (выбор стиля или описание адресата),
+в фоне параллельно запрашиваются варианты «Мягче», «Жестче» и «Формальнее».
+Они сохраняются в user_data вместе с текстом, к которому относятся, и нажатие
+кнопки показывает готовый вариант без обращения к API. Если вариант еще генерируется,
+обработчик дожидается уже идущего запроса, а не отправляет новый.
+
+Расход ограничен общим бюджетом токенов в минуту и длиной текста; фоновые запросы
+отменяются, когда пользователь начинает новый текст.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import gemini_api
+import metrics
+import prompts
+import retention
+from scheduler import Superseded
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Включить упреждающую генерацию вариантов тона
+PREFETCH_VARIANTS = os.environ.get("PREFETCH_VARIANTS", "0") == "1"
+# Бюджет фоновой генерации на всех пользователей: оценка токенов (вход + выход) в минуту, 0 — без ограничения
+PREFETCH_TOKENS_PER_MINUTE = float(os.environ.get("PREFETCH_TOKENS_PER_MINUTE", 30000))
+# Для ответов длиннее этого числа символов варианты заранее не генерируются
+PREFETCH_MAX_TEXT_CHARS = int(os.environ.get("PREFETCH_MAX_TEXT_CHARS", 2000))
+
+# Какие кнопки меню доработки обслуживаются заранее
+PREFETCH_ACTIONS = ('adjust_softer', 'adjust_harder', 'adjust_more_formal')
+
+# Ключ user_data: {'source': текст, к которому относятся варианты, 'variants': {action: текст}}
+USER_DATA_KEY = 'prefetched_variants'
+# Готовые варианты можно выбросить при нехватке памяти — они лишь ускоряют ответ
+retention.DISPOSABLE_KEYS.append(USER_DATA_KEY)
+
+# user_id -> {action: asyncio.Task} — фоновые запросы, которые еще выполняются
+_tasks = {}
+# (время, токены) потраченного за последнюю минуту бюджета
+_spent = deque()
+
+
+class PrefetchStats:
+    """Счетчики упреждающей генерации."""
+    def __init__(self):
+        self.batches_started = 0
+        self.variants_generated = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped_budget = 0
+        self.skipped_too_long = 0
+        self.cancelled = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+stats = PrefetchStats()
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики упреждающей генерации: запущено, попаданий, пропусков из-за бюджета и т.д."""
+    return stats.snapshot()
+
+
+metrics.register_stats('prefetch', get_stats)
+
+
+def _try_spend(tokens: int) -> bool:
+    """Списывает токены из минутного бюджета, если их хватает."""
+    if not PREFETCH_TOKENS_PER_MINUTE:
+        return True
+    now = time.monotonic()
+    while _spent and now - _spent[0][0] > 60:
+        _spent.popleft()
+    if sum(amount for _, amount in _spent) + tokens > PREFETCH_TOKENS_PER_MINUTE:
+        return False
+    _spent.append((now, tokens))
+    return True
+
+
+def start(user_id: int, chat_id: int, user_data: dict, response_text: str, chosen_style: str):
+    """Запускает фоновую генерацию вариантов тона для только что показанного ответа."""
+    if not PREFETCH_VARIANTS:
+        return
+    cancel(user_id, user_data)
+    if len(response_text) > PREFETCH_MAX_TEXT_CHARS:
+        stats.skipped_too_long += 1
+        return
+
+    templates = {action: prompts.get_adjust_template(action, chosen_style) for action in PREFETCH_ACTIONS}
+    prompts_by_action = {action: template.render(text=response_text) for action, template in templates.items()}
+    # Ответ сопоставим по длине с исходным текстом, поэтому выход оцениваем так же, как вход
+    cost = sum(gemini_api.estimate_tokens(prompt) + gemini_api.estimate_tokens(response_text)
+               for prompt in prompts_by_action.values())
+    if not _try_spend(cost):
+        stats.skipped_budget += 1
+        logger.debug(f"Упреждающая генерация для пользователя {user_id} пропущена: исчерпан бюджет.")
+        return
+
+    store = {'source': response_text, 'variants': {}}
+    user_data[USER_DATA_KEY] = store
+    tasks = _tasks[user_id] = {}
+    for action, prompt in prompts_by_action.items():
+        task = asyncio.create_task(_prefetch_one(chat_id, prompt, templates[action].id, store, action))
+        task.add_done_callback(lambda _, action=action: _forget_task(user_id, tasks, action))
+        tasks[action] = task
+    stats.batches_started += 1
+
+
+async def _prefetch_one(chat_id: int, prompt: str, template_id: str, store: dict, action: str):
+    try:
+        # supersede=False: соседние фоновые запросы того же чата не должны отменять друг друга
+        text = await gemini_api.generate_async(prompt, chat_id=chat_id, supersede=False, template_id=template_id)
+    except (gemini_api.GeminiError, Superseded):
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка упреждающей генерации ({action}): {e}", exc_info=True)
+        return None
+    store['variants'][action] = text
+    stats.variants_generated += 1
+    return text
+
+
+def _forget_task(user_id: int, tasks: dict, action: str):
+    tasks.pop(action, None)
+    # К этому моменту пользователь мог начать новый текст: удаляем только свою пачку
+    if not tasks and _tasks.get(user_id) is tasks:
+        del _tasks[user_id]
+
+
+def has_variant(user_data: dict, action: str, source_text: str) -> bool:
+    """Готов ли уже вариант для кнопки action (без ожидания)."""
+    store = user_data.get(USER_DATA_KEY)
+    return bool(store) and store.get('source') == source_text and action in store['variants']
+
+
+async def take(user_id: int, user_data: dict, action: str, source_text: str) -> str:
+    """
+    Возвращает заранее сгенерированный вариант для кнопки action, если он относится к source_text,
+    дожидаясь уже идущего фонового запроса. Иначе возвращает None — нужен обычный запрос.
+    Оставшиеся варианты после этого больше не нужны: следующая доработка пойдет от нового текста.
+    """
+    store = user_data.get(USER_DATA_KEY)
+    if not store or store.get('source') != source_text or action not in PREFETCH_ACTIONS:
+        if PREFETCH_VARIANTS and action in PREFETCH_ACTIONS:
+            stats.misses += 1
+        return None
+
+    text = store['variants'].get(action)
+    task = _tasks.get(user_id, {}).get(action)
+    if text is None and task is not None:
+        try:
+            text = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # Отменен сам обработчик, а не фоновый запрос
+                raise
+            text = None
+    cancel(user_id, user_data)
+    if text is None:
+        stats.misses += 1
+    else:
+        stats.hits += 1
+    return text
+
+
+def cancel(user_id: int, user_data: dict = None):
+    """Отменяет фоновые запросы пользователя и удаляет сохраненные варианты."""
+    for task in _tasks.pop(user_id, {}).values():
+        if not task.done():
+            task.cancel()
+            stats.cancelled += 1
+    if user_data is not None:
+        user_data.pop(USER_DATA_KEY, None)
@@ -0,0 +1,299 @@
+# profiling.py
+"""
+Таймеры обработчиков и профилирование по запросу.
+
+- timed(name) — декоратор, который записывает длительность вызова в гистограмму
+  call_seconds{function=...}. Подходит для обычных функций, корутин и асинхронных генераторов
+  (для генератора измеряется время от первого запроса элемента до конца потока).
+  instrument_conversation() оборачивает им обработчики всех состояний ConversationHandler,
+  а gemini_api — функции запросов к модели. При PROFILING_TIMERS=0 декоратор возвращает
+  функцию без изменений, и накладных расходов нет вовсе.
+- SamplingProfiler — сэмплирующий профилировщик, который включается на N секунд по команде
+  администратора (/profile) или по HTTP-запросу к /debug/profile и возвращает стеки в свернутом
+  формате (collapsed stacks: «кадр;кадр;кадр число»), который понимают flamegraph.pl, speedscope
+  и inferno. Пока профилирование не запрошено, он ничего не делает. На время снятия профиля
+  интервал переключения GIL (sys.setswitchinterval) уменьшается для всего процесса — это
+  затрагивает все потоки, в том числе пул потоков, — и восстанавливается по окончании.
+
+Режимы профилирования:
+- loop — стек потока цикла событий: где тратится процессорное время обработчиков
+  (и что блокирует цикл, см. также loop_watchdog);
+- tasks — цепочки await всех задач asyncio: где обработчики ждут (Gemini, Telegram, очереди);
+- threads — стеки всех потоков, включая пул потоков (синхронные вызовы через asyncio.to_thread).
+
+В режиме с несколькими процессами (WORKERS > 1) /debug/profile профилирует приемник,
+/debug/profile?worker=N — процесс-обработчик шарда N, а команда /profile — процесс шарда администратора.
+"""
+import asyncio
+import functools
+import hmac
+import inspect
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Таймеры обработчиков и запросов к Gemini (гистограмма call_seconds); 0 — отключить
+PROFILING_TIMERS = os.environ.get("PROFILING_TIMERS", "1") == "1"
+# Период сэмплирования (секунды)
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+# Интервал переключения GIL на время профилирования (sys.setswitchinterval, секунды).
+# Настройка общая для всего процесса: пока идет профилирование, потоки переключаются чаще,
+# что немного замедляет процессорную работу всех потоков; после профилирования значение восстанавливается
+PROFILE_SWITCH_INTERVAL = float(os.environ.get("PROFILE_SWITCH_INTERVAL", 0.0002))
+# Наибольшая и стандартная длительность профилирования (секунды)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+PROFILE_DEFAULT_SECONDS = float(os.environ.get("PROFILE_DEFAULT_SECONDS", 10))
+# Telegram id администраторов через запятую: только им доступна команда /profile
+ADMIN_USER_IDS = {int(user_id) for user_id in os.environ.get("ADMIN_USER_IDS", "").replace(" ", "").split(",") if user_id}
+# Токен для /debug/profile?token=...; если не задан, маршрут отключен
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+
+MODES = ("loop", "tasks", "threads")
+
+
+def timed(name: str):
+    """Декоратор: записывает длительность каждого вызова в call_seconds{function=name}."""
+    def decorator(func):
+        if not PROFILING_TIMERS:
+            return func
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def async_gen_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                stream = func(*args, **kwargs)
+                try:
+                    async for item in stream:
+                        yield item
+                finally:
+                    # Если поток прерван раньше конца, закрываем и исходный генератор
+                    await stream.aclose()
+                    metrics.call_seconds.observe(time.perf_counter() - started, name)
+            return async_gen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metrics.call_seconds.observe(time.perf_counter() - started, name)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.call_seconds.observe(time.perf_counter() - started, name)
+        return wrapper
+
+    return decorator
+
+
+def instrument_conversation(conv_handler):
+    """Оборачивает таймерами обработчики точек входа, всех состояний и fallbacks диалога."""
+    if not PROFILING_TIMERS:
+        return conv_handler
+    handlers = list(conv_handler.entry_points) + list(conv_handler.fallbacks)
+    for state_handlers in conv_handler.states.values():
+        handlers.extend(state_handlers)
+    # Один и тот же обработчик встречается в нескольких состояниях — оборачиваем его один раз
+    wrapped = {}
+    for handler in handlers:
+        callback = handler.callback
+        if callback not in wrapped:
+            wrapped[callback] = timed(f"handler:{callback.__name__}")(callback)
+        handler.callback = wrapped[callback]
+    return conv_handler
+
+
+class ProfilerBusy(Exception):
+    """Профилирование уже идет: одновременно выполняется только одно."""
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse_frame(frame) -> list:
+    """Стек потока от корня к вершине."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _collapse_task(task) -> list:
+    """Цепочка await задачи от ее корутины до самого глубокого ожидания."""
+    labels = [f"task {task.get_name()}"]
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        code = getattr(awaitable, 'cr_code', None) or getattr(awaitable, 'ag_code', None) or getattr(awaitable, 'gi_code', None)
+        if code is None:
+            # Future или другой объект без кадра — конец цепочки
+            labels.append(type(awaitable).__name__)
+            break
+        labels.append(_frame_label(code))
+        awaitable = (getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'ag_await', None)
+                     or getattr(awaitable, 'gi_yieldfrom', None))
+    return labels
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик: поток, который раз в PROFILE_SAMPLE_INTERVAL снимает стеки
+    и считает одинаковые. Цикл событий при этом не останавливается и не замедляется заметно.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread_id = None
+        # Статистика
+        self.profiles = 0
+        self.samples_total = 0
+        self.running = False
+
+    def attach(self):
+        """Запоминает текущий цикл событий и его поток; вызывается из цикла при старте приложения."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+
+    def _sample(self, mode: str, own_thread: int) -> list:
+        if mode == "tasks":
+            if self._loop is None:
+                return []
+            # all_tasks из другого потока безопасен: он повторяет обход, если набор изменился
+            return [_collapse_task(task) for task in asyncio.all_tasks(self._loop) if not task.done()]
+        frames = sys._current_frames()
+        if mode == "loop":
+            frame = frames.get(self._loop_thread_id)
+            return [_collapse_frame(frame)] if frame is not None else []
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        return [
+            [f"thread {names.get(ident, ident)}"] + _collapse_frame(frame)
+            for ident, frame in frames.items() if ident != own_thread
+        ]
+
+    def profile(self, seconds: float, mode: str = "loop") -> tuple:
+        """
+        Профилирует seconds секунд и возвращает (свернутые стеки, число снимков).
+        Блокирует вызывающий поток, поэтому из цикла событий вызывается через asyncio.to_thread.
+        На это время меняет интервал переключения GIL всего процесса (PROFILE_SWITCH_INTERVAL).
+        """
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode} (доступны: {', '.join(MODES)})")
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("Профилирование уже идет")
+        # Снимок берется, когда поток профилировщика получает GIL; без короткого интервала
+        # переключения это почти всегда происходит в select() цикла, и вычисления в стеках не видны
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, PROFILE_SWITCH_INTERVAL))
+        try:
+            self.running = True
+            seconds = min(max(seconds, self.interval), PROFILE_MAX_SECONDS)
+            logger.info("Профилирование (%s) на %.1f с.", mode, seconds)
+            own_thread = threading.get_ident()
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for stack in self._sample(mode, own_thread):
+                    stacks[";".join(label.replace(";", ":") for label in stack)] += 1
+                samples += 1
+                time.sleep(self.interval)
+            self.profiles += 1
+            self.samples_total += samples
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()), samples
+        finally:
+            sys.setswitchinterval(switch_interval)
+            self.running = False
+            self._lock.release()
+
+    def stats(self) -> dict:
+        return {'running': self.running, 'profiles': self.profiles, 'samples_total': self.samples_total}
+
+
+profiler = SamplingProfiler()
+metrics.register_stats('profiler', profiler.stats)
+
+
+# При нескольких процессах (см. workers) приемник задает функцию (номер процесса, секунды, режим) ->
+# (код ответа, тело), которая профилирует процесс-обработчик: /debug/profile?worker=N
+worker_profiler = None
+
+
+def profile_response(seconds: float, mode: str) -> tuple:
+    """Профилирование этого процесса в виде ответа HTTP: (код ответа, тело)."""
+    try:
+        collapsed, _ = profiler.profile(seconds, mode)
+    except ProfilerBusy as e:
+        return 409, f"{e}\n".encode()
+    except ValueError as e:
+        return 400, f"{e}\n".encode()
+    return 200, collapsed.encode()
+
+
+def handle_http(query: dict) -> tuple:
+    """
+    Маршрут /debug/profile?seconds=N&mode=loop|tasks|threads&worker=N&token=...: (код ответа, тело).
+    Вызывается из потока HTTP-сервера и держит его, пока идет профилирование.
+    """
+    token = query.get('token', [''])[0]
+    if not PROFILE_TOKEN or not hmac.compare_digest(token, PROFILE_TOKEN):
+        return 404, b"Not Found"
+    try:
+        seconds = float(query.get('seconds', [PROFILE_DEFAULT_SECONDS])[0])
+        worker = int(query['worker'][0]) if 'worker' in query else None
+    except ValueError as e:
+        return 400, f"{e}\n".encode()
+    mode = query.get('mode', ['loop'])[0]
+    if worker is None:
+        return profile_response(seconds, mode)
+    if worker_profiler is None:
+        return 400, "Параметр worker доступен только при WORKERS > 1\n".encode()
+    return worker_profiler(worker, seconds, mode)
+
+
+async def profile_command(update, context):
+    """/profile [секунды] [loop|tasks|threads] — профилирование для администраторов, результат файлом."""
+    user = update.effective_user
+    if user is None or user.id not in ADMIN_USER_IDS:
+        return
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+        mode = context.args[1] if len(context.args) > 1 else "loop"
+        await update.message.reply_text(f"Профилирую ({mode}) {min(seconds, PROFILE_MAX_SECONDS):.0f} с...")
+        collapsed, samples = await asyncio.to_thread(profiler.profile, seconds, mode)
+    except (ProfilerBusy, ValueError) as e:
+        await update.message.reply_text(f"Профилирование не выполнено: {e}")
+        return
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=io.BytesIO(collapsed.encode() or b"\n"),
+        filename=f"profile_{mode}_{time.strftime('%Y%m%d_%H%M%S')}.folded",
+        caption=f"Снимков: {samples}. Формат collapsed stacks (flamegraph.pl, speedscope).",
+    )
+
+
+def setup(application):
+    """Подключает команду /profile к приложению (только для ADMIN_USER_IDS)."""
+    from telegram.ext import CommandHandler
+
+    if ADMIN_USER_IDS:
+        application.add_handler(CommandHandler("profile", profile_command))
@@ -0,0 +1,262 @@
+# prompts.py
+"""
+Реестр шаблонов промптов для Gemini.
+Все инструкции стилей и доработок собираются в готовые шаблоны один раз при импорте,
+а на каждый запрос в шаблон подставляется только текст пользователя (и описание адресата).
+У каждого шаблона есть идентификатор версии, на который могут опираться кэш и метрики.
+"""
+import hashlib
+import os
+import re
+
+import metrics
+
+# Ручная версия набора промптов. Увеличивайте при изменении смысла инструкций.
+PROMPT_VERSION = "1"
+
+# Компактный режим автоподбора стиля: если адресата удается уверенно отнести к одному стилю
+# по ключевым словам, в модель уходят инструкции только этого стиля, а не всех четырех.
+AUTO_STYLE_COMPACT = os.environ.get("AUTO_STYLE_COMPACT", "1") == "1"
+
+# --- Главная, универсальная инструкция ---
+TUNE_INSTRUCTION = """Твоя главная задача — действовать как деликатный корректор, а не как рерайтер.
+1.  **ОБЯЗАТЕЛЬНО СОХРАНЯЙ ПРИВЕТСТВИЯ:** Никогда не удаляй и не изменяй слова приветствия, такие как "привет", "здравствуйте", "добрый день" и т.п., если они есть в начале текста.
+2.  **МИНИМАЛЬНЫЕ ИЗМЕНЕНИЯ:** Не переписывай предложения полностью. Твоя цель — лишь слегка "причесать" текст. Вноси только самые необходимые, точечные изменения: можешь заменить разговорное слово на более формальное или поменять порядок слов для улучшения структуры.
+3.  **СОХРАНЯЙ СУТЬ И ЛЕКСИКУ:** Сохраняй максимум оригинальных слов и конструкций автора. Идея и суть текста должны остаться абсолютно неизменными.
+4.  **СОХРАНЯЙ ФОРМАТИРОВАНИЕ:** Сохраняй исходное деление на абзацы и переносы строк. Не объединяй несколько абзацев в один."""
+
+# --- Инструкции для каждого стиля ---
+STYLE_INSTRUCTIONS = {
+    "style_business": """Применяй следующие принципы делового стиля:
+1.  **Обеспечь лаконичность:** Если в предложении есть очевидно лишние слова или повторы, которые можно убрать без потери смысла и изменения структуры — сделай это.
+2.  **Придай официальный тон:** Заменяй разговорную лексику и жаргон на нейтральные или деловые эквиваленты.
+3.  **Сохраняй фокус на цели:** Убедись, что ключевая мысль, просьба или предложение выражены четко и ясно.""",
+    "style_academic": """Применяй следующие принципы учебного (академического) стиля:
+1.  **Усиль логические связки:** При необходимости замени союзы или добавь вводные слова (например, «следовательно», «однако»), чтобы улучшить логическую последовательность, не меняя порядок предложений.
+2.  **Используй точную терминологию:** Если в тексте есть разговорные аналоги научных или учебных терминов, замени их на корректные термины.
+3.  **Соблюдай нейтральность:** Убирай эмоционально окрашенные слова, заменяя их на нейтральные синонимы.""",
+    "style_personal": """Применяй следующие принципы для личного общения:
+1.  **Сделай текст более живым:** Если это уместно, замени нейтральное слово на более эмоциональный синоним, не меняя общий смысл и конструкцию предложения.
+2.  **Сохраняй авторский голос:** Не трогай характерные для автора выражения, сленг или личные обороты речи, если они не мешают пониманию.
+3.  **Улучши связность:** Если два коротких предложения можно логично объединить в одно без потери авторского стиля, сделай это.""",
+    "style_simplified": """Применяй следующие принципы для упрощения текста:
+1.  **Используй простую лексику:** Последовательно заменяй сложные или узкоспециализированные слова на их более простые и общеупотребительные аналоги.
+2.  **Сокращай, но осторожно:** Только если предложение очень длинное и запутанное, ты можешь аккуратно разделить его на два, стараясь сохранить исходные слова и порядок мысли. Не делай этого без крайней необходимости.""",
+}
+
+# Человекочитаемые названия стилей
+STYLE_NAMES = {
+    "style_business": "Деловой стиль",
+    "style_academic": "Учебный стиль",
+    "style_personal": "Личное общение",
+    "style_simplified": "Упрощённый текст",
+}
+
+# --- Доработки тона: (описание для статуса, префикс ответа, инструкция для модели) ---
+ADJUSTMENTS = {
+    "adjust_softer": (
+        "смягчение тона",
+        "Готово! Сделал текст немного мягче:",
+        "Сделай следующий текст немного мягче по тону, заменяя отдельные слова на более вежливые или дипломатичные синонимы, но не меняя структуру предложений.",
+    ),
+    "adjust_harder": (
+        "увеличение жесткости/настойчивости тона",
+        "Есть! Текст стал более настойчивым:",
+        "Сделай следующий текст немного жестче или более настойчивым по тону, заменяя отдельные слова на более сильные или прямые синонимы, но не меняя структуру предложений.",
+    ),
+    "adjust_more_formal": (
+        "увеличение формальности стиля",
+        "Пожалуйста! Теперь текст более формальный:",
+        "Сделай следующий текст еще более формальным, заменяя разговорные или нейтральные слова на их более официальные эквиваленты, но не меняя структуру предложений.",
+    ),
+}
+# Для учебного стиля «Формальнее» не должно превращать текст в сухой официальный документ
+ACADEMIC_MORE_FORMAL_INSTRUCTION = "Сделай следующий текст немного более формальным, но избегай излишней строгости. Можно заменить некоторые нейтральные слова на более академические аналоги или улучшить связность предложений. Цель — отполированный учебный текст, а не сухой официальный документ."
+
+_ANSWER_ONLY_INSTRUCTION = "НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."
+
+
+class PromptTemplate:
+    """
+    Готовый шаблон промпта. Поля подставляются через str.format,
+    поэтому значения пользователя (даже с фигурными скобками) не интерпретируются.
+    """
+    __slots__ = ('name', 'template', 'version')
+
+    def __init__(self, name: str, template: str):
+        self.name = name
+        self.template = template
+        content_hash = hashlib.sha1(template.encode('utf-8')).hexdigest()[:8]
+        self.version = f"{PROMPT_VERSION}.{content_hash}"
+
+    @property
+    def id(self) -> str:
+        """Идентификатор шаблона с версией, например 'style_business@1.3f2a9c01'."""
+        return f"{self.name}@{self.version}"
+
+    def render(self, **fields) -> str:
+        metrics.prompts_total.inc(self.id)
+        with metrics.stage_timer('prompt_build'):
+            return self.template.format(**fields)
+
+
+def _escape(text: str) -> str:
+    """Экранирует фигурные скобки в статичных частях шаблона."""
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def _build_style_template(style: str) -> PromptTemplate:
+    return PromptTemplate(style, (
+        "Твоя задача: внимательно и аккуратно переформулировать следующий исходный текст. "
+        f"{_escape(TUNE_INSTRUCTION)} "
+        f"Вот конкретные принципы, которым нужно следовать для выбранного стиля:\n{_escape(STYLE_INSTRUCTIONS[style])}\n"
+        "КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла. "
+        "Исходный текст для переформулирования: \"{text}\"\n\n"
+        "Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст. "
+        f"{_ANSWER_ONLY_INSTRUCTION}"
+    ))
+
+
+def _build_auto_template() -> PromptTemplate:
+    return PromptTemplate("style_auto", f"""Твоя задача – переформулировать исходный текст, автоматически подобрав для него наиболее подходящий стиль, учитывая, что сообщение адресовано: '{{addressee}}'.
+{_escape(TUNE_INSTRUCTION)}
+Проанализируй исходный текст и описание адресата. Определи, какой из следующих четырех стилей (Деловой, Учебный, Личное общение, Упрощение текста) является наиболее подходящим для данной ситуации.
+После того как ты определишь наиболее подходящий стиль, переформулируй исходный текст, СТРОГО следуя ИСКЛЮЧИТЕЛЬНО инструкциям для ВЫБРАННОГО ТОБОЙ стиля.
+Вот детальные инструкции для каждого стиля:
+---
+ИНСТРУКЦИИ ДЛЯ ДЕЛОВОГО СТИЛЯ:
+{_escape(STYLE_INSTRUCTIONS["style_business"])}
+---
+ИНСТРУКЦИИ ДЛЯ УЧЕБНОГО (АКАДЕМИЧЕСКОГО) СТИЛЯ:
+{_escape(STYLE_INSTRUCTIONS["style_academic"])}
+---
+ИНСТРУКЦИИ ДЛЯ СТИЛЯ ЛИЧНОГО ОБЩЕНИЯ:
+{_escape(STYLE_INSTRUCTIONS["style_personal"])}
+---
+ИНСТРУКЦИИ ДЛЯ УПРОЩЕНИЯ ТЕКСТА:
+{_escape(STYLE_INSTRUCTIONS["style_simplified"])}
+---
+Если ты не можешь с высокой уверенностью определить один из этих четырех стилей на основе описания адресата ('{{addressee}}') и исходного текста, сделай переформулированный текст максимально нейтральным и обезличенным, без явных обращений и излишних эмоций, но при этом понятным, логичным и сохраняющим всю суть исходного сообщения.
+КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла.
+Исходный текст для переформулирования: "{{text}}"
+
+Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст.
+{_ANSWER_ONLY_INSTRUCTION}""")
+
+
+def _build_compact_auto_template(style: str) -> PromptTemplate:
+    return PromptTemplate(f"style_auto_compact_{style}", f"""Твоя задача – переформулировать исходный текст, учитывая, что сообщение адресовано: '{{addressee}}'.
+{_escape(TUNE_INSTRUCTION)}
+Для такого адресата подходит стиль «{STYLE_NAMES[style]}». Переформулируй исходный текст, СТРОГО следуя инструкциям для этого стиля:
+{_escape(STYLE_INSTRUCTIONS[style])}
+КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла.
+Исходный текст для переформулирования: "{{text}}"
+
+Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст.
+{_ANSWER_ONLY_INSTRUCTION}""")
+
+
+def _build_adjust_template(name: str, instruction: str) -> PromptTemplate:
+    return PromptTemplate(name, (
+        "Твоя задача — изменить тон предоставленного текста согласно инструкции, при этом строго следуя общим правилам. "
+        f"{_escape(TUNE_INSTRUCTION)}\n"
+        f"Инструкция по изменению тона: {_escape(instruction)}\n"
+        "КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений или потерь ключевой информации. "
+        "Вот текст для модификации: \"{text}\"\n\n"
+        "Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО измененный текст. "
+        f"{_ANSWER_ONLY_INSTRUCTION}"
+    ))
+
+
+def _build_batch_template(style: str) -> PromptTemplate:
+    return PromptTemplate(f"batch_{style}", (
+        "Твоя задача: внимательно и аккуратно переформулировать КАЖДЫЙ из нескольких независимых исходных текстов. "
+        f"{_escape(TUNE_INSTRUCTION)} "
+        f"Вот конкретные принципы, которым нужно следовать для выбранного стиля:\n{_escape(STYLE_INSTRUCTIONS[style])}\n"
+        "КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл каждого исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла. "
+        "Тексты не связаны между собой: не переноси информацию из одного текста в другой.\n"
+        "Исходные тексты — JSON-массив объектов с полями \"id\" и \"text\":\n{items}\n\n"
+        "Ответ — ИСКЛЮЧИТЕЛЬНО JSON-массив объектов "
+        "{{\"id\": <id исходного текста>, \"text\": \"<переформулированный текст>\"}}, "
+        "ровно по одному на каждый исходный текст, с теми же id. "
+        "Никакого текста вне JSON."
+    ))
+
+
+# --- Шаблоны, собранные один раз при импорте ---
+STYLE_TEMPLATES = {style: _build_style_template(style) for style in STYLE_INSTRUCTIONS}
+AUTO_STYLE_TEMPLATE = _build_auto_template()
+COMPACT_AUTO_TEMPLATES = {style: _build_compact_auto_template(style) for style in STYLE_INSTRUCTIONS}
+ADJUST_TEMPLATES = {action: _build_adjust_template(action, instruction)
+                    for action, (_, _, instruction) in ADJUSTMENTS.items()}
+ADJUST_TEMPLATES["adjust_more_formal_academic"] = _build_adjust_template(
+    "adjust_more_formal_academic", ACADEMIC_MORE_FORMAL_INSTRUCTION
+)
+# Пакетная обработка: несколько текстов в одном запросе со структурированным ответом (bulk.py)
+BATCH_TEMPLATES = {style: _build_batch_template(style) for style in STYLE_INSTRUCTIONS}
+
+
+def get_style_template(style: str):
+    """Возвращает шаблон для фиксированного стиля или None, если стиль неизвестен."""
+    return STYLE_TEMPLATES.get(style)
+
+
+def get_batch_template(style: str):
+    """Возвращает шаблон пакетной обработки для стиля или None, если стиль неизвестен."""
+    return BATCH_TEMPLATES.get(style)
+
+
+def get_adjust_template(action: str, chosen_style: str = None):
+    """Возвращает шаблон доработки тона с учетом выбранного ранее стиля или None для неизвестного действия."""
+    if action == "adjust_more_formal" and chosen_style == "style_academic":
+        return ADJUST_TEMPLATES["adjust_more_formal_academic"]
+    return ADJUST_TEMPLATES.get(action)
+
+
+# --- Локальная классификация адресата для компактного автоподбора ---
+# Основы слов (фрагменты регулярных выражений), по которым описание адресата относится к стилю.
+# Порядок важен: совпавшие фрагменты вырезаются перед проверкой следующих стилей, поэтому
+# «научному руководителю» попадает в учебный стиль и не считается «руководителем» из делового.
+_ADDRESSEE_KEYWORDS = (
+    ("style_academic", (r"научн\w*\s+руководител", "учител", "преподавател", "профессор", "доцент", "научн", "декан", "куратор",
+                        "кафедр", "университет", "институт", "школ", "учебн", "классн")),
+    ("style_business", ("начальни", "руководител", "директор", "шеф", "босс", "клиент", "коллег", "партн",
+                        "заказчик", "работодател", "менеджер", "поставщик", "инстанц", "официальн",
+                        "компани", "банк", "администрац", "служб", "организац", "hr", "бухгалтер")),
+    ("style_personal", ("друг", "друз", "подруг", "приятел", "мам", "пап", "брат", "сестр", "родител",
+                        "бабушк", "дедушк", "муж", "жен", "парн", "девушк", "близк", "сосед", "любим")),
+    ("style_simplified", ("ребен", "ребён", "дет", "пожил", "иностран", "новичк", r"простым\s+языком",
+                          "неспециалист")),
+)
+_ADDRESSEE_PATTERNS = tuple(
+    (style, re.compile(r'\b(?:' + '|'.join(stems) + r')\w*', re.IGNORECASE))
+    for style, stems in _ADDRESSEE_KEYWORDS
+)
+
+
+def classify_addressee(addressee_description: str):
+    """
+    Дешевая локальная эвристика: относит описание адресата к одному из четырех стилей.
+    Возвращает ключ стиля или None, если совпадений нет или они указывают на разные стили.
+    """
+    matched = []
+    remaining = addressee_description
+    for style, pattern in _ADDRESSEE_PATTERNS:
+        remaining, found = pattern.subn(' ', remaining)
+        if found:
+            matched.append(style)
+    if len(matched) == 1:
+        return matched[0]
+    return None
+
+
+def select_auto_template(addressee_description: str) -> PromptTemplate:
+    """
+    Выбирает шаблон для автоподбора стиля: компактный (только инструкции одного стиля),
+    если адресат классифицирован уверенно, иначе полный с инструкциями всех стилей.
+    """
+    if AUTO_STYLE_COMPACT:
+        style = classify_addressee(addressee_description)
+        if style is not None:
+            return COMPACT_AUTO_TEMPLATES[style]
+    return AUTO_STYLE_TEMPLATE
@@ -0,0 +1,202 @@
+# resilience.py
+"""
+Устойчивость обращений к внешнему сервису (Gemini API):
+ограниченные повторы с экспоненциальной задержкой и decorrelated jitter,
+учет заголовка Retry-After, дедлайн на каждую попытку и на весь вызов,
+а также circuit breaker, который при неполадках у сервиса сразу отказывает,
+вместо того чтобы каждый пользователь ждал полный таймаут.
+
+Модуль не знает о Gemini: повторяемость ошибки определяется атрибутами
+исключения retryable и retry_after, а service_failure=False помечает временную ошибку,
+которая не говорит о сбое сервиса (например, локальный пул ключей исчерпан) и не
+учитывается circuit breaker'ом.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Сколько раз повторять запрос после первой неудачной попытки
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", 2))
+# Базовая и максимальная задержка между попытками (секунды)
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get("GEMINI_RETRY_BASE_DELAY", 0.5))
+GEMINI_RETRY_MAX_DELAY = float(os.environ.get("GEMINI_RETRY_MAX_DELAY", 8))
+# Таймаут одной попытки и общий дедлайн вызова со всеми повторами (секунды)
+GEMINI_ATTEMPT_TIMEOUT = float(os.environ.get("GEMINI_ATTEMPT_TIMEOUT", 15))
+GEMINI_TOTAL_DEADLINE = float(os.environ.get("GEMINI_TOTAL_DEADLINE", 30))
+# Circuit breaker: сколько неудач подряд размыкают цепь и через сколько секунд пробовать снова
+GEMINI_BREAKER_THRESHOLD = int(os.environ.get("GEMINI_BREAKER_THRESHOLD", 5))
+GEMINI_BREAKER_RESET_TIMEOUT = float(os.environ.get("GEMINI_BREAKER_RESET_TIMEOUT", 30))
+
+
+class CircuitOpenError(Exception):
+    """Цепь разомкнута: сервис считается недоступным, запрос не выполняется."""
+
+
+class CircuitBreaker:
+    """
+    Классический circuit breaker с состояниями closed / open / half_open.
+    В half_open пропускается один пробный запрос: успех замыкает цепь, неудача снова размыкает.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self.times_opened = 0
+        self.rejected = 0
+
+    def is_open(self) -> bool:
+        """Цепь разомкнута и время до пробного запроса еще не вышло (состояние не меняется)."""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.trial_started_at = None
+            logger.info("Circuit breaker '%s': пробуем снова (half-open).", self.name)
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            # Пробный запрос мог быть отменен, не сообщив результат: через reset_timeout пускаем новый
+            if self.trial_started_at is None or now - self.trial_started_at >= self.reset_timeout:
+                self.trial_started_at = now
+                return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker '%s': сервис снова доступен, цепь замкнута.", self.name)
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trial_started_at = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.trial_started_at = None
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                logger.warning(
+                    "Circuit breaker '%s': цепь разомкнута после %d неудач подряд.", self.name, self.consecutive_failures
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {
+            'state': self.state,
+            'open': self.state == self.OPEN,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
+
+
+class RetryPolicy:
+    """Параметры повторов: число попыток, задержки и дедлайны."""
+
+    def __init__(self, max_retries: int, base_delay: float, max_delay: float,
+                 attempt_timeout: float, total_deadline: float):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.total_deadline = total_deadline
+
+    def start(self) -> 'RetryState':
+        return RetryState(self)
+
+
+class RetryState:
+    """Состояние повторов одного вызова: сколько попыток сделано и сколько времени осталось."""
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.retries = 0
+        self.deadline = time.monotonic() + policy.total_deadline
+        self._last_delay = policy.base_delay
+
+    def attempt_timeout(self) -> float:
+        """Таймаут очередной попытки: не больше attempt_timeout и не дольше общего дедлайна."""
+        return max(0.1, min(self.policy.attempt_timeout, self.deadline - time.monotonic()))
+
+    def next_delay(self, retry_after: float = None):
+        """
+        Возвращает задержку перед следующей попыткой или None, если повторять больше нельзя.
+        Задержка — decorrelated jitter (AWS Architecture Blog), но не меньше Retry-After.
+        """
+        if self.retries >= self.policy.max_retries:
+            return None
+        delay = min(self.policy.max_delay, random.uniform(self.policy.base_delay, self._last_delay * 3))
+        self._last_delay = delay
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        # Если после ожидания на попытку не останется времени, не ждем зря
+        if time.monotonic() + delay + 0.5 >= self.deadline:
+            return None
+        self.retries += 1
+        return delay
+
+
+async def call_with_retries(call, breaker: CircuitBreaker, policy: RetryPolicy):
+    """
+    Выполняет call(timeout) с повторами и через circuit breaker.
+    call получает таймаут текущей попытки. Повторяются исключения с атрибутом retryable=True;
+    атрибут retry_after (секунды) задает минимальную паузу перед повтором. Исключение
+    с retryable=False — отказ сервиса по существу (сервис работает), а исключение без
+    атрибута retryable (например, непредвиденный ответ) считается сбоем.
+    Если цепь разомкнута, сразу выбрасывается CircuitOpenError.
+    """
+    state = policy.start()
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        try:
+            result = await call(state.attempt_timeout())
+        except Exception as e:
+            if not getattr(e, 'retryable', False):
+                if hasattr(e, 'retryable'):
+                    # Ошибка запроса (блокировка, неверные данные), а не сбой сервиса
+                    breaker.record_success()
+                else:
+                    # Непредвиденная ошибка не подтверждает, что сервис работает
+                    breaker.record_failure()
+                raise
+            if getattr(e, 'service_failure', True):
+                breaker.record_failure()
+            delay = state.next_delay(getattr(e, 'retry_after', None))
+            if delay is None:
+                # Отдельные попытки пишутся в лог на уровне debug/warning, ошибкой — только отказ
+                logger.error("Запрос к '%s' не выполнен (повторов: %d): %s", breaker.name, state.retries, e)
+                raise
+            logger.warning("Повтор запроса к '%s' через %.2f с после ошибки: %s", breaker.name, delay, e)
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+# Общие объекты для Gemini API
+gemini_breaker = CircuitBreaker('gemini', GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_RESET_TIMEOUT)
+gemini_retry_policy = RetryPolicy(
+    GEMINI_MAX_RETRIES, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY,
+    GEMINI_ATTEMPT_TIMEOUT, GEMINI_TOTAL_DEADLINE
+)
+metrics.register_stats('gemini_breaker', gemini_breaker.snapshot)
@@ -0,0 +1,239 @@
+# response_cache.py
+"""
+Кэш ответов Gemini API.
+Ключ — хэш нормализованного промпта и имени модели, поэтому одинаковые
+запросы (одни и те же приветствия, извинения, шаблоны) не уходят в API повторно.
+Первый уровень — LRU в памяти с TTL и ограничением по размеру,
+второй (необязательный) — SQLite-файл, который переживает перезапуск бота.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки кэша (переменные окружения) ---
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+# Время жизни записи в секундах
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 24 * 3600))
+# Ограничения для уровня в памяти: число записей и суммарный размер ответов в байтах
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+# Путь к SQLite-файлу для дискового уровня. Если не задан, используется только память.
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB")
+# Максимальное число записей в дисковом уровне
+RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_DB_MAX_ENTRIES", 50000))
+
+_SPACES_RE = re.compile(r'[ \t\u00a0]+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Приводит промпт к каноническому виду: Unicode NFC, схлопнутые пробелы,
+    без пробелов по краям строк. Переносы строк сохраняются — они важны для абзацев.
+    """
+    prompt = unicodedata.normalize('NFC', prompt)
+    lines = [_SPACES_RE.sub(' ', line).strip() for line in prompt.splitlines()]
+    return '\n'.join(lines).strip()
+
+
+def make_cache_key(prompt: str, model: str, template_id: str = None) -> str:
+    """
+    Возвращает ключ кэша: SHA-256 от имени модели, шаблона промпта (prompts.PromptTemplate.id,
+    если промпт собран из шаблона) и нормализованного промпта. Поэтому новая версия шаблона
+    (в том числе смена PROMPT_VERSION) не получает ответы, сохраненные для старой.
+    """
+    header = f"{model}\n{template_id}" if template_id else model
+    data = f"{header}\n{normalize_prompt(prompt)}".encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class MemoryLRUCache:
+    """LRU-кэш в памяти с TTL и ограничением по числу записей и суммарному размеру."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at, size = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, time.monotonic() + self.ttl, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+
+class SQLiteCache:
+    """Дисковый уровень кэша в SQLite. Записи старше TTL считаются отсутствующими."""
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_created ON response_cache(created_at)")
+        self._conn.commit()
+        self._writes = 0
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM response_cache WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            self._writes += 1
+            # Чистим устаревшие и лишние записи не на каждой записи, а периодически
+            if self._writes % 100 == 0:
+                self._purge_locked()
+            self._conn.commit()
+
+    def _purge_locked(self):
+        self._conn.execute("DELETE FROM response_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов: сначала память, затем (если настроен) SQLite.
+    Попадание в дисковый уровень поднимает запись в память.
+    """
+
+    def __init__(self, memory: MemoryLRUCache, disk: SQLiteCache = None):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка чтения дискового кэша ответов: {e}")
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи в дисковый кэш ответов: {e}")
+
+    async def aget(self, key: str):
+        """Асинхронное чтение: обращение к SQLite выполняется в отдельном потоке."""
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        if self.disk is None:
+            self.misses += 1
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: str):
+        """Асинхронная запись: обращение к SQLite выполняется в отдельном потоке."""
+        if self.disk is None:
+            self.memory.set(key, value)
+        else:
+            await asyncio.to_thread(self.set, key, value)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory.size_bytes,
+        }
+
+
+def _create_response_cache():
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    disk = None
+    if RESPONSE_CACHE_DB:
+        try:
+            disk = SQLiteCache(RESPONSE_CACHE_DB, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB_MAX_ENTRIES)
+            logger.info(f"Дисковый кэш ответов Gemini подключен: {RESPONSE_CACHE_DB}")
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось открыть дисковый кэш ответов ({RESPONSE_CACHE_DB}): {e}. Используется только память.")
+    memory = MemoryLRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+    return ResponseCache(memory, disk)
+
+
+# Общий кэш ответов. None, если кэширование отключено.
+response_cache = _create_response_cache()
@@ -0,0 +1,165 @@
+# retention.py
+"""
+Ограничение памяти, которую занимает состояние диалогов (context.user_data).
+
+- у каждого пользователя есть предельный размер данных: при превышении сначала
+  выбрасываются необязательные ключи, а слишком длинный текст не принимается;
+- диалоги без активности дольше RETENTION_IDLE_TIMEOUT удаляются периодической задачей JobQueue;
+- в памяти держится не больше RETENTION_MAX_RESIDENT_USERS пользователей, самые давние вытесняются.
+"""
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Предельный размер user_data одного пользователя в байтах (оценка)
+RETENTION_MAX_USER_BYTES = int(os.environ.get("RETENTION_MAX_USER_BYTES", 64 * 1024))
+# Через сколько секунд без активности диалог считается брошенным и удаляется
+RETENTION_IDLE_TIMEOUT = float(os.environ.get("RETENTION_IDLE_TIMEOUT", 6 * 3600))
+# Сколько пользователей максимум держать в памяти
+RETENTION_MAX_RESIDENT_USERS = int(os.environ.get("RETENTION_MAX_RESIDENT_USERS", 5000))
+# Как часто запускать очистку (секунды)
+RETENTION_SWEEP_INTERVAL = float(os.environ.get("RETENTION_SWEEP_INTERVAL", 60))
+
+# Ключи user_data, которые можно выбросить без потери диалога, в порядке удаления
+DISPOSABLE_KEYS = []
+
+# user_id -> время последней активности; порядок — от самого давнего к самому свежему
+_last_seen = OrderedDict()
+
+
+class RetentionStats:
+    """Счетчики и показатели подсистемы удержания состояния."""
+    def __init__(self):
+        self.resident_users = 0
+        self.resident_bytes = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self.oversize_trimmed = 0
+        self.oversize_rejected = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+stats = RetentionStats()
+
+
+def get_stats() -> dict:
+    """Возвращает показатели удержания: число пользователей и байт в памяти, счетчики вытеснений."""
+    return stats.snapshot()
+
+
+metrics.register_stats('retention', get_stats)
+
+
+def estimate_size(obj) -> int:
+    """Грубая рекурсивная оценка размера объекта в байтах (строки, байты, словари, списки)."""
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_size(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def fits_user_cap(text: str) -> bool:
+    """Проверяет, что текст пользователя сам по себе не превышает предельный размер состояния."""
+    # Ответ модели сопоставим по размеру с исходным текстом, поэтому оставляем место под него
+    return estimate_size(text) * 2 <= RETENTION_MAX_USER_BYTES
+
+
+def enforce_user_cap(user_data: dict) -> bool:
+    """
+    Приводит user_data к предельному размеру, выбрасывая необязательные ключи из DISPOSABLE_KEYS.
+    Возвращает False, если даже после этого размер превышен.
+    """
+    if estimate_size(user_data) <= RETENTION_MAX_USER_BYTES:
+        return True
+    for key in DISPOSABLE_KEYS:
+        if user_data.pop(key, None) is not None:
+            stats.oversize_trimmed += 1
+            if estimate_size(user_data) <= RETENTION_MAX_USER_BYTES:
+                return True
+    return estimate_size(user_data) <= RETENTION_MAX_USER_BYTES
+
+
+def touch(user_id: int):
+    """Отмечает активность пользователя."""
+    _last_seen[user_id] = time.monotonic()
+    _last_seen.move_to_end(user_id)
+
+
+async def _touch_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user:
+        touch(update.effective_user.id)
+
+
+async def _evict(application: Application, user_id: int, idle: bool):
+    """
+    Убирает данные пользователя из памяти.
+    Брошенный диалог удаляется полностью, в том числе из хранилища.
+    При вытеснении по LRU, если хранилище умеет лениво загружать данные (SQLite),
+    они сначала сохраняются и будут прочитаны заново при следующем обращении.
+    """
+    persistence = application.persistence
+    user_data = application.user_data.get(user_id)
+    if not idle and persistence is not None and hasattr(persistence, 'forget_user'):
+        if user_data:
+            await persistence.update_user_data(user_id, dict(user_data))
+            user_data.clear()
+        persistence.forget_user(user_id)
+    else:
+        application.drop_user_data(user_id)
+    _last_seen.pop(user_id, None)
+
+
+async def sweep(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая задача JobQueue: удаляет брошенные диалоги и ограничивает число пользователей в памяти."""
+    application = context.application
+    now = time.monotonic()
+
+    # Пользователи, загруженные из хранилища при запуске, считаются активными с момента запуска
+    for user_id in application.user_data:
+        if user_id not in _last_seen:
+            _last_seen[user_id] = now
+            _last_seen.move_to_end(user_id, last=False)
+
+    idle_threshold = now - RETENTION_IDLE_TIMEOUT
+    while _last_seen:
+        user_id, last_seen = next(iter(_last_seen.items()))
+        if last_seen >= idle_threshold:
+            break
+        await _evict(application, user_id, idle=True)
+        stats.evicted_idle += 1
+
+    resident = [uid for uid in _last_seen if application.user_data.get(uid)]
+    overflow = len(resident) - RETENTION_MAX_RESIDENT_USERS
+    for user_id in resident[:max(overflow, 0)]:
+        await _evict(application, user_id, idle=False)
+        stats.evicted_lru += 1
+
+    resident_data = [data for data in application.user_data.values() if data]
+    stats.resident_users = len(resident_data)
+    stats.resident_bytes = sum(estimate_size(data) for data in resident_data)
+    logger.debug(
+        "Удержание состояния: в памяти %d пользователей (~%d байт), удалено брошенных %d, вытеснено %d",
+        stats.resident_users, stats.resident_bytes, stats.evicted_idle, stats.evicted_lru
+    )
+
+
+def setup(application: Application):
+    """Подключает учет активности и периодическую очистку к приложению."""
+    application.add_handler(TypeHandler(Update, _touch_handler), group=-1)
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]): очистка состояния отключена.")
+        return
+    application.job_queue.run_repeating(sweep, interval=RETENTION_SWEEP_INTERVAL, first=RETENTION_SWEEP_INTERVAL)
@@ -0,0 +1,217 @@
+# scheduler.py
+"""
+Планировщик запросов к Gemini API.
+
+- глобальный лимит одновременных запросов (семафор на GEMINI_MAX_CONCURRENCY);
+- token bucket по запросам и по токенам в минуту под квоту Gemini (GEMINI_RPM / GEMINI_TPM);
+- честная очередь: свободный слот по кругу достается следующему чату, поэтому
+  один пользователь, часто нажимающий кнопки, не отодвигает остальных;
+- одинаковые запросы одного чата, уже находящиеся в работе, объединяются,
+  а более новый запрос чата отменяет его еще не начатые старые запросы.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Сколько запросов к Gemini может выполняться одновременно
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+# Квота запросов и токенов в минуту (0 — без ограничения)
+GEMINI_RPM = float(os.environ.get("GEMINI_RPM", 0))
+GEMINI_TPM = float(os.environ.get("GEMINI_TPM", 0))
+
+
+class Superseded(Exception):
+    """Запрос отменен до начала выполнения, потому что тот же чат отправил более новый."""
+
+
+class TokenBucket:
+    """Token bucket: не более rate_per_minute единиц в минуту с запасом capacity."""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        # Запрос больше емкости ведра никогда бы не прошел — ограничиваем его емкостью
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class _Ticket:
+    """Заявка на слот в очереди одного чата."""
+    __slots__ = ('chat_id', 'key', 'tokens', 'granted', 'enqueued_at')
+
+    def __init__(self, chat_id, key, tokens: int):
+        self.chat_id = chat_id
+        self.key = key
+        self.tokens = tokens
+        self.granted = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class GeminiScheduler:
+    """Очередь запросов к Gemini с ограничением параллелизма, квотой и круговой справедливостью по чатам."""
+
+    def __init__(self, max_concurrency: int, rpm: float = 0, tpm: float = 0):
+        self.max_concurrency = max_concurrency
+        self._request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self._token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self._queues = {}        # chat_id -> deque[_Ticket]
+        self._ring = deque()     # чаты с ожидающими заявками, по кругу
+        self._running = 0
+        self._inflight = {}      # (chat_id, key) -> asyncio.Future с результатом
+        # Статистика
+        self.submitted = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.granted_total = 0
+
+    # --- Очередь ---
+
+    def _enqueue(self, chat_id, key, tokens: int, supersede: bool) -> _Ticket:
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._ring.append(chat_id)
+        if supersede:
+            for old in queue:
+                if old.key != key and not old.granted.done():
+                    old.granted.set_exception(Superseded())
+                    self.superseded += 1
+        ticket = _Ticket(chat_id, key, tokens)
+        queue.append(ticket)
+        self.submitted += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        """Раздает свободные слоты заявкам, перебирая чаты по кругу."""
+        while self._running < self.max_concurrency and self._ring:
+            chat_id = self._ring.popleft()
+            queue = self._queues[chat_id]
+            ticket = queue.popleft()
+            if queue:
+                self._ring.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            if ticket.granted.done():
+                # Заявка уже отменена или вытеснена более новой
+                continue
+            self._running += 1
+            asyncio.ensure_future(self._grant(ticket))
+
+    async def _grant(self, ticket: _Ticket):
+        """Дожидается квоты и выдает слот заявке."""
+        try:
+            if self._request_bucket is not None:
+                await self._request_bucket.acquire(1)
+            if self._token_bucket is not None:
+                await self._token_bucket.acquire(ticket.tokens)
+        except Exception:
+            logger.exception("Ошибка ожидания квоты в планировщике Gemini")
+        if ticket.granted.done():
+            self._release()
+            return
+        waited = time.monotonic() - ticket.enqueued_at
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.granted_total += 1
+        metrics.stage_seconds.observe(waited, 'queue_wait')
+        ticket.granted.set_result(None)
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    # --- Публичный интерфейс ---
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id, key=None, tokens: int = 0, supersede: bool = True):
+        """
+        Асинхронный контекстный менеджер: ждет своей очереди и квоты, удерживает слот до выхода.
+        Если чат отправит более новый запрос раньше, чем этот начнется, выбрасывает Superseded.
+        """
+        ticket = self._enqueue(chat_id, key, tokens, supersede)
+        try:
+            await ticket.granted
+        except BaseException:
+            if ticket.granted.done() and not ticket.granted.cancelled() and ticket.granted.exception() is None:
+                # Слот уже выдан, но ожидающий ушел — возвращаем его
+                self._release()
+            elif not ticket.granted.done():
+                ticket.granted.cancel()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def submit(self, chat_id, key, tokens: int, call, supersede: bool = True):
+        """
+        Выполняет call() в порядке очереди. Если такой же запрос (key) этого чата уже
+        выполняется, ждет его результата вместо повторного обращения к API.
+        supersede=False — не вытеснять ожидающие запросы чата (см. slot).
+        """
+        inflight_key = (chat_id, key)
+        pending = self._inflight.get(inflight_key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        result = asyncio.get_running_loop().create_future()
+        self._inflight[inflight_key] = result
+        try:
+            async with self.slot(chat_id, key, tokens, supersede):
+                value = await call()
+            result.set_result(value)
+            return value
+        except BaseException as e:
+            if not result.done():
+                # Отмена исходного запроса для присоединившихся к нему выглядит как вытеснение
+                result.set_exception(Superseded() if isinstance(e, asyncio.CancelledError) else e)
+                # Исключение уже передано вызывающему; не даем asyncio ругаться на «неполученное» исключение
+                result.exception()
+            raise
+        finally:
+            self._inflight.pop(inflight_key, None)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': sum(len(queue) for queue in self._queues.values()),
+            'queued_chats': len(self._queues),
+            'running': self._running,
+            'max_concurrency': self.max_concurrency,
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'superseded': self.superseded,
+            'avg_wait_ms': 1000 * self.wait_time_total / self.granted_total if self.granted_total else 0.0,
+            'max_wait_ms': 1000 * self.wait_time_max,
+        }
+
+
+# Общий планировщик запросов к Gemini
+gemini_scheduler = GeminiScheduler(GEMINI_MAX_CONCURRENCY, GEMINI_RPM, GEMINI_TPM)
+metrics.register_stats('scheduler', gemini_scheduler.stats)
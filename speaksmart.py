@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import os
+import time
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -15,25 +17,65 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
-    CallbackQueryHandler,
-    PicklePersistence
+    CallbackQueryHandler
 )
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
+import bulk
+import chunking
+import fuzzy_cache
 import gemini_api
-from health_checker import start_health_check_server_in_thread
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import loop_watchdog
+import metrics
+import prefetch
+import profiling
+import prompts
+import retention
+import startup
+import telegram_outbound
+import tracing
+from update_processor import PerChatUpdateProcessor
+from response_cache import make_cache_key
+from scheduler import Superseded
+from health_checker import HEALTH_CHECK_PORT, start_health_check_server_in_thread
+
+# Настройка логирования: запись в отдельном потоке, trace id в каждой строке (см. tracing)
+tracing.setup_logging()
 logger = logging.getLogger(__name__)
 
-# Получаем API ключи из переменных окружения
+# Получаем токен бота из переменных окружения (ключи и модели Gemini читает backend_pool)
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+# Сколько обновлений бот обрабатывает одновременно (запросы к Gemini разных пользователей перекрываются;
+# обновления одного чата все равно обрабатываются по очереди, см. update_processor)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+# Режим получения обновлений: "polling" (long polling) или "webhook"
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+# Публичный базовый адрес бота для webhook (например, https://speaksmart.onrender.com)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+# Путь, на который Telegram присылает обновления, и секрет для проверки их подлинности
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Хранилище состояния диалогов: "pickle" (один файл) или "sqlite" (построчно, с ленивой загрузкой)
+PERSISTENCE_BACKEND = os.environ.get("PERSISTENCE_BACKEND", "pickle")
+PERSISTENCE_PATH = os.environ.get("PERSISTENCE_PATH", "bot_persistence")
+# Через сколько секунд без активности состояние пользователя в SQLite считается устаревшим (0 — никогда)
+PERSISTENCE_TTL = float(os.environ.get("PERSISTENCE_TTL", 30 * 24 * 3600))
+# Число процессов-обработчиков: больше 1 — обновления распределяются по процессам по chat id (см. workers)
+WORKERS = int(os.environ.get("WORKERS", 1))
+# Потоковый режим: текст ответа появляется в сообщении по мере генерации
+STREAMING_RESPONSES = os.environ.get("STREAMING_RESPONSES", "1") == "1"
+# Минимальный интервал между правками одного чата при потоковом выводе (секунды)
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+# Сколько вариантов просить у модели за один вызов для «Сгенерировать заново» (1 — по одному, с потоковым выводом)
+REGENERATE_CANDIDATES = int(os.environ.get("REGENERATE_CANDIDATES", 3))
+
+# Запасные варианты для «Сгенерировать заново»: {'prompt': ключ промпта, 'texts': [...]}.
+# Их можно выбросить при нехватке памяти — тогда будет сделан новый запрос
+REGENERATE_CANDIDATES_KEY = 'regenerate_candidates'
+retention.DISPOSABLE_KEYS.append(REGENERATE_CANDIDATES_KEY)
 
 # --- КОНСТАНТЫ ДЛЯ СОСТОЯНИЙ ДИАЛОГА ---
 GET_TEXT_FOR_CORRECTION, CHOOSE_STYLE, DESCRIBE_ADDRESSEE, POST_PROCESSING_MENU = range(4)
@@ -44,14 +86,6 @@ main_menu_layout = [
 ]
 main_menu_keyboard = ReplyKeyboardMarkup(main_menu_layout, resize_keyboard=True, one_time_keyboard=False)
 
-# --- Главная, универсальная инструкция ---
-TUNE_INSTRUCTION = """Твоя главная задача — действовать как деликатный корректор, а не как рерайтер.
-1.  **ОБЯЗАТЕЛЬНО СОХРАНЯЙ ПРИВЕТСТВИЯ:** Никогда не удаляй и не изменяй слова приветствия, такие как "привет", "здравствуйте", "добрый день" и т.п., если они есть в начале текста.
-2.  **МИНИМАЛЬНЫЕ ИЗМЕНЕНИЯ:** Не переписывай предложения полностью. Твоя цель — лишь слегка "причесать" текст. Вноси только самые необходимые, точечные изменения: можешь заменить разговорное слово на более формальное или поменять порядок слов для улучшения структуры.
-3.  **СОХРАНЯЙ СУТЬ И ЛЕКСИКУ:** Сохраняй максимум оригинальных слов и конструкций автора. Идея и суть текста должны остаться абсолютно неизменными.
-4.  **СОХРАНЯЙ ФОРМАТИРОВАНИЕ:** Сохраняй исходное деление на абзацы и переносы строк. Не объединяй несколько абзацев в один."""
-
-
 # --- Функции бота ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -76,8 +110,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 
 async def start_new_dialogue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    prefetch.cancel(update.effective_user.id)
     context.user_data.clear()
-    logger.info(f"Пользователь {update.effective_user.id} начал новый диалог. user_data очищены.")
+    logger.info("Пользователь %s начал новый диалог. user_data очищены.", update.effective_user.id)
 
     await update.message.reply_text(
         "Отлично! Теперь, пожалуйста, отправь мне текст, который нужно переформулировать."
@@ -87,11 +122,18 @@ async def start_new_dialogue(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def received_text_for_correction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_message = update.message.text
-    logger.info(f"Получен текст для исправления от chat_id {update.effective_chat.id}: '{user_message}'")
+    # Сам текст в лог не пишем: на длинных текстах это заметная нагрузка, да и хранить его в логах незачем
+    logger.info("Получен текст для исправления от chat_id %s (%d символов)", update.effective_chat.id, len(user_message))
+    if not retention.fits_user_cap(user_message):
+        await update.message.reply_text("Этот текст слишком длинный для обработки. Пожалуйста, сократи его и отправь снова.")
+        retention.stats.oversize_rejected += 1
+        return GET_TEXT_FOR_CORRECTION
+    prefetch.cancel(update.effective_user.id, context.user_data)
     context.user_data['text_to_correct'] = user_message
     context.user_data.pop('chosen_style', None)
     context.user_data.pop('addressee_description', None)
     context.user_data.pop('last_gemini_response', None)
+    context.user_data.pop(REGENERATE_CANDIDATES_KEY, None)
 
     keyboard = [
         [InlineKeyboardButton("Деловой стиль 📑", callback_data="style_business")],
@@ -109,19 +151,60 @@ async def received_text_for_correction(update: Update, context: ContextTypes.DEF
     return CHOOSE_STYLE
 
 
-# --- ИЗМЕНЕНИЕ: Возвращен «слабый» моноширный стиль ---
-async def _send_post_processing_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE, response_text: str, message_prefix: str):
-    context.user_data['last_gemini_response'] = response_text
-
+class _ChatEditRateLimiter:
+    """
+    Ограничивает частоту правок сообщений в одном чате, чтобы при потоковом выводе
+    не упираться в лимиты Telegram на редактирование.
+    """
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._last_edit = {}
+
+    def try_acquire(self, chat_id: int) -> bool:
+        """Возвращает True и отмечает правку, если с предыдущей прошло достаточно времени."""
+        now = time.monotonic()
+        last_edit = self._last_edit.get(chat_id)
+        if last_edit is not None and now - last_edit < self.min_interval:
+            return False
+        self._mark(chat_id, now)
+        return True
+
+    async def wait(self, chat_id: int):
+        """Дожидается момента, когда правка в чате снова разрешена, и отмечает ее."""
+        last_edit = self._last_edit.get(chat_id)
+        if last_edit is not None:
+            delay = last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._mark(chat_id, time.monotonic())
+
+    def _mark(self, chat_id: int, now: float):
+        self._last_edit[chat_id] = now
+        # Не даем словарю расти бесконечно: давно не редактировавшиеся чаты не нужны
+        if len(self._last_edit) > 10000:
+            threshold = now - self.min_interval
+            self._last_edit = {cid: t for cid, t in self._last_edit.items() if t >= threshold}
+
+
+_edit_rate_limiter = _ChatEditRateLimiter(STREAM_EDIT_INTERVAL)
+
+
+def _format_response_text(response_text: str) -> str:
     # Эта строка убирает все переносы строк для корректной работы ` `
     processed_response_text = response_text.strip().replace('\n', ' ')
     escaped_response_text = escape_markdown(processed_response_text, version=2)
-    
+
     # Используем одинарные кавычки для "слабого" моноширного стиля
-    formatted_response_text = f"`{escaped_response_text}`"
-    
-    escaped_message_prefix = escape_markdown(message_prefix, version=2)
+    return f"`{escaped_response_text}`"
+
+
+def _format_response_block(response_text: str) -> str:
+    # Для длинных текстов нужен блок ``` ```: в отличие от ` `, он сохраняет переносы строк и абзацы
+    escaped_response_text = escape_markdown(response_text.strip(), version=2, entity_type='pre')
+    return f"```\n{escaped_response_text}\n```"
 
+
+def _post_processing_keyboard() -> InlineKeyboardMarkup:
     post_process_keyboard_inline = [
         [
             InlineKeyboardButton("Мягче", callback_data="adjust_softer"),
@@ -132,14 +215,38 @@ async def _send_post_processing_menu(update_or_query, context: ContextTypes.DEFA
             InlineKeyboardButton("Сгенерировать заново", callback_data="regenerate_text"),
         ]
     ]
-    reply_markup_inline = InlineKeyboardMarkup(post_process_keyboard_inline)
+    return InlineKeyboardMarkup(post_process_keyboard_inline)
+
+
+# --- ИЗМЕНЕНИЕ: Возвращен «слабый» моноширный стиль ---
+async def _send_post_processing_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE, response_text: str, message_prefix: str, target_message=None, send_new: bool = False):
+    """
+    Показывает ответ с меню доработки: правит target_message (по умолчанию — сообщение с нажатой
+    кнопкой) или, если send_new, присылает новое сообщение, не трогая уже показанные.
+    """
+    context.user_data['last_gemini_response'] = response_text
+    retention.enforce_user_cap(context.user_data)
+
+    formatted_response_text = _format_response_text(response_text)
+    
+    escaped_message_prefix = escape_markdown(message_prefix, version=2)
+
+    reply_markup_inline = _post_processing_keyboard()
 
     message_to_send = f"{escaped_message_prefix}\n\n{formatted_response_text}\n\nКак тебе результат? Можем доработать:"
 
+    # У CallbackQuery нет effective_chat: чат берем из сообщения с кнопкой
+    if isinstance(update_or_query, CallbackQuery):
+        chat_id = update_or_query.message.chat_id
+    else:
+        chat_id = update_or_query.effective_chat.id
+
     try:
         target_message_for_edit = None
-        if isinstance(update_or_query, CallbackQuery):
-            target_message_for_edit = update_or_query.message
+        if not send_new:
+            target_message_for_edit = target_message
+            if target_message_for_edit is None and isinstance(update_or_query, CallbackQuery):
+                target_message_for_edit = update_or_query.message
 
         if target_message_for_edit:
             await context.bot.edit_message_text(
@@ -147,29 +254,192 @@ async def _send_post_processing_menu(update_or_query, context: ContextTypes.DEFA
                 chat_id=target_message_for_edit.chat_id,
                 message_id=target_message_for_edit.message_id,
                 reply_markup=reply_markup_inline,
-                parse_mode=ParseMode.MARKDOWN_V2
+                parse_mode=ParseMode.MARKDOWN_V2,
+                rate_limit_args=telegram_outbound.PRIORITY_RESULT
             )
         else:
             await context.bot.send_message(
-                chat_id=update_or_query.effective_chat.id,
+                chat_id=chat_id,
                 text=message_to_send,
                 reply_markup=reply_markup_inline,
-                parse_mode=ParseMode.MARKDOWN_V2
+                parse_mode=ParseMode.MARKDOWN_V2,
+                rate_limit_args=telegram_outbound.PRIORITY_RESULT
             )
     except Exception as e:
-        logger.error(f"Ошибка при отправке/редактировании сообщения в _send_post_processing_menu: {e}", exc_info=True)
-        chat_id_to_notify = update_or_query.effective_chat.id
-        if chat_id_to_notify:
-            await context.bot.send_message(chat_id=chat_id_to_notify, text="Произошла ошибка при отображении меню доработки.")
+        logger.error("Ошибка при отправке/редактировании сообщения в _send_post_processing_menu: %s", e, exc_info=True)
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="Произошла ошибка при отображении меню доработки.")
+
+
+async def _generate_and_show(update_or_query, context: ContextTypes.DEFAULT_TYPE, prompt_for_gemini: str, message_prefix: str, use_cache: bool = True, status_message=None, template_id: str = None):
+    """
+    Запрашивает переформулировку у Gemini и показывает результат с меню доработки.
+    template_id — шаблон, из которого собран промпт (входит в ключ кэша ответов).
+    В потоковом режиме частичный текст появляется в сообщении по мере генерации
+    (не чаще STREAM_EDIT_INTERVAL), а клавиатура прикрепляется к окончательному варианту.
+    Возвращает текст ответа модели или None, если вместо него показано сообщение об ошибке.
+    """
+    target_message = status_message
+    if target_message is None and isinstance(update_or_query, CallbackQuery):
+        target_message = update_or_query.message
+
+    chat_id = target_message.chat_id if target_message is not None else update_or_query.effective_chat.id
+
+    try:
+        if not STREAMING_RESPONSES or target_message is None:
+            response_text = await gemini_api.generate_async(
+                prompt_for_gemini, use_cache=use_cache, chat_id=chat_id, template_id=template_id
+            )
+            await _send_post_processing_menu(update_or_query, context, response_text, message_prefix, target_message)
+            return response_text
+
+        escaped_message_prefix = escape_markdown(message_prefix, version=2)
+        partial_edits_enabled = True
+        response_text = ""
+        async for response_text in gemini_api.generate_stream(
+                prompt_for_gemini, use_cache=use_cache, chat_id=chat_id, template_id=template_id):
+            if not partial_edits_enabled or not _edit_rate_limiter.try_acquire(chat_id):
+                continue
+            try:
+                await context.bot.edit_message_text(
+                    text=f"{escaped_message_prefix}\n\n{_format_response_text(response_text)} …",
+                    chat_id=chat_id,
+                    message_id=target_message.message_id,
+                    parse_mode=ParseMode.MARKDOWN_V2,
+                    rate_limit_args=telegram_outbound.PRIORITY_PROGRESS
+                )
+            except RetryAfter as e:
+                # Telegram просит притормозить: промежуточные правки больше не отправляем
+                logger.warning("Telegram ограничил частоту правок в чате %s: %s", chat_id, e)
+                partial_edits_enabled = False
+            except TelegramError as e:
+                logger.debug("Не удалось показать промежуточный результат: %s", e)
+
+        # Окончательную правку не задерживаем: ждущая промежуточная правка будет сброшена,
+        # а лимит чата соблюдает telegram_outbound
+        await _send_post_processing_menu(update_or_query, context, response_text, message_prefix, target_message)
+        return response_text
+    except gemini_api.GeminiError as e:
+        # Сообщение об ошибке показываем на месте ответа, как и раньше
+        await _send_post_processing_menu(update_or_query, context, e.user_message, message_prefix, target_message)
+    except Superseded:
+        # Пользователь уже нажал другую кнопку: результат покажет более новый запрос
+        logger.info("Запрос чата %s к Gemini отменен более новым запросом.", chat_id)
+    return None
+
+
+async def _rewrite_long_and_show(update_or_query, context: ContextTypes.DEFAULT_TYPE, template: prompts.PromptTemplate, fields: dict, source_text: str, message_prefix: str, status_message=None):
+    """
+    Переформулирует длинный текст по частям (см. chunking) и присылает результат несколькими
+    сообщениями по мере готовности, сохраняя абзацы. Меню доработки приходит последним сообщением.
+    Возвращает полный текст ответа или None, если показано сообщение об ошибке.
+    """
+    target_message = status_message
+    if target_message is None and isinstance(update_or_query, CallbackQuery):
+        target_message = update_or_query.message
+
+    chat_id = target_message.chat_id if target_message is not None else update_or_query.effective_chat.id
+
+    pieces = []
+    try:
+        async for index, total, piece in chunking.rewrite_chunks(template, fields, source_text, chat_id=chat_id):
+            if index == 0:
+                header = f"{message_prefix} Текст длинный, присылаю его по частям ({total}):"
+                if target_message is not None:
+                    await context.bot.edit_message_text(text=header, chat_id=chat_id, message_id=target_message.message_id)
+                else:
+                    await context.bot.send_message(chat_id=chat_id, text=header)
+            pieces.append(piece)
+            for part in chunking.split_for_telegram(piece):
+                await _edit_rate_limiter.wait(chat_id)
+                await context.bot.send_message(chat_id=chat_id, text=_format_response_block(part), parse_mode=ParseMode.MARKDOWN_V2)
+    except gemini_api.GeminiError as e:
+        # Уже отправленные заголовок и части остаются в чате, а ошибка с меню доработки приходит
+        # новым сообщением после них; если ничего еще не отправлено, правится сообщение о статусе
+        await _send_post_processing_menu(update_or_query, context, e.user_message, message_prefix, target_message, send_new=bool(pieces))
+        return None
+    except Superseded:
+        logger.info("Запрос чата %s к Gemini отменен более новым запросом.", chat_id)
+        return None
+
+    response_text = "\n\n".join(pieces)
+    context.user_data['last_gemini_response'] = response_text
+    retention.enforce_user_cap(context.user_data)
+    await _edit_rate_limiter.wait(chat_id)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Как тебе результат? Можем доработать:",
+        reply_markup=_post_processing_keyboard()
+    )
+    return response_text
+
+
+async def _rewrite_short_and_show(update_or_query, context: ContextTypes.DEFAULT_TYPE, cache_namespace: str, template: prompts.PromptTemplate, fields: dict, source_text: str, message_prefix: str, status_message=None):
+    """
+    Переформулирует текст в стиле: сначала ищет ответ на почти такой же текст в fuzzy_cache,
+    иначе обращается к Gemini и запоминает ответ. Возвращает текст ответа или None при ошибке.
+    """
+    # Ответы, полученные по другой версии шаблона, не подставляются
+    cache_namespace = f"{template.id}:{cache_namespace}"
+    hit = fuzzy_cache.lookup(cache_namespace, source_text)
+    if hit is not None:
+        fuzzy_cache.mark_served(context.user_data, hit)
+        await _send_post_processing_menu(update_or_query, context, hit.text, message_prefix, status_message)
+        return hit.text
+
+    prompt_for_gemini = template.render(text=source_text, **fields)
+    response_text = await _generate_and_show(
+        update_or_query, context, prompt_for_gemini, message_prefix, status_message=status_message, template_id=template.id
+    )
+    if response_text:
+        fuzzy_cache.remember(cache_namespace, source_text, response_text)
+    return response_text
+
+
+async def _regenerate_with_candidates(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, prompt_for_gemini: str, message_prefix: str, template_id: str = None):
+    """
+    «Сгенерировать заново» через пул вариантов: модель возвращает несколько вариантов одним
+    вызовом, первый показывается сразу, остальные сохраняются в user_data, и следующие нажатия
+    показывают их по очереди без обращения к API. Новый вызов — только когда пул исчерпан.
+    """
+    prompt_key = make_cache_key(prompt_for_gemini, gemini_api.GEMINI_MODEL, template_id)
+    last_response = context.user_data.get('last_gemini_response')
+    pool = context.user_data.get(REGENERATE_CANDIDATES_KEY)
+    if pool and pool.get('prompt') == prompt_key:
+        while pool['texts']:
+            candidate = pool['texts'].pop(0)
+            if candidate != last_response:
+                await _send_post_processing_menu(query, context, candidate, message_prefix)
+                return
+
+    telegram_outbound.edit_status(
+        context.bot, query.message.chat_id, query.message.message_id,
+        "Генерирую новый вариант на основе первоначальных данных... Минуточку."
+    )
+    try:
+        async with telegram_outbound.typing(context.bot, query.message.chat_id):
+            candidates = await gemini_api.generate_candidates_async(
+                prompt_for_gemini, REGENERATE_CANDIDATES, chat_id=query.message.chat_id, template_id=template_id
+            )
+    except gemini_api.GeminiError as e:
+        await _send_post_processing_menu(query, context, e.user_message, message_prefix)
+        return
+    except Superseded:
+        logger.info("Запрос чата %s к Gemini отменен более новым запросом.", query.message.chat_id)
+        return
+    candidates = [text for text in candidates if text != last_response] or candidates
+    context.user_data[REGENERATE_CANDIDATES_KEY] = {'prompt': prompt_key, 'texts': candidates[1:]}
+    await _send_post_processing_menu(query, context, candidates[0], message_prefix)
 
 
 async def style_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    telegram_outbound.answer(context.bot, query)
     style_choice = query.data
     context.user_data['chosen_style'] = style_choice
     context.user_data.pop('addressee_description', None)
-    logger.info(f"Пользователь {query.from_user.id} выбрал стиль: {style_choice}")
+    logger.info("Пользователь %s выбрал стиль: %s", query.from_user.id, style_choice)
+    metrics.styles_total.inc(style_choice)
     text_to_correct = context.user_data.get('text_to_correct')
 
     if not text_to_correct:
@@ -184,46 +454,27 @@ async def style_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         )
         return DESCRIBE_ADDRESSEE
 
-    await query.edit_message_text(text=f"Ты выбрал стиль: {style_choice}. Минуточку, обрабатываю твой текст...")
-
-    style_prompt_instruction = ""
-    if style_choice == "style_business":
-        style_prompt_instruction = """Применяй следующие принципы делового стиля:
-1.  **Обеспечь лаконичность:** Если в предложении есть очевидно лишние слова или повторы, которые можно убрать без потери смысла и изменения структуры — сделай это.
-2.  **Придай официальный тон:** Заменяй разговорную лексику и жаргон на нейтральные или деловые эквиваленты.
-3.  **Сохраняй фокус на цели:** Убедись, что ключевая мысль, просьба или предложение выражены четко и ясно."""
-    elif style_choice == "style_academic":
-        style_prompt_instruction = """Применяй следующие принципы учебного (академического) стиля:
-1.  **Усиль логические связки:** При необходимости замени союзы или добавь вводные слова (например, «следовательно», «однако»), чтобы улучшить логическую последовательность, не меняя порядок предложений.
-2.  **Используй точную терминологию:** Если в тексте есть разговорные аналоги научных или учебных терминов, замени их на корректные термины.
-3.  **Соблюдай нейтральность:** Убирай эмоционально окрашенные слова, заменяя их на нейтральные синонимы."""
-    elif style_choice == "style_personal":
-        style_prompt_instruction = """Применяй следующие принципы для личного общения:
-1.  **Сделай текст более живым:** Если это уместно, замени нейтральное слово на более эмоциональный синоним, не меняя общий смысл и конструкцию предложения.
-2.  **Сохраняй авторский голос:** Не трогай характерные для автора выражения, сленг или личные обороты речи, если они не мешают пониманию.
-3.  **Улучши связность:** Если два коротких предложения можно логично объединить в одно без потери авторского стиля, сделай это."""
-    elif style_choice == "style_simplified":
-        style_prompt_instruction = """Применяй следующие принципы для упрощения текста:
-1.  **Используй простую лексику:** Последовательно заменяй сложные или узкоспециализированные слова на их более простые и общеупотребительные аналоги.
-2.  **Сокращай, но осторожно:** Только если предложение очень длинное и запутанное, ты можешь аккуратно разделить его на два, стараясь сохранить исходные слова и порядок мысли. Не делай этого без крайней необходимости."""
-
-    prompt_for_gemini = (
-        f"Твоя задача: внимательно и аккуратно переформулировать следующий исходный текст. "
-        f"{TUNE_INSTRUCTION} "
-        f"Вот конкретные принципы, которым нужно следовать для выбранного стиля:\n{style_prompt_instruction}\n"
-        f"КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла. "
-        f"Исходный текст для переформулирования: \"{text_to_correct}\"\n\n"
-        f"Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст. "
-        f"НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."
+    telegram_outbound.edit_status(
+        context.bot, query.message.chat_id, query.message.message_id,
+        f"Ты выбрал стиль: {style_choice}. Минуточку, обрабатываю твой текст..."
     )
 
+    style_template = prompts.get_style_template(style_choice)
+
     try:
-        await context.bot.send_chat_action(chat_id=query.message.chat_id, action="typing")
-        response_text = gemini_api.ask_gemini(prompt_for_gemini, GEMINI_API_KEY)
-        await _send_post_processing_menu(query, context, response_text, "Вот переформулированный текст:")
+        async with telegram_outbound.typing(context.bot, query.message.chat_id):
+            if chunking.needs_chunking(text_to_correct):
+                response_text = await _rewrite_long_and_show(query, context, style_template, {}, text_to_correct, "Вот переформулированный текст:")
+            else:
+                response_text = await _rewrite_short_and_show(
+                    query, context, style_choice, style_template, {}, text_to_correct, "Вот переформулированный текст:"
+                )
+        if response_text:
+            prefetch.start(query.from_user.id, query.message.chat_id, context.user_data, response_text, style_choice)
         return POST_PROCESSING_MENU
     except Exception as e:
-        logger.error(f"Ошибка в style_chosen при вызове Gemini API: {e}", exc_info=True)
+        logger.error("Ошибка в style_chosen при вызове Gemini API: %s", e, exc_info=True)
+        metrics.errors_total.inc(type(e).__name__)
         await query.edit_message_text("К сожалению, произошла ошибка при обработке вашего запроса. Попробуйте позже.")
         return ConversationHandler.END
 
@@ -238,198 +489,95 @@ async def addressee_described(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Произошла ошибка: не найден исходный текст. Пожалуйста, начни заново, нажав «Новый текст».")
         return ConversationHandler.END
 
-    await update.message.reply_text("Понял тебя! Подбираю стиль и переформулирую текст для твоего адресата. Минуточку...")
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-
-    style_business_instr = """Применяй следующие принципы делового стиля:
-1.  **Обеспечь лаконичность:** Если в предложении есть очевидно лишние слова или повторы, которые можно убрать без потери смысла и изменения структуры — сделай это.
-2.  **Придай официальный тон:** Заменяй разговорную лексику и жаргон на нейтральные или деловые эквиваленты.
-3.  **Сохраняй фокус на цели:** Убедись, что ключевая мысль, просьба или предложение выражены четко и ясно."""
-    style_academic_instr = """Применяй следующие принципы учебного (академического) стиля:
-1.  **Усиль логические связки:** При необходимости замени союзы или добавь вводные слова (например, «следовательно», «однако»), чтобы улучшить логическую последовательность, не меняя порядок предложений.
-2.  **Используй точную терминологию:** Если в тексте есть разговорные аналоги научных или учебных терминов, замени их на корректные термины.
-3.  **Соблюдай нейтральность:** Убирай эмоционально окрашенные слова, заменяя их на нейтральные синонимы."""
-    style_personal_instr = """Применяй следующие принципы для личного общения:
-1.  **Сделай текст более живым:** Если это уместно, замени нейтральное слово на более эмоциональный синоним, не меняя общий смысл и конструкцию предложения.
-2.  **Сохраняй авторский голос:** Не трогай характерные для автора выражения, сленг или личные обороты речи, если они не мешают пониманию.
-3.  **Улучши связность:** Если два коротких предложения можно логично объединить в одно без потери авторского стиля, сделай это."""
-    style_simplified_instr = """Применяй следующие принципы для упрощения текста:
-1.  **Используй простую лексику:** Последовательно заменяй сложные или узкоспециализированные слова на их более простые и общеупотребительные аналоги.
-2.  **Сокращай, но осторожно:** Только если предложение очень длинное и запутанное, ты можешь аккуратно разделить его на два, стараясь сохранить исходные слова и порядок мысли. Не делай этого без крайней необходимости."""
-
-    prompt_for_gemini = f"""Твоя задача – переформулировать исходный текст, автоматически подобрав для него наиболее подходящий стиль, учитывая, что сообщение адресовано: '{addressee_description}'.
-{TUNE_INSTRUCTION}
-Проанализируй исходный текст и описание адресата. Определи, какой из следующих четырех стилей (Деловой, Учебный, Личное общение, Упрощение текста) является наиболее подходящим для данной ситуации.
-После того как ты определишь наиболее подходящий стиль, переформулируй исходный текст, СТРОГО следуя ИСКЛЮЧИТЕЛЬНО инструкциям для ВЫБРАННОГО ТОБОЙ стиля.
-Вот детальные инструкции для каждого стиля:
----
-ИНСТРУКЦИИ ДЛЯ ДЕЛОВОГО СТИЛЯ:
-{style_business_instr}
----
-ИНСТРУКЦИИ ДЛЯ УЧЕБНОГО (АКАДЕМИЧЕСКОГО) СТИЛЯ:
-{style_academic_instr}
----
-ИНСТРУКЦИИ ДЛЯ СТИЛЯ ЛИЧНОГО ОБЩЕНИЯ:
-{style_personal_instr}
----
-ИНСТРУКЦИИ ДЛЯ УПРОЩЕНИЯ ТЕКСТА:
-{style_simplified_instr}
----
-Если ты не можешь с высокой уверенностью определить один из этих четырех стилей на основе описания адресата ('{addressee_description}') и исходного текста, сделай переформулированный текст максимально нейтральным и обезличенным, без явных обращений и излишних эмоций, но при этом понятным, логичным и сохраняющим всю суть исходного сообщения.
-КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла.
-Исходный текст для переформулирования: "{text_to_correct}"
-
-Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст.
-НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."""
+    status_message = await update.message.reply_text("Понял тебя! Подбираю стиль и переформулирую текст для твоего адресата. Минуточку...")
+
+    auto_template = prompts.select_auto_template(addressee_description)
+    message_prefix = f"Вот переформулированный текст (стиль подобран автоматически для '{addressee_description}'):"
 
     try:
-        response_text = gemini_api.ask_gemini(prompt_for_gemini, GEMINI_API_KEY)
-        await _send_post_processing_menu(update, context, response_text, f"Вот переформулированный текст (стиль подобран автоматически для '{addressee_description}'):")
+        async with telegram_outbound.typing(context.bot, update.effective_chat.id):
+            if chunking.needs_chunking(text_to_correct):
+                response_text = await _rewrite_long_and_show(
+                    update, context, auto_template, {'addressee': addressee_description}, text_to_correct,
+                    message_prefix, status_message=status_message
+                )
+            else:
+                response_text = await _rewrite_short_and_show(
+                    update, context, f"style_auto:{addressee_description.strip().lower()}", auto_template,
+                    {'addressee': addressee_description}, text_to_correct, message_prefix, status_message=status_message
+                )
+        if response_text:
+            prefetch.start(update.effective_user.id, update.effective_chat.id, context.user_data, response_text, 'style_auto')
         return POST_PROCESSING_MENU
     except Exception as e:
-        logger.error(f"Ошибка в addressee_described при вызове Gemini API: {e}", exc_info=True)
+        logger.error("Ошибка в addressee_described при вызове Gemini API: %s", e, exc_info=True)
+        metrics.errors_total.inc(type(e).__name__)
         await update.message.reply_text("К сожалению, произошла ошибка при обработке вашего запроса с автоопределением стиля. Попробуйте позже.")
         return ConversationHandler.END
 
 
 async def post_processing_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    telegram_outbound.answer(context.bot, query)
     action_choice = query.data
+    metrics.adjustments_total.inc(action_choice)
+    fuzzy_cache.record_feedback(context.user_data, action_choice)
 
     last_response = context.user_data.get('last_gemini_response')
     original_text = context.user_data.get('text_to_correct')
     chosen_style_callback = context.user_data.get('chosen_style')
     addressee_description_if_auto = context.user_data.get('addressee_description')
 
-    prompt_for_gemini = ""
+    # Шаблон, его поля и текст, к которому он применяется: длинный текст обрабатывается по частям
+    template = None
+    template_fields = {}
+    source_text = ""
     final_message_prefix = ""
 
-    if action_choice in ["adjust_softer", "adjust_harder", "adjust_more_formal"]:
+    if action_choice in prompts.ADJUSTMENTS:
         if not last_response:
             await query.edit_message_text(text="Ошибка: текст для доработки не найден. Начните заново, нажав «Новый текст».")
             return ConversationHandler.END
 
-        instruction_verb_for_status_update = ""
-        modification_instruction_for_gemini = ""
-
-        if action_choice == "adjust_softer":
-            instruction_verb_for_status_update = "смягчение тона"
-            final_message_prefix = "Готово! Сделал текст немного мягче:"
-            modification_instruction_for_gemini = "Сделай следующий текст немного мягче по тону, заменяя отдельные слова на более вежливые или дипломатичные синонимы, но не меняя структуру предложений."
-        elif action_choice == "adjust_harder":
-            instruction_verb_for_status_update = "увеличение жесткости/настойчивости тона"
-            final_message_prefix = "Есть! Текст стал более настойчивым:"
-            modification_instruction_for_gemini = "Сделай следующий текст немного жестче или более настойчивым по тону, заменяя отдельные слова на более сильные или прямые синонимы, но не меняя структуру предложений."
-        elif action_choice == "adjust_more_formal":
-            instruction_verb_for_status_update = "увеличение формальности стиля"
-            final_message_prefix = "Пожалуйста! Теперь текст более формальный:"
-            if chosen_style_callback == "style_academic":
-                modification_instruction_for_gemini = "Сделай следующий текст немного более формальным, но избегай излишней строгости. Можно заменить некоторые нейтральные слова на более академические аналоги или улучшить связность предложений. Цель — отполированный учебный текст, а не сухой официальный документ."
-            else:
-                modification_instruction_for_gemini = "Сделай следующий текст еще более формальным, заменяя разговорные или нейтральные слова на их более официальные эквиваленты, но не меняя структуру предложений."
-
-        await query.edit_message_text(text=f"Применяю '{instruction_verb_for_status_update}'... Минуточку.")
-
-        prompt_for_gemini = (
-            f"Твоя задача — изменить тон предоставленного текста согласно инструкции, при этом строго следуя общим правилам. "
-            f"{TUNE_INSTRUCTION}\n"
-            f"Инструкция по изменению тона: {modification_instruction_for_gemini}\n"
-            f"КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений или потерь ключевой информации. "
-            f"Вот текст для модификации: \"{last_response}\"\n\n"
-            f"Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО измененный текст. "
-            f"НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."
-        )
+        instruction_verb_for_status_update, final_message_prefix, _ = prompts.ADJUSTMENTS[action_choice]
+
+        # Готовый вариант из упреждающей генерации показываем сразу, без статуса «Применяю...»
+        if not prefetch.has_variant(context.user_data, action_choice, last_response):
+            telegram_outbound.edit_status(
+                context.bot, query.message.chat_id, query.message.message_id,
+                f"Применяю '{instruction_verb_for_status_update}'... Минуточку."
+            )
+        prefetched_text = await prefetch.take(query.from_user.id, context.user_data, action_choice, last_response)
+        if prefetched_text is not None:
+            await _send_post_processing_menu(query, context, prefetched_text, final_message_prefix)
+            return POST_PROCESSING_MENU
+
+        template = prompts.get_adjust_template(action_choice, chosen_style_callback)
+        source_text = last_response
     elif action_choice == "regenerate_text":
         if not original_text:
             await query.edit_message_text(text="Ошибка: исходный текст для повторной генерации не найден. Начните заново, нажав «Новый текст».")
             return ConversationHandler.END
 
-        await query.edit_message_text(text="Генерирую новый вариант на основе первоначальных данных... Минуточку.")
+        # Варианты тона относились к прежнему ответу
+        prefetch.cancel(query.from_user.id, context.user_data)
 
         if chosen_style_callback == "style_auto" and addressee_description_if_auto:
-            style_business_instr = """Применяй следующие принципы делового стиля:
-1.  **Обеспечь лаконичность:** Если в предложении есть очевидно лишние слова или повторы, которые можно убрать без потери смысла и изменения структуры — сделай это.
-2.  **Придай официальный тон:** Заменяй разговорную лексику и жаргон на нейтральные или деловые эквиваленты.
-3.  **Сохраняй фокус на цели:** Убедись, что ключевая мысль, просьба или предложение выражены четко и ясно."""
-            style_academic_instr = """Применяй следующие принципы учебного (академического) стиля:
-1.  **Усиль логические связки:** При необходимости замени союзы или добавь вводные слова (например, «следовательно», «однако»), чтобы улучшить логическую последовательность, не меняя порядок предложений.
-2.  **Используй точную терминологию:** Если в тексте есть разговорные аналоги научных или учебных терминов, замени их на корректные термины.
-3.  **Соблюдай нейтральность:** Убирай эмоционально окрашенные слова, заменяя их на нейтральные синонимы."""
-            style_personal_instr = """Применяй следующие принципы для личного общения:
-1.  **Сделай текст более живым:** Если это уместно, замени нейтральное слово на более эмоциональный синоним, не меняя общий смысл и конструкцию предложения.
-2.  **Сохраняй авторский голос:** Не трогай характерные для автора выражения, сленг или личные обороты речи, если они не мешают пониманию.
-3.  **Улучши связность:** Если два коротких предложения можно логично объединить в одно без потери авторского стиля, сделай это."""
-            style_simplified_instr = """Применяй следующие принципы для упрощения текста:
-1.  **Используй простую лексику:** Последовательно заменяй сложные или узкоспециализированные слова на их более простые и общеупотребительные аналоги.
-2.  **Сокращай, но осторожно:** Только если предложение очень длинное и запутанное, ты можешь аккуратно разделить его на два, стараясь сохранить исходные слова и порядок мысли. Не делай этого без крайней необходимости."""
-
-            prompt_for_gemini = f"""Твоя задача – переформулировать исходный текст, автоматически подобрав для него наиболее подходящий стиль, учитывая, что сообщение адресовано: '{addressee_description_if_auto}'.
-{TUNE_INSTRUCTION}
-Проанализируй исходный текст и описание адресата. Определи, какой из следующих четырех стилей (Деловой, Учебный, Личное общение, Упрощение текста) является наиболее подходящим для данной ситуации.
-После того как ты определишь наиболее подходящий стиль, переформулируй исходный текст, СТРОГО следуя ИСКЛЮЧИТЕЛЬНО инструкциям для ВЫБРАННОГО ТОБОЙ стиля.
-Вот детальные инструкции для каждого стиля:
----
-ИНСТРУКЦИИ ДЛЯ ДЕЛОВОГО СТИЛЯ:
-{style_business_instr}
----
-ИНСТРУКЦИИ ДЛЯ УЧЕБНОГО (АКАДЕМИЧЕСКОГО) СТИЛЯ:
-{style_academic_instr}
----
-ИНСТРУКЦИИ ДЛЯ СТИЛЯ ЛИЧНОГО ОБЩЕНИЯ:
-{style_personal_instr}
----
-ИНСТРУКЦИИ ДЛЯ УПРОЩЕНИЯ ТЕКСТА:
-{style_simplified_instr}
----
-Если ты не можешь с высокой уверенностью определить один из этих четырех стилей на основе описания адресата ('{addressee_description_if_auto}') и исходного текста, сделай переформулированный текст максимально нейтральным и обезличенным, без явных обращений и излишних эмоций, но при этом понятным, логичным и сохраняющим всю суть исходного сообщения.
-КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла.
-Исходный текст для переформулирования: "{original_text}"
-
-Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст.
-НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."""
+            template = prompts.select_auto_template(addressee_description_if_auto)
+            template_fields = {'addressee': addressee_description_if_auto}
+            source_text = original_text
             final_message_prefix = f"Новый вариант (стиль подобран автоматически для '{addressee_description_if_auto}'):"
 
         elif chosen_style_callback and chosen_style_callback != "style_auto":
-            style_specific_instruction = ""
-            if chosen_style_callback == "style_business":
-                style_specific_instruction = """Применяй следующие принципы делового стиля:
-1.  **Обеспечь лаконичность:** Если в предложении есть очевидно лишние слова или повторы, которые можно убрать без потери смысла и изменения структуры — сделай это.
-2.  **Придай официальный тон:** Заменяй разговорную лексику и жаргон на нейтральные или деловые эквиваленты.
-3.  **Сохраняй фокус на цели:** Убедись, что ключевая мысль, просьба или предложение выражены четко и ясно."""
-            elif chosen_style_callback == "style_academic":
-                style_specific_instruction = """Применяй следующие принципы учебного (академического) стиля:
-1.  **Усиль логические связки:** При необходимости замени союзы или добавь вводные слова (например, «следовательно», «однако»), чтобы улучшить логическую последовательность, не меняя порядок предложений.
-2.  **Используй точную терминологию:** Если в тексте есть разговорные аналоги научных или учебных терминов, замени их на корректные термины.
-3.  **Соблюдай нейтральность:** Убирай эмоционально окрашенные слова, заменяя их на нейтральные синонимы."""
-            elif chosen_style_callback == "style_personal":
-                style_specific_instruction = """Применяй следующие принципы для личного общения:
-1.  **Сделай текст более живым:** Если это уместно, замени нейтральное слово на более эмоциональный синоним, не меняя общий смысл и конструкцию предложения.
-2.  **Сохраняй авторский голос:** Не трогай характерные для автора выражения, сленг или личные обороты речи, если они не мешают пониманию.
-3.  **Улучши связность:** Если два коротких предложения можно логично объединить в одно без потери авторского стиля, сделай это."""
-            elif chosen_style_callback == "style_simplified":
-                style_specific_instruction = """Применяй следующие принципы для упрощения текста:
-1.  **Используй простую лексику:** Последовательно заменяй сложные или узкоспециализированные слова на их более простые и общеупотребительные аналоги.
-2.  **Сокращай, но осторожно:** Только если предложение очень длинное и запутанное, ты можешь аккуратно разделить его на два, стараясь сохранить исходные слова и порядок мысли. Не делай этого без крайней необходимости."""
-
-            if not style_specific_instruction:
+            style_template = prompts.get_style_template(chosen_style_callback)
+
+            if not style_template:
                  await query.edit_message_text(text="Ошибка: неизвестный стиль для повторной генерации. Начните заново, нажав «Новый текст».")
                  return ConversationHandler.END
 
-            prompt_for_gemini = (
-                f"Твоя задача: внимательно и аккуратно переформулировать следующий исходный текст. "
-                f"{TUNE_INSTRUCTION} "
-                f"Вот конкретные принципы, которым нужно следовать для выбранного стиля:\n{style_specific_instruction}\n"
-                f"КРИТИЧЕСКИ ВАЖНО: Первоначальный и полный смысл исходного текста должен быть сохранен АБСОЛЮТНО ТОЧНО, без малейших искажений, потерь ключевой информации или добавления нового смысла. "
-                f"Исходный текст для переформулирования: \"{original_text}\"\n\n"
-                f"Твой ответ должен содержать ИСКЛЮЧИТЕЛЬНО и ТОЛЬКО переформулированный текст. "
-                f"НЕ ДОБАВЛЯЙ никаких приветствий, вступлений, объяснений своих действий, извинений, комментариев, послесловий или каких-либо других фраз, кроме самого переформулированного текста."
-            )
-            style_name_map = {
-                "style_business": "Деловой стиль", "style_academic": "Учебный стиль",
-                "style_personal": "Личное общение", "style_simplified": "Упрощённый текст"
-            }
-            readable_style_name = style_name_map.get(chosen_style_callback, chosen_style_callback)
+            template = style_template
+            source_text = original_text
+            readable_style_name = prompts.STYLE_NAMES.get(chosen_style_callback, chosen_style_callback)
             final_message_prefix = f"Новый вариант ({readable_style_name}):"
         else:
             await query.edit_message_text(text="Ошибка: не удалось восстановить параметры для повторной генерации. Начните заново, нажав «Новый текст».")
@@ -438,14 +586,32 @@ async def post_processing_action(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text(text=f"Неизвестное действие: {action_choice}. Завершаю диалог.")
         return ConversationHandler.END
 
-    await context.bot.send_chat_action(chat_id=query.message.chat_id, action="typing")
-
     try:
-        new_response_text = gemini_api.ask_gemini(prompt_for_gemini, GEMINI_API_KEY)
-        await _send_post_processing_menu(query, context, new_response_text, final_message_prefix)
+        long_text = chunking.needs_chunking(source_text)
+        prompt_for_gemini = template.render(text=source_text, **template_fields)
+        if action_choice == "regenerate_text" and REGENERATE_CANDIDATES > 1 and not long_text:
+            await _regenerate_with_candidates(query, context, prompt_for_gemini, final_message_prefix, template.id)
+            return POST_PROCESSING_MENU
+        if action_choice == "regenerate_text":
+            telegram_outbound.edit_status(
+                context.bot, query.message.chat_id, query.message.message_id,
+                "Генерирую новый вариант на основе первоначальных данных... Минуточку."
+            )
+
+        async with telegram_outbound.typing(context.bot, query.message.chat_id):
+            if long_text:
+                await _rewrite_long_and_show(query, context, template, template_fields, source_text, final_message_prefix)
+                return POST_PROCESSING_MENU
+
+            # «Сгенерировать заново» должно давать новый вариант, поэтому кэш для него не читаем
+            await _generate_and_show(
+                query, context, prompt_for_gemini, final_message_prefix,
+                use_cache=(action_choice != "regenerate_text"), template_id=template.id
+            )
         return POST_PROCESSING_MENU
     except Exception as e:
-        logger.error(f"Ошибка в post_processing_action при вызове Gemini API: {e}", exc_info=True)
+        logger.error("Ошибка в post_processing_action при вызове Gemini API: %s", e, exc_info=True)
+        metrics.errors_total.inc(type(e).__name__)
         await query.edit_message_text(
             text="К сожалению, произошла ошибка при доработке/генерации текста. Попробуйте позже."
         )
@@ -459,8 +625,9 @@ async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif update.message:
         await update.message.reply_text("Действие отменено. Чтобы начать заново, нажми «Новый текст».",
                                       reply_markup=main_menu_keyboard)
+    prefetch.cancel(update.effective_user.id)
     context.user_data.clear()
-    logger.info(f"Пользователь {update.effective_user.id} отменил диалог.")
+    logger.info("Пользователь %s отменил диалог.", update.effective_user.id)
     return ConversationHandler.END
 
 
@@ -468,17 +635,99 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(f"Бот онлайн и готов к работе! Health check сервер активен.")
 
 
-def main() -> None:
-    if not TELEGRAM_TOKEN:
-        logger.critical("Переменная окружения TELEGRAM_TOKEN не найдена! Бот не может быть запущен.")
-        return
-
-    logger.info("Запуск основного приложения бота...")
-    start_health_check_server_in_thread()
-
-    persistence = PicklePersistence(filepath="bot_persistence")
-
-    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
+async def _on_shutdown(application: Application) -> None:
+    """Освобождает общие ресурсы при остановке бота."""
+    await gemini_api.close_async_client()
+
+
+class _InstrumentedApplication(Application):
+    """
+    Application, который открывает трассу на каждое обновление, записывает в метрики
+    время обработки обновлений и сохранения состояния, на время работы запускает
+    сторож цикла событий (loop_watchdog) и сообщает профилировщику (profiling) цикл бота.
+    При инициализации заранее открывает соединение с Gemini и записывает этапы запуска (startup).
+    """
+
+    async def initialize(self) -> None:
+        # Соединение с Gemini открывается параллельно с getMe (соединение с Telegram) и загрузкой состояния
+        self._prewarm_task = asyncio.create_task(self._prewarm_gemini())
+        with startup.stage('initialize'):
+            await super().initialize()
+
+    @staticmethod
+    async def _prewarm_gemini() -> None:
+        with startup.stage('gemini_prewarm'):
+            await gemini_api.prewarm()
+
+    async def start(self) -> None:
+        await super().start()
+        profiling.profiler.attach()
+        loop_watchdog.watchdog.start(backlog=lambda: loop_watchdog.application_backlog(self))
+        startup.ready()
+
+    async def stop(self) -> None:
+        await loop_watchdog.watchdog.stop()
+        await super().stop()
+
+    async def process_update(self, update: object) -> None:
+        update_id = getattr(update, 'update_id', None)
+        with tracing.start_trace('update', update_id=update_id), \
+                metrics.in_flight.track_inprogress('updates'), metrics.stage_timer('handler'):
+            await super().process_update(update)
+
+    async def update_persistence(self) -> None:
+        with metrics.stage_timer('persistence_flush'):
+            await super().update_persistence()
+
+
+class _InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API, который записывает время отправки и правки сообщений в метрики и трассу."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # url оканчивается именем метода Bot API, например .../sendMessage или .../editMessageText
+        api_method = url.rsplit('/', 1)[-1]
+        stage = 'telegram_edit' if api_method.startswith('edit') else 'telegram_send'
+        with metrics.stage_timer(stage), tracing.span(stage, method=api_method):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def build_persistence():
+    """Создает хранилище состояния согласно PERSISTENCE_BACKEND."""
+    if PERSISTENCE_BACKEND == "sqlite":
+        from state_store import SQLitePersistence
+        path = PERSISTENCE_PATH if PERSISTENCE_PATH.endswith(".sqlite3") else f"{PERSISTENCE_PATH}.sqlite3"
+        logger.info(f"Состояние диалогов хранится в SQLite: {path}")
+        return SQLitePersistence(filepath=path, ttl=PERSISTENCE_TTL or None)
+    if PERSISTENCE_BACKEND != "pickle":
+        logger.warning(f"Неизвестное хранилище PERSISTENCE_BACKEND={PERSISTENCE_BACKEND}, используется pickle.")
+    # Файл читается в фоновом потоке, пока бот подключается к Telegram и Gemini
+    from state_store import BackgroundPicklePersistence
+    return BackgroundPicklePersistence(filepath=PERSISTENCE_PATH)
+
+
+def build_application(token: str, persistence=None, base_url: str = None) -> Application:
+    """
+    Создает Application со всеми обработчиками бота, но не запускает его.
+    persistence — хранилище состояния (None — без сохранения между перезапусками);
+    base_url — адрес Bot API вместо api.telegram.org (например, локальная заглушка из bench/).
+    """
+    update_processor = PerChatUpdateProcessor(CONCURRENT_UPDATES)
+    metrics.register_stats('updates', update_processor.stats)
+    builder = (
+        Application.builder()
+        .application_class(_InstrumentedApplication)
+        .token(token)
+        # Размер пула как у клиента по умолчанию: параллельные обработчики отправляют сообщения одновременно
+        .request(_InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(telegram_outbound.outbound_limiter)
+        .concurrent_updates(update_processor)
+        .post_shutdown(_on_shutdown)
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Text(["Новый текст"]), start_new_dialogue)],
@@ -501,11 +750,70 @@ def main() -> None:
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_conversation)],
+        # Состояние диалогов хранится вместе с user_data: после перезапуска (в том числе процесса шарда,
+        # см. workers) пользователь продолжает с того же шага
+        name="speaksmart_dialogue",
+        persistent=persistence is not None,
     )
+    profiling.instrument_conversation(conv_handler)
 
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("status", status))
+    bulk.setup(application)
+    retention.setup(application)
+    profiling.setup(application)
+    return application
+
+
+def main(boot_server=None) -> None:
+    """
+    Запускает бота в режиме RUN_MODE. boot_server — HTTP-сервер, который уже открыл порт
+    health check при быстром запуске (см. boot.py): в режиме опроса он продолжает обслуживать
+    служебные маршруты, а в режиме webhook передает свой сокет и принятые обновления webhook-серверу.
+    """
+    if not TELEGRAM_TOKEN:
+        logger.critical("Переменная окружения TELEGRAM_TOKEN не найдена! Бот не может быть запущен.")
+        return
+    if not gemini_api.backend_pool.backends:
+        logger.error("Не задан ни один ключ Gemini (GEMINI_API_KEYS или GEMINI_API_KEY): запросы к модели будут отклоняться.")
+
+    logger.info("Запуск основного приложения бота...")
+    use_webhook = RUN_MODE == "webhook"
+    if use_webhook and not WEBHOOK_URL:
+        logger.error("RUN_MODE=webhook, но WEBHOOK_URL не задан. Переключаюсь на режим опроса.")
+        use_webhook = False
+    if not use_webhook and boot_server is None:
+        # В режиме webhook health check обслуживает тот же сервер, что и обновления
+        start_health_check_server_in_thread()
+
+    if WORKERS > 1:
+        import workers
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.strip('/')}" if use_webhook else None
+        sock, pending_updates = boot_server.hand_over() if use_webhook and boot_server else (None, [])
+        workers.run_sharded(
+            TELEGRAM_TOKEN, WORKERS, webhook_url=webhook_url, port=HEALTH_CHECK_PORT,
+            url_path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, sock=sock, pending_updates=pending_updates,
+        )
+        return
+
+    with startup.stage('build'):
+        application = build_application(TELEGRAM_TOKEN, persistence=build_persistence())
+
+    if use_webhook:
+        from webhook_server import run_webhook
+        logger.info("Бот Telegram успешно настроен и запускается в режиме webhook...")
+        sock, pending_updates = boot_server.hand_over() if boot_server else (None, [])
+        run_webhook(
+            application,
+            port=HEALTH_CHECK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.strip('/')}",
+            secret_token=WEBHOOK_SECRET,
+            sock=sock,
+            pending_updates=pending_updates,
+        )
+        return
 
     logger.info("Бот Telegram успешно настроен и запускается в режиме опроса...")
     application.run_polling()
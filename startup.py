@@ -0,0 +1,94 @@
+# startup.py
+"""
+Замеры времени запуска бота.
+
+Этапы запуска записываются через stage() (длительность блока) или record(), а когда бот
+готов принимать обновления, ready() один раз пишет в лог разбивку: сколько занял запуск
+интерпретатора, открытие порта health check, импорт модулей, сборка приложения, загрузка
+состояния, соединения с Telegram и Gemini. Те же значения доступны в /metrics
+(speaksmart_startup_*_ms).
+
+Этапы, которые идут параллельно (загрузка состояния в фоновом потоке, соединение с Gemini),
+записываются отдельно и в сумму не складываются; total — время от запуска процесса до готовности.
+
+Модуль импортирует только стандартную библиотеку и metrics, чтобы его можно было подключить
+самым первым (см. boot.py).
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Время импорта модуля: отсюда отсчитываются этапы, если возраст процесса неизвестен
+_imported_at = time.monotonic()
+# этап -> длительность (секунды) в порядке записи
+_stages = {}
+_ready_at = None
+
+
+def _process_age() -> float:
+    """Сколько секунд прошло с запуска процесса (Linux, /proc); None, если узнать нельзя."""
+    try:
+        with open("/proc/self/stat") as stat_file:
+            # Поле 22 — время запуска в тиках с загрузки системы; имя процесса в скобках может содержать пробелы
+            started_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Запуск интерпретатора и импорт стандартных модулей до этого места
+_python_startup = _process_age()
+_process_started_at = _imported_at - (_python_startup or 0.0)
+if _python_startup is not None:
+    _stages['python'] = _python_startup
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        _stages[name] = _stages.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Записывает длительность блока как этап запуска."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - started)
+
+
+def since_start() -> float:
+    """Секунды с запуска процесса."""
+    return time.monotonic() - _process_started_at
+
+
+def ready():
+    """Отмечает, что бот готов принимать обновления, и один раз пишет разбивку запуска в лог."""
+    global _ready_at
+    with _lock:
+        if _ready_at is not None:
+            return
+        _ready_at = since_start()
+        breakdown = ", ".join(f"{name} {1000 * seconds:.0f}" for name, seconds in _stages.items())
+    logger.info("Бот готов через %.0f мс после запуска процесса. Этапы (мс): %s.", 1000 * _ready_at, breakdown)
+
+
+def get_stats() -> dict:
+    """Длительность этапов запуска (мс) и общее время до готовности (total_ms, 0 — еще не готов)."""
+    with _lock:
+        stats = {f"{name}_ms": 1000 * seconds for name, seconds in _stages.items()}
+        stats['total_ms'] = 1000 * _ready_at if _ready_at is not None else 0.0
+    return stats
+
+
+metrics.register_stats('startup', get_stats)
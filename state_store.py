@@ -0,0 +1,309 @@
+# state_store.py
+"""
+Хранилище состояния бота в SQLite вместо одного pickle-файла.
+Каждый пользователь — отдельная строка, поэтому при сохранении записываются
+только изменившиеся пользователи, а не весь user_data целиком. Данные пользователя
+читаются лениво, при первом обращении к нему, так что время запуска не зависит
+от размера аудитории. Режим WAL позволяет нескольким процессам работать с одним файлом.
+
+Для обычного pickle-файла есть BackgroundPicklePersistence: файл читается в фоновом потоке
+сразу после создания приложения, параллельно с подключением к Telegram и Gemini, а не в цикле
+событий во время initialize().
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+import startup
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (name, key))",
+    "CREATE INDEX IF NOT EXISTS user_data_updated ON user_data(updated_at)",
+    "CREATE INDEX IF NOT EXISTS chat_data_updated ON chat_data(updated_at)",
+    "CREATE INDEX IF NOT EXISTS conversations_updated ON conversations(updated_at)",
+)
+
+
+def _dump(data) -> bytes:
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Реализация BasePersistence поверх SQLite.
+
+    - user_data и chat_data загружаются лениво в refresh_user_data / refresh_chat_data;
+    - запись выполняется только если сериализованные данные действительно изменились;
+    - записи, не обновлявшиеся дольше ttl секунд, считаются устаревшими и удаляются.
+    """
+
+    def __init__(self, filepath: str, ttl: float = None, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(), update_interval=update_interval)
+        self.filepath = filepath
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filepath, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        # Кого уже загрузили из базы и хэши последних записанных данных (для пропуска неизменившихся)
+        self._loaded = {'user_data': set(), 'chat_data': set()}
+        self._hashes = {'user_data': {}, 'chat_data': {}}
+        self._loading = {}
+        self.rows_written = 0
+        self.rows_skipped = 0
+
+    # --- Вспомогательные методы работы с базой (выполняются в отдельном потоке) ---
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def _fetchone(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _min_updated_at(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    def _purge_expired(self):
+        if not self.ttl:
+            return
+        threshold = self._min_updated_at()
+        with self._lock:
+            removed = 0
+            for table in ('user_data', 'chat_data', 'conversations'):
+                removed += self._conn.execute(f"DELETE FROM {table} WHERE updated_at < ?", (threshold,)).rowcount
+            self._conn.commit()
+        if removed:
+            logger.info(f"Из хранилища состояния удалено устаревших записей: {removed}")
+
+    async def _load_row(self, table: str, row_id: int, target: dict):
+        if row_id in self._loaded[table]:
+            return
+        # При параллельной обработке обновлений одного пользователя читаем строку только один раз
+        key = (table, row_id)
+        pending = self._loading.get(key)
+        if pending is not None:
+            await asyncio.shield(pending)
+            return
+        pending = asyncio.ensure_future(self._read_row(table, row_id, target))
+        self._loading[key] = pending
+        try:
+            await pending
+            self._loaded[table].add(row_id)
+        finally:
+            self._loading.pop(key, None)
+
+    async def _read_row(self, table: str, row_id: int, target: dict):
+        row = await asyncio.to_thread(
+            self._fetchone, f"SELECT data FROM {table} WHERE id = ? AND updated_at >= ?",
+            (row_id, self._min_updated_at())
+        )
+        if row is not None:
+            target.update(pickle.loads(row[0]))
+            self._hashes[table][row_id] = hashlib.blake2b(row[0], digest_size=16).digest()
+
+    async def _store_row(self, table: str, row_id: int, data: dict):
+        if not data and row_id not in self._loaded[table]:
+            # Данные были вытеснены из памяти (forget_user): актуальная копия лежит в базе
+            self.rows_skipped += 1
+            return
+        blob = _dump(data)
+        digest = hashlib.blake2b(blob, digest_size=16).digest()
+        if self._hashes[table].get(row_id) == digest:
+            self.rows_skipped += 1
+            return
+        await asyncio.to_thread(
+            self._execute, f"INSERT OR REPLACE INTO {table} (id, data, updated_at) VALUES (?, ?, ?)",
+            (row_id, blob, time.time())
+        )
+        self._hashes[table][row_id] = digest
+        self.rows_written += 1
+
+    async def _drop_row(self, table: str, row_id: int):
+        await asyncio.to_thread(self._execute, f"DELETE FROM {table} WHERE id = ?", (row_id,))
+        self._hashes[table].pop(row_id, None)
+        self._loaded[table].discard(row_id)
+
+    def forget_user(self, user_id: int):
+        """
+        Забывает, что данные пользователя уже загружены, не трогая базу.
+        При следующем обращении они будут заново прочитаны из SQLite.
+        """
+        self._loaded['user_data'].discard(user_id)
+        self._hashes['user_data'].pop(user_id, None)
+
+    # --- user_data ---
+
+    async def get_user_data(self) -> dict:
+        # Данные пользователей загружаются лениво в refresh_user_data
+        await asyncio.to_thread(self._purge_expired)
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._load_row('user_data', user_id, user_data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._store_row('user_data', user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop_row('user_data', user_id)
+
+    # --- chat_data ---
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._load_row('chat_data', chat_id, chat_data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._store_row('chat_data', chat_id, data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop_row('chat_data', chat_id)
+
+    # --- bot_data и callback_data (по одной строке) ---
+
+    async def get_bot_data(self) -> dict:
+        row = await asyncio.to_thread(self._fetchone, "SELECT data FROM bot_data WHERE id = 0")
+        return pickle.loads(row[0]) if row else {}
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        await asyncio.to_thread(
+            self._execute, "INSERT OR REPLACE INTO bot_data (id, data, updated_at) VALUES (0, ?, ?)",
+            (_dump(data), time.time())
+        )
+
+    async def get_callback_data(self):
+        row = await asyncio.to_thread(self._fetchone, "SELECT data FROM callback_data WHERE id = 0")
+        return pickle.loads(row[0]) if row else None
+
+    async def update_callback_data(self, data) -> None:
+        await asyncio.to_thread(
+            self._execute, "INSERT OR REPLACE INTO callback_data (id, data, updated_at) VALUES (0, ?, ?)",
+            (_dump(data), time.time())
+        )
+
+    # --- Состояния ConversationHandler ---
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await asyncio.to_thread(
+            self._fetchall, "SELECT key, state FROM conversations WHERE name = ? AND updated_at >= ?",
+            (name, self._min_updated_at())
+        )
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        key_json = json.dumps(list(key))
+        if new_state is None:
+            await asyncio.to_thread(
+                self._execute, "DELETE FROM conversations WHERE name = ? AND key = ?", (name, key_json)
+            )
+        else:
+            await asyncio.to_thread(
+                self._execute,
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                (name, key_json, _dump(new_state), time.time())
+            )
+
+    async def flush(self) -> None:
+        await asyncio.to_thread(self._purge_expired)
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        logger.info(
+            f"Хранилище состояния закрыто. Записано строк: {self.rows_written}, пропущено без изменений: {self.rows_skipped}"
+        )
+
+
+class BackgroundPicklePersistence(PicklePersistence):
+    """
+    PicklePersistence (один файл), который начинает читать файл в фоновом потоке, как только
+    приложение передает ему бота (set_bot), а данные отдает из потока, не блокируя цикл событий:
+    и распаковка, и копирование большого файла занимают заметное время.
+    """
+
+    def __init__(self, filepath: str, **kwargs):
+        super().__init__(filepath=filepath, **kwargs)
+        self._load_lock = threading.Lock()
+        self._file_loaded = False
+        self._preload_thread = None
+
+    def set_bot(self, bot) -> None:
+        super().set_bot(bot)
+        if self.single_file and self._preload_thread is None:
+            self._preload_thread = threading.Thread(target=self._preload, name="persistence-preload", daemon=True)
+            self._preload_thread.start()
+
+    def _preload(self):
+        try:
+            self._load_singlefile()
+        except Exception as e:
+            # Ошибка повторится и будет выброшена при первом get_* во время initialize()
+            logger.error(f"Не удалось загрузить состояние из {self.filepath}: {e}")
+
+    def _load_singlefile(self) -> None:
+        # Файл читается один раз: остальные get_* ждут первой загрузки, а не повторяют ее
+        with self._load_lock:
+            if self._file_loaded:
+                return
+            with startup.stage('persistence_load'):
+                super()._load_singlefile()
+            self._file_loaded = True
+
+    def _loaded_copy(self, name: str):
+        self._load_singlefile()
+        value = getattr(self, name)
+        return None if value is None else deepcopy(value)
+
+    async def get_user_data(self) -> dict:
+        if not self.single_file:
+            return await super().get_user_data()
+        return await asyncio.to_thread(self._loaded_copy, 'user_data')
+
+    async def get_chat_data(self) -> dict:
+        if not self.single_file:
+            return await super().get_chat_data()
+        return await asyncio.to_thread(self._loaded_copy, 'chat_data')
+
+    async def get_bot_data(self):
+        if not self.single_file:
+            return await super().get_bot_data()
+        return await asyncio.to_thread(self._loaded_copy, 'bot_data')
+
+    async def get_callback_data(self):
+        if not self.single_file:
+            return await super().get_callback_data()
+        return await asyncio.to_thread(self._loaded_copy, 'callback_data')
+
+    async def get_conversations(self, name: str) -> dict:
+        if self.single_file:
+            await asyncio.to_thread(self._load_singlefile)
+        return await super().get_conversations(name)
@@ -0,0 +1,415 @@
+# telegram_outbound.py
+"""
+Исходящие запросы к Telegram Bot API.
+
+- OutboundRateLimiter — ограничитель запросов бота (telegram.ext.BaseRateLimiter):
+  глобальный лимит и лимит на чат, очередь с приоритетами (правка с результатом обгоняет
+  статусные сообщения), последовательные правки одного сообщения и сброс статусных правок,
+  которые все равно будут перезаписаны более новой правкой того же сообщения;
+- answer / edit_status — «выстрелил и забыл»: ответ на нажатие кнопки и статус «Минуточку...»
+  уходят параллельно с запросом к Gemini, а не перед ним;
+- typing — индикатор «печатает...», который обновляется, пока идет долгая генерация.
+
+Приоритет запроса передается в методы бота через rate_limit_args (см. PRIORITY_*).
+"""
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
+import time
+from bisect import insort
+
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Общий лимит запросов бота в секунду (0 — без ограничения)
+TELEGRAM_GLOBAL_RPS = float(os.environ.get("TELEGRAM_GLOBAL_RPS", 30))
+# Лимит сообщений и правок в секунду для одного личного чата и допустимый всплеск
+TELEGRAM_CHAT_RPS = float(os.environ.get("TELEGRAM_CHAT_RPS", 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get("TELEGRAM_CHAT_BURST", 5))
+# Лимит сообщений в минуту для группового чата
+TELEGRAM_GROUP_RPM = float(os.environ.get("TELEGRAM_GROUP_RPM", 20))
+# Сколько секунд статусная правка ждет отправки: если за это время придет результат, статус не отправляется
+TELEGRAM_STATUS_HOLD = float(os.environ.get("TELEGRAM_STATUS_HOLD", 0.15))
+# Сколько раз повторять результат и обычные запросы после RetryAfter
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 1))
+# Как часто обновлять «печатает...» (Telegram показывает его около 5 секунд)
+TYPING_REFRESH_INTERVAL = float(os.environ.get("TYPING_REFRESH_INTERVAL", 4.5))
+
+# Приоритеты (меньше — раньше). Правки с PRIORITY_PROGRESS и ниже можно сбросить,
+# если то же сообщение уже правится заново
+PRIORITY_RESULT = 0      # результат генерации, меню доработки, ответ на нажатие кнопки
+PRIORITY_NORMAL = 1      # все запросы без явного приоритета
+PRIORITY_PROGRESS = 2    # промежуточный текст при потоковом выводе (не ждет очереди), «печатает...»
+PRIORITY_STATUS = 3      # статус «Минуточку...»: придерживается на TELEGRAM_STATUS_HOLD
+
+# Методы, которые правят уже отправленное сообщение
+_EDIT_METHODS = {'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+# Методы, не расходующие лимит сообщений чата
+_CHAT_EXEMPT_METHODS = {'sendChatAction', 'answerCallbackQuery'}
+
+_DROPPED = object()
+
+
+def _seconds(value) -> float:
+    # В зависимости от настроек PTB retry_after — число секунд или timedelta
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class _Bucket:
+    """Token bucket без ожидания: когда повторить попытку, решает диспетчер."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float, reserve: float = 0) -> float:
+        """Через сколько секунд появится свободная единица сверх reserve (0 — уже есть)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(self.capacity, 1 + reserve)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self.wait_time(now)
+        return self.tokens >= self.capacity
+
+
+class _Request:
+    """Запрос в очереди ограничителя."""
+    __slots__ = ('priority', 'seq', 'chat_id', 'key', 'not_before', 'granted', 'enqueued_at')
+
+    def __init__(self, priority: int, seq: int, chat_id, key, not_before: float):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.key = key
+        self.not_before = not_before
+        self.granted = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def droppable(self) -> bool:
+        return self.key is not None and self.priority >= PRIORITY_PROGRESS
+
+    def __lt__(self, other) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Очередь исходящих запросов бота с приоритетами, глобальным лимитом и лимитом на чат.
+    rate_limit_args — приоритет (PRIORITY_*) или (приоритет, номер из reserve()).
+    """
+
+    def __init__(self, global_rps: float = TELEGRAM_GLOBAL_RPS, chat_rps: float = TELEGRAM_CHAT_RPS,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, group_rpm: float = TELEGRAM_GROUP_RPM,
+                 status_hold: float = TELEGRAM_STATUS_HOLD, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.global_rps = global_rps
+        self.chat_rps = chat_rps
+        self.chat_burst = chat_burst
+        self.group_rpm = group_rpm
+        self.status_hold = status_hold
+        self.max_retries = max_retries
+        self._seq = itertools.count()
+        self._waiting = []           # отсортированы по (priority, seq)
+        self._busy_keys = set()      # сообщения, правка которых уже выполняется
+        self._chat_buckets = {}
+        self._global_bucket = _Bucket(global_rps, global_rps) if global_rps > 0 else None
+        self._blocked_until = {}     # chat_id (None — весь бот) -> время окончания RetryAfter
+        self._reserved = {}          # сообщение -> число зарезервированных статусных правок
+        self._latest = {}            # сообщение -> номер последней правки (пока есть резерв)
+        self._wakeup = None
+        self._dispatcher = None
+        # Статистика
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    # --- BaseRateLimiter ---
+
+    async def initialize(self) -> None:
+        self._ensure_dispatcher()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority, seq = rate_limit_args if isinstance(rate_limit_args, tuple) else (rate_limit_args, None)
+        if priority is None:
+            priority = PRIORITY_NORMAL
+        if seq is None:
+            seq = next(self._seq)
+        chat_id = data.get('chat_id')
+        key = (chat_id, data['message_id']) if endpoint in _EDIT_METHODS and 'message_id' in data else None
+        chat_limited = chat_id is not None and endpoint not in _CHAT_EXEMPT_METHODS
+        reserved = isinstance(rate_limit_args, tuple)
+
+        try:
+            if key is not None and not self._supersede(key, seq, priority):
+                self.dropped += 1
+                return True
+
+            if priority == PRIORITY_PROGRESS and key is not None and not self._progress_allowed(chat_id, key):
+                # Промежуточную правку не ставим в очередь: следующая все равно ее перекроет
+                self.dropped += 1
+                return True
+
+            hold = self.status_hold if priority == PRIORITY_STATUS else 0.0
+            for attempt in itertools.count():
+                request = _Request(priority, seq, chat_id if chat_limited else None, key, time.monotonic() + hold)
+                if not await self._enqueue(request):
+                    self.dropped += 1
+                    return True
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    # Telegram просит подождать: тормозим чат (или весь бот) на указанное время
+                    self._blocked_until[chat_id if chat_limited else None] = time.monotonic() + _seconds(e.retry_after)
+                    if priority > PRIORITY_NORMAL or attempt >= self.max_retries:
+                        raise
+                    self.retried += 1
+                    logger.warning("Telegram ограничил %s (чат %s), повтор через %.0f с.", endpoint, chat_id, _seconds(e.retry_after))
+                    hold = 0.0
+                finally:
+                    self._busy_keys.discard(key)
+                    self._wakeup.set()
+        finally:
+            if reserved:
+                self._release_reservation(key)
+
+    def _progress_allowed(self, chat_id, key) -> bool:
+        """Промежуточная правка уходит, только если ее можно отправить сразу и у чата останется единица на результат."""
+        now = time.monotonic()
+        if key in self._busy_keys or self._waiting and any(request.chat_id == chat_id for request in self._waiting):
+            return False
+        if max(self._blocked_until.get(chat_id, 0), self._blocked_until.get(None, 0)) > now:
+            return False
+        return self.chat_rps <= 0 or self._chat_bucket(chat_id).wait_time(now, reserve=1) == 0
+
+    # --- Резерв статусных правок ---
+
+    def reserve(self, chat_id, message_id) -> int:
+        """
+        Резервирует номер для статусной правки, которая будет отправлена позже (например, из
+        фоновой задачи). Любая правка того же сообщения, начатая после резерва, отменяет ее,
+        даже если фоновая задача еще не успела дойти до очереди.
+        """
+        key = (chat_id, message_id)
+        self._reserved[key] = self._reserved.get(key, 0) + 1
+        return next(self._seq)
+
+    def _release_reservation(self, key):
+        count = self._reserved.get(key, 0) - 1
+        if count > 0:
+            self._reserved[key] = count
+        else:
+            self._reserved.pop(key, None)
+            self._latest.pop(key, None)
+
+    def _supersede(self, key, seq: int, priority: int) -> bool:
+        """Учитывает новую правку сообщения; возвращает False, если ее саму уже нужно сбросить."""
+        if priority >= PRIORITY_PROGRESS and seq < self._latest.get(key, -1):
+            return False
+        if key in self._reserved:
+            self._latest[key] = max(seq, self._latest.get(key, -1))
+        for request in list(self._waiting):
+            if request.key != key or request.seq > seq:
+                continue
+            if request.droppable:
+                self._waiting.remove(request)
+                request.granted.set_result(_DROPPED)
+            elif request.priority > priority:
+                # Более ранняя правка того же сообщения не должна оказаться позже новой
+                self._waiting.remove(request)
+                request.priority = priority
+                insort(self._waiting, request)
+        return True
+
+    # --- Очередь и диспетчер ---
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _enqueue(self, request: _Request) -> bool:
+        """Ставит запрос в очередь и ждет разрешения; False — запрос сброшен."""
+        self._ensure_dispatcher()
+        insort(self._waiting, request)
+        # Свободный запрос получает разрешение сразу, без переключения на диспетчер
+        self._grant_ready()
+        self._wakeup.set()
+        try:
+            result = await request.granted
+        except BaseException:
+            if request in self._waiting:
+                self._waiting.remove(request)
+            elif request.granted.done() and not request.granted.cancelled():
+                # Разрешение уже выдано, но ожидающий ушел — освобождаем сообщение
+                self._busy_keys.discard(request.key)
+                self._wakeup.set()
+            raise
+        if result is _DROPPED:
+            return False
+        waited = time.monotonic() - request.enqueued_at
+        self.sent += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        metrics.stage_seconds.observe(waited, 'telegram_queue')
+        return True
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant_ready()
+            if delay is None:
+                await self._wakeup.wait()
+            else:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    def _chat_bucket(self, chat_id) -> _Bucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = _Bucket(self.group_rpm / 60.0, 1)
+            else:
+                bucket = _Bucket(self.chat_rps, self.chat_burst)
+            if len(self._chat_buckets) > 10000:
+                # Полные ведра ничего не помнят — их можно выбросить
+                now = time.monotonic()
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.full(now)}
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _grant_ready(self):
+        """Выдает разрешения всем запросам, которые можно отправить сейчас; возвращает паузу до следующей проверки."""
+        now = time.monotonic()
+        delay = None
+
+        def later(seconds):
+            nonlocal delay
+            delay = seconds if delay is None else min(delay, seconds)
+
+        blocked_chats = set()
+        for request in list(self._waiting):
+            global_wait = self._blocked_until.get(None, 0) - now
+            if self._global_bucket is not None:
+                global_wait = max(global_wait, self._global_bucket.wait_time(now))
+            if global_wait > 0:
+                later(global_wait)
+                break
+            if request.key in self._busy_keys or request.chat_id in blocked_chats:
+                continue
+            wait = request.not_before - now
+            if request.chat_id is not None:
+                wait = max(wait, self._blocked_until.get(request.chat_id, 0) - now)
+                if self.chat_rps > 0:
+                    # Статус не тратит последнюю единицу чата: она нужна результату
+                    reserve = 1 if request.priority >= PRIORITY_STATUS else 0
+                    wait = max(wait, self._chat_bucket(request.chat_id).wait_time(now, reserve))
+            if wait > 0:
+                # Менее важные запросы этого чата не обгоняют ждущий более важный
+                if request.chat_id is not None and request.not_before <= now:
+                    blocked_chats.add(request.chat_id)
+                later(wait)
+                continue
+
+            self._waiting.remove(request)
+            if self._global_bucket is not None:
+                self._global_bucket.take()
+            if request.chat_id is not None and self.chat_rps > 0:
+                self._chat_bucket(request.chat_id).take()
+            if request.key is not None:
+                self._busy_keys.add(request.key)
+            request.granted.set_result(None)
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': len(self._waiting),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'retried': self.retried,
+            'avg_wait_ms': 1000 * self.wait_time_total / self.sent if self.sent else 0.0,
+            'max_wait_ms': 1000 * self.wait_time_max,
+        }
+
+
+# Общий ограничитель: лимиты Telegram действуют на бота целиком
+outbound_limiter = OutboundRateLimiter()
+metrics.register_stats('telegram_outbound', outbound_limiter.stats)
+
+# Фоновые запросы: держим ссылки, чтобы задачи не собрал сборщик мусора
+_background = set()
+
+
+def fire(coro, what: str = "запрос к Telegram") -> asyncio.Task:
+    """Запускает запрос к Telegram в фоне; ошибки только записываются в лог."""
+    task = asyncio.create_task(coro)
+    _background.add(task)
+
+    def done(finished: asyncio.Task):
+        _background.discard(finished)
+        if not finished.cancelled() and finished.exception() is not None:
+            logger.debug("Фоновый %s не выполнен: %s", what, finished.exception())
+
+    task.add_done_callback(done)
+    return task
+
+
+def answer(bot, query) -> asyncio.Task:
+    """Отвечает на нажатие кнопки, не дожидаясь ответа Telegram."""
+    return fire(bot.answer_callback_query(query.id, rate_limit_args=PRIORITY_RESULT), "ответ на нажатие кнопки")
+
+
+def edit_status(bot, chat_id, message_id, text: str) -> asyncio.Task:
+    """
+    Показывает статус («Минуточку...») в сообщении, не дожидаясь ответа Telegram. Если
+    до отправки статуса то же сообщение будет исправлено еще раз (например, готовым результатом),
+    статус не отправляется вовсе.
+    """
+    seq = bot.rate_limiter.reserve(chat_id, message_id)
+    return fire(
+        bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, rate_limit_args=(PRIORITY_STATUS, seq)),
+        "статус",
+    )
+
+
+async def _refresh_typing(bot, chat_id):
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING, rate_limit_args=PRIORITY_PROGRESS)
+        except TelegramError as e:
+            logger.debug("Не удалось показать «печатает...» в чате %s: %s", chat_id, e)
+        await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+
+
+@contextlib.asynccontextmanager
+async def typing(bot, chat_id):
+    """Показывает «печатает...» в чате, пока выполняется блок, и обновляет его для долгих генераций."""
+    refresher = asyncio.create_task(_refresh_typing(bot, chat_id))
+    try:
+        yield
+    finally:
+        refresher.cancel()
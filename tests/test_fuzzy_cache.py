@@ -0,0 +1,77 @@
+import fuzzy_cache
+from fuzzy_cache import _Entry, _adapt, _tokenize
+
+
+def _entry(text: str, response: str) -> _Entry:
+    words, names = _tokenize(text)
+    return _Entry("style_business", words, names, fuzzy_cache._signature(words), response)
+
+
+def _adapt_to(entry: _Entry, text: str):
+    return _adapt(entry, *_tokenize(text))
+
+
+def test_tokenize_normalizes_words():
+    words, _ = _tokenize("Ёлка, ЗЕЛЁНАЯ ёлка!")
+    assert words == ["елка", "зеленая", "елка"]
+
+
+def test_tokenize_marks_names_and_numbers():
+    words, names = _tokenize("Привет, Маша. Встречаемся в 5 у Пушкина. Завтра")
+    assert dict(zip(words, names)) == {
+        "привет": False, "маша": True, "встречаемся": False, "в": False,
+        "5": True, "у": False, "пушкина": True, "завтра": False,
+    }
+
+
+def test_adapt_same_text_returns_response_unchanged():
+    entry = _entry("Привет, Маша", "Здравствуйте, Маша")
+    assert _adapt_to(entry, "привет,  маша!") == ("Здравствуйте, Маша", False)
+
+
+def test_adapt_substitutes_name_only_when_counts_match():
+    entry = _entry("Скажи Маше, что встреча в пятницу", "Передайте, пожалуйста, Маше: встреча в пятницу. МАШЕ — лично.")
+    # В исходном тексте имя одно, в ответе два — подставлять небезопасно
+    assert _adapt_to(entry, "Скажи Пете, что встреча в пятницу") is None
+    entry = _entry("Скажи Маше, что встреча в пятницу", "Передайте, пожалуйста, Маше: встреча в пятницу.")
+    assert _adapt_to(entry, "Скажи Пете, что встреча в пятницу") == (
+        "Передайте, пожалуйста, Пете: встреча в пятницу.", True
+    )
+
+
+def test_adapt_does_not_rewrite_unrelated_number():
+    entry = _entry("Перенеси встречу на 5 часов", "Прошу перенести встречу на 5 часов. Повестка из 5 пунктов.")
+    assert _adapt_to(entry, "Перенеси встречу на 10 часов") is None
+
+
+def test_adapt_substitutes_number_seen_once():
+    entry = _entry("Перенеси встречу на 5 часов", "Прошу перенести встречу на 5 часов.")
+    assert _adapt_to(entry, "Перенеси встречу на 10 часов") == ("Прошу перенести встречу на 10 часов.", True)
+
+
+def test_adapt_does_not_touch_number_inside_other_token():
+    entry = _entry("Перенеси встречу на 5 часов", "Прошу перенести встречу (пункт 15) на 5 часов.")
+    assert _adapt_to(entry, "Перенеси встречу на 10 часов") == ("Прошу перенести встречу (пункт 15) на 10 часов.", True)
+
+
+def test_adapt_rejects_inflected_name():
+    entry = _entry("Поздравь Машу с днем рождения", "Поздравляю Марию с днем рождения!")
+    assert _adapt_to(entry, "Поздравь Олю с днем рождения") is None
+
+
+def test_adapt_rejects_changed_ordinary_word():
+    entry = _entry("Перенеси встречу на 5 часов", "Прошу перенести встречу на 5 часов.")
+    assert _adapt_to(entry, "Отмени встречу на 5 часов") is None
+    assert _adapt_to(entry, "Перенеси встречу на 5 часов вечера") is None
+
+
+def test_adapt_substitutions_do_not_chain(monkeypatch):
+    monkeypatch.setattr(fuzzy_cache, "FUZZY_CACHE_MAX_SUBSTITUTIONS", 2)
+    entry = _entry("Замени 5 на 10", "Заменить 5 на 10.")
+    assert _adapt_to(entry, "Замени 10 на 20") == ("Заменить 10 на 20.", True)
+
+
+def test_adapt_respects_substitution_limit():
+    entry = _entry("Встреча Маши и Пети в 5", "Встреча Маши и Пети в 5.")
+    assert _adapt_to(entry, "Встреча Оли и Пети в 5") == ("Встреча Оли и Пети в 5.", True)
+    assert _adapt_to(entry, "Встреча Оли и Димы в 5") is None
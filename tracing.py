@@ -0,0 +1,201 @@
+# tracing.py
+"""
+Трассировка запросов и неблокирующее логирование.
+
+Каждое обновление Telegram получает trace id, который хранится в contextvars и поэтому
+доступен во всех корутинах и задачах, запущенных при его обработке: обработчик → запрос
+к Gemini → отправка и правка сообщений. trace id добавляется в каждую строку лога.
+Для доли обновлений (TRACE_SAMPLE_RATE) дополнительно записываются этапы (spans)
+с длительностями, и по завершении обработки в лог выводится одна сводная строка.
+
+Логирование идет через QueueHandler/QueueListener: цикл событий только кладет запись
+в очередь, а форматирование вывода и запись в поток выполняются в отдельном потоке.
+LOG_FORMAT=json включает вывод в виде JSON-строк (по одной на запись).
+"""
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Формат строк лога: "text" (как раньше) или "json"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Уровень логирования
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Доля обновлений, для которых записываются этапы обработки (0 — не записывать, 1 — все)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.05))
+# Максимальный размер очереди записей лога; при переполнении новые записи отбрасываются
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_listener = None
+
+
+class Trace:
+    """Трасса обработки одного обновления: идентификатор и (для выбранных) список этапов."""
+    __slots__ = ('trace_id', 'name', 'sampled', 'started', 'spans', 'attrs', 'finished')
+
+    def __init__(self, name: str, sampled: bool, attrs: dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attrs = attrs
+        self.finished = False
+
+    def summary(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'duration_ms': round(1000 * (time.perf_counter() - self.started), 1),
+            'attrs': self.attrs,
+            'spans': self.spans,
+        }
+
+
+def current_trace_id() -> str:
+    """trace id текущего обновления или None вне трассы."""
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+@contextlib.contextmanager
+def start_trace(name: str, **attrs):
+    """
+    Открывает трассу на время блока. Решение о записи этапов принимается один раз,
+    при открытии; для выбранных трасс по завершении в лог выводится сводная строка.
+    """
+    trace = Trace(name, random.random() < TRACE_SAMPLE_RATE, attrs)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.finished = True
+        if trace.sampled:
+            summary = trace.summary()
+            logger.info(
+                "Трасса %s: %.1f мс; %s", trace.name, summary['duration_ms'],
+                " ".join(f"{span['name']}={span['duration_ms']}мс" for span in trace.spans) or "без этапов",
+                extra={'trace': summary}
+            )
+        _current_trace.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    Записывает этап обработки с длительностью в текущую трассу.
+    Вне трассы и для невыбранных трасс почти ничего не стоит.
+    """
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        yield
+        return
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if not trace.finished:
+            record = {
+                'name': name,
+                'start_ms': round(1000 * (started - trace.started), 1),
+                'duration_ms': round(1000 * (time.perf_counter() - started), 1),
+            }
+            if attrs:
+                record.update(attrs)
+            if error:
+                record['error'] = error
+            trace.spans.append(record)
+
+
+class _TraceIdFilter(logging.Filter):
+    """Добавляет в запись trace_id текущей трассы. Работает в потоке, где создана запись."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись лога как одну JSON-строку."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', '-')
+        if trace_id != '-':
+            entry['trace_id'] = trace_id
+        trace = getattr(record, 'trace', None)
+        if trace is not None:
+            entry['trace'] = trace
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Текст исключения, подготовленный в _DroppingQueueHandler.prepare
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполненной очереди отбрасывает запись, а не блокирует цикл событий."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # В отличие от стандартного prepare, не форматируем запись целиком здесь:
+        # подставляем аргументы (они могут измениться позже) и переносим текст исключения,
+        # а окончательное форматирование выполнит обработчик в потоке QueueListener
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging():
+    """
+    Настраивает корневой логгер: записи уходят в очередь, а в stderr их пишет
+    QueueListener в отдельном потоке. Повторный вызов ничего не делает.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+
+    queue_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(_TraceIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,103 @@
+# update_processor.py
+"""
+Порядок обработки обновлений Telegram.
+
+Обновления разных чатов обрабатываются параллельно (запросы к Gemini разных пользователей
+перекрываются), а обновления одного чата — строго по очереди, в порядке поступления. Иначе
+ConversationHandler и user_data видят гонку: пользователь быстро отправил текст и нажал
+кнопку, а обработчик кнопки запускается, пока диалог еще не перешел в нужное состояние.
+
+Для каждого чата, у которого есть обновления в работе, хранится блокировка; когда очередь
+чата пустеет, блокировка удаляется, поэтому память не растет с числом пользователей.
+"""
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Во сколько раз больше обновлений, чем выполняется одновременно, может ждать очереди своего чата
+PENDING_FACTOR = 4
+
+
+class _ChatQueue:
+    """Блокировка чата и число обновлений, которые ее держат или ждут."""
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+def _chat_key(update: object):
+    """Ключ очереди: чат обновления, для обновлений без чата (inline-запросы) — пользователь."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return ('user', update.effective_user.id)
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик обновлений: по очереди внутри чата, параллельно между чатами,
+    одновременно выполняется не больше max_running обработчиков.
+
+    Семафор базового класса берется еще до очереди чата, поэтому он ограничивает число
+    принятых в работу обновлений вместе с ждущими (max_running * PENDING_FACTOR), а число
+    одновременно выполняемых ограничивает отдельный семафор, который берется уже после
+    блокировки чата: обновления, ждущие своей очереди, не занимают места других чатов.
+    """
+
+    def __init__(self, max_running: int):
+        super().__init__(max_running * PENDING_FACTOR)
+        self.max_running = max_running
+        self._running = None
+        self._chats = {}
+        self._active = 0
+        self.queued_total = 0
+
+    async def initialize(self) -> None:
+        # Семафор создается в работающем цикле событий
+        self._running = asyncio.BoundedSemaphore(self.max_running)
+
+    async def shutdown(self) -> None:
+        # Очереди чатов удаляются сами, когда их последнее обновление обработано
+        return
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = _chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = _ChatQueue()
+        else:
+            self.queued_total += 1
+        queue.users += 1
+        try:
+            async with queue.lock:
+                await self._run(coroutine)
+        finally:
+            queue.users -= 1
+            if not queue.users:
+                del self._chats[key]
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self._active += 1
+            try:
+                await coroutine
+            finally:
+                self._active -= 1
+
+    def stats(self) -> dict:
+        waiting = sum(queue.users - 1 for queue in self._chats.values() if queue.users > 1)
+        return {
+            'chats': len(self._chats),
+            'running': self._active,
+            'waiting_in_chat': waiting,
+            'queued_total': self.queued_total,
+        }
@@ -0,0 +1,110 @@
+# webhook_server.py
+"""
+Режим webhook: один асинхронный HTTP-сервер (aiohttp) на порту PORT
+принимает обновления от Telegram и отвечает на служебные маршруты health_checker
+(/healthz и другие). Отдельный поток с HTTPServer в этом режиме не нужен.
+"""
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+import health_checker
+
+logger = logging.getLogger(__name__)
+
+
+def build_web_app(submit_update, url_path: str, secret_token: str = None) -> web.Application:
+    """
+    Создает aiohttp-приложение с маршрутом для обновлений Telegram и служебными маршрутами.
+    submit_update — корутина, которая принимает обновление (словарь из JSON) и ставит его в обработку.
+    """
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, secret_token):
+                logger.warning("Webhook: получен запрос с неверным секретным токеном.")
+                return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Отвечаем Telegram сразу, а обработка идет через очередь обновлений
+        await submit_update(data)
+        return web.Response()
+
+    async def handle_service(request: web.Request) -> web.Response:
+        # В пуле потоков: /debug/profile длится секунды и снимает стеки самого цикла событий
+        status, content_type, body = await asyncio.to_thread(health_checker.handle_request, request.path_qs)
+        return web.Response(status=status, content_type=content_type, body=body)
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{url_path.strip('/')}", handle_update)
+    web_app.router.add_get('/{tail:.*}', handle_service)
+    return web_app
+
+
+async def _run(application: Application, port: int, url_path: str, webhook_url: str, secret_token: str = None,
+               sock=None, pending_updates=()):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Например, Windows: останавливаемся по KeyboardInterrupt
+            pass
+
+    async def submit_update(data: dict):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    runner = web.AppRunner(build_web_app(submit_update, url_path, secret_token))
+    await runner.setup()
+    # Сокет, уже открытый при запуске (boot.py), или новый порт
+    site = web.SockSite(runner, sock) if sock is not None else web.TCPSite(runner, host='0.0.0.0', port=port)
+    # Порт открываем до инициализации бота, чтобы health check отвечал как можно раньше
+    await site.start()
+    logger.info(f"Webhook-сервер слушает порт {port}, путь /{url_path.strip('/')}")
+    # Обновления, принятые при запуске, обрабатываются первыми
+    for data in pending_updates:
+        await submit_update(data)
+
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Webhook зарегистрирован в Telegram: {webhook_url}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, port: int, url_path: str, webhook_url: str, secret_token: str = None,
+                sock=None, pending_updates=()):
+    """
+    Запускает бота в режиме webhook и блокирует поток до получения SIGINT/SIGTERM.
+    sock — уже открытый слушающий сокет вместо порта port, pending_updates — обновления
+    (словари из JSON), принятые до запуска сервера (см. boot.py).
+    """
+    try:
+        asyncio.run(_run(application, port, url_path, webhook_url, secret_token, sock, pending_updates))
+    except KeyboardInterrupt:
+        logger.info("Webhook-сервер остановлен.")
@@ -0,0 +1,398 @@
+# workers.py
+"""
+Горизонтальное масштабирование: один приемник обновлений и пул процессов-обработчиков.
+
+Приемник (webhook или long polling) не обрабатывает обновления сам, а отправляет каждое
+в процесс-обработчик, выбранный по chat id через консистентное хэширование. Поэтому
+все обновления одного чата попадают в один и тот же процесс, и каждый процесс владеет
+user_data и состоянием ConversationHandler только своей части чатов (шарда), храня их
+в собственном файле (PERSISTENCE_PATH с суффиксом .shardN).
+
+Упавший обработчик перезапускается с тем же номером шарда и тем же хранилищем: другие шарды
+не затрагиваются, а user_data и состояния диалогов (ConversationHandler сохраняется в хранилище)
+восстанавливаются из его файла. Обновления для него, пришедшие во время перезапуска, ждут в очереди.
+
+Сторож цикла событий и профилировщик работают в каждом процессе. Обработчики раз в
+WORKER_STATS_INTERVAL секунд присылают приемнику снимок своих метрик и результат своей
+проверки готовности: /metrics приемника выводит их с меткой worker, /readyz не готов, если
+обработчик не запущен, не готов сам или давно не присылал отчет (его цикл событий заблокирован),
+а /debug/profile?worker=N профилирует процесс-обработчик N.
+
+Процессы не могут делить один HTTP-клиент, поэтому общими для них остаются ключи и модели
+Gemini, а лимиты (GEMINI_RPM, GEMINI_TPM, GEMINI_KEY_RPM, GEMINI_MAX_CONCURRENCY,
+PREFETCH_TOKENS_PER_MINUTE) делятся между процессами поровну, чтобы в сумме не превысить
+общую квоту. Кэш ответов можно сделать общим, указав RESPONSE_CACHE_DB (SQLite в режиме WAL).
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+import loop_watchdog
+import metrics
+import profiling
+import startup
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки (переменные окружения) ---
+# Сколько точек на кольце хэширования у каждого процесса (чем больше, тем ровнее распределение)
+WORKER_VIRTUAL_NODES = int(os.environ.get("WORKER_VIRTUAL_NODES", 64))
+# Максимальная длина очереди обновлений одного процесса; при переполнении обновление отбрасывается
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 10000))
+# Пауза перед перезапуском упавшего процесса (секунды)
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", 1.0))
+# Как часто обработчик присылает приемнику метрики и результат проверки готовности (секунды)
+WORKER_STATS_INTERVAL = float(os.environ.get("WORKER_STATS_INTERVAL", 5.0))
+
+# Лимиты, которые делятся между процессами: (переменная, значение по умолчанию, округлять вверх до целого)
+_SHARED_LIMITS = (
+    ("GEMINI_RPM", "0", False),
+    ("GEMINI_TPM", "0", False),
+    ("GEMINI_KEY_RPM", "0", False),
+    ("PREFETCH_TOKENS_PER_MINUTE", "30000", False),
+    ("GEMINI_MAX_CONCURRENCY", "8", True),
+)
+
+
+class HashRing:
+    """Консистентное хэширование: при изменении числа процессов переезжает лишь малая часть чатов."""
+
+    def __init__(self, nodes: list, virtual_nodes: int = WORKER_VIRTUAL_NODES):
+        self._ring = sorted(
+            (self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key) -> int:
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+
+def shard_key(data: dict):
+    """Ключ шарда для обновления (словарь из JSON Bot API): chat id, иначе id пользователя, иначе update_id."""
+    for field, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+        if 'from' in value and 'id' in value['from']:
+            return value['from']['id']
+    return data.get('update_id')
+
+
+def _worker_environment(index: int, count: int) -> dict:
+    """Переменные окружения процесса-обработчика: номер шарда, свое хранилище и доля общих лимитов."""
+    env = {"SHARD_INDEX": str(index), "PERSISTENCE_PATH": f"{os.environ.get('PERSISTENCE_PATH', 'bot_persistence')}.shard{index}"}
+    for name, default, round_up in _SHARED_LIMITS:
+        value = float(os.environ.get(name, default)) / count
+        env[name] = str(max(1, math.ceil(value))) if round_up else str(value)
+    return env
+
+
+def _worker_main(index: int, updates, reports):
+    """
+    Точка входа процесса-обработчика: настоящее приложение бота, получающее обновления из очереди
+    updates; отчеты (метрики, готовность, результаты профилирования) уходят приемнику через reports.
+    """
+    # Остановку процессов выполняет приемник (через пустое значение в очереди), Ctrl+C здесь игнорируем
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import speaksmart
+
+    application = speaksmart.build_application(speaksmart.TELEGRAM_TOKEN, persistence=speaksmart.build_persistence())
+    asyncio.run(_serve_worker(index, application, updates, reports))
+
+
+async def _report_stats(index: int, reports):
+    """Периодически отправляет приемнику метрики процесса и результат его проверки готовности."""
+    while True:
+        ready, report = loop_watchdog.readiness()
+        reports.put(('stats', index, metrics.snapshot(), ready, report))
+        await asyncio.sleep(WORKER_STATS_INTERVAL)
+
+
+async def _profile(index: int, reports, request_id: int, seconds: float, mode: str):
+    """Профилирует процесс по запросу приемника и отправляет ему результат."""
+    status, body = await asyncio.to_thread(profiling.profile_response, seconds, mode)
+    reports.put(('profile', index, request_id, status, body))
+
+
+async def _serve_worker(index: int, application, updates, reports):
+    from telegram import Update
+
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await application.start()
+    logger.info("Обработчик шарда %d запущен (pid %d).", index, os.getpid())
+    reporter = asyncio.create_task(_report_stats(index, reports))
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            if isinstance(data, tuple):
+                # Служебный запрос приемника: ('profile', номер запроса, секунды, режим)
+                asyncio.create_task(_profile(index, reports, *data[1:]))
+                continue
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        reporter.cancel()
+        # Приемник при остановке уже не читает отчеты: не ждем, пока они уйдут в канал
+        reports.cancel_join_thread()
+        # stop() дожидается обработки уже принятых обновлений, shutdown() сохраняет состояние
+        await application.stop()
+        await application.shutdown()
+        logger.info("Обработчик шарда %d остановлен.", index)
+
+
+class WorkerPool:
+    """Процессы-обработчики, их очереди и перезапуск упавших."""
+
+    def __init__(self, count: int):
+        self.count = count
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(WORKER_QUEUE_SIZE) for _ in range(count)]
+        # Отчеты всех обработчиков приемнику (см. _drain_reports)
+        self._reports = self._context.Queue()
+        self._processes = [None] * count
+        self._ring = HashRing(list(range(count)))
+        self.routed = [0] * count
+        self.dropped = [0] * count
+        self.restarts = [0] * count
+        # Последний отчет каждого обработчика: (время получения, готов ли, строки отчета)
+        self.last_report = [None] * count
+        # Запросы профилирования, ждущие ответа: номер запроса -> {'done': Event, 'result': (код, тело)}
+        self._profiles = {}
+        self._profile_ids = itertools.count(1)
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        # Процесс создается методом spawn и получает копию текущего окружения
+        saved = dict(os.environ)
+        os.environ.update(_worker_environment(index, self.count))
+        try:
+            process = self._context.Process(
+                target=_worker_main, args=(index, self._queues[index], self._reports), name=f"speaksmart-shard-{index}", daemon=False
+            )
+            process.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        logger.info("Запущено процессов-обработчиков: %d", self.count)
+
+    async def submit(self, data: dict):
+        """Отправляет обновление процессу, которому принадлежит его чат."""
+        index = self._ring.node_for(shard_key(data))
+        try:
+            self._queues[index].put_nowait(data)
+            self.routed[index] += 1
+        except queue.Full:
+            self.dropped[index] += 1
+            logger.error("Очередь шарда %d переполнена, обновление %s отброшено.", index, data.get('update_id'))
+
+    async def watch(self, interval: float = 1.0):
+        """Следит за процессами, перезапускает упавшие с тем же номером шарда и принимает их отчеты."""
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            self._drain_reports()
+            for index, process in enumerate(self._processes):
+                if self._stopping or process.is_alive():
+                    continue
+                logger.error(
+                    "Обработчик шарда %d завершился с кодом %s; перезапуск через %.1f с.",
+                    index, process.exitcode, WORKER_RESTART_DELAY
+                )
+                await asyncio.sleep(WORKER_RESTART_DELAY)
+                self.restarts[index] += 1
+                self._spawn(index)
+
+    def _drain_reports(self):
+        while True:
+            try:
+                kind, index, *payload = self._reports.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'stats':
+                worker_snapshot, ready, report = payload
+                self.last_report[index] = (time.monotonic(), ready, report)
+                metrics.set_worker_snapshot(str(index), worker_snapshot)
+            elif kind == 'profile':
+                request_id, status, body = payload
+                waiter = self._profiles.pop(request_id, None)
+                if waiter is not None:
+                    waiter['result'] = (status, body)
+                    waiter['done'].set()
+
+    def readiness(self) -> tuple:
+        """Проверка готовности обработчиков для /readyz приемника: (строки "FAIL ...", строки отчета)."""
+        problems = []
+        lines = []
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if process is None or not process.is_alive():
+                problems.append(f"FAIL worker {index}: процесс не запущен")
+                continue
+            last_report = self.last_report[index]
+            if last_report is None:
+                problems.append(f"FAIL worker {index}: еще не прислал отчет")
+                continue
+            received_at, ready, report = last_report
+            age = now - received_at
+            lines.append(f"worker {index}: {'ready' if ready else 'not ready'}, report {age:.1f}s ago")
+            if age > 3 * WORKER_STATS_INTERVAL:
+                problems.append(f"FAIL worker {index}: нет отчета {age:.1f}s (цикл событий заблокирован?)")
+            elif not ready:
+                problems.extend(f"FAIL worker {index}: {line[len('FAIL '):]}" for line in report if line.startswith("FAIL"))
+        return problems, lines
+
+    def profile_worker(self, index: int, seconds: float, mode: str) -> tuple:
+        """
+        Профилирует процесс-обработчик index (см. profiling.worker_profiler): (код ответа, тело).
+        Вызывается из потока HTTP-сервера и держит его, пока идет профилирование.
+        """
+        if not 0 <= index < self.count:
+            return 400, f"Нет обработчика {index}: всего их {self.count}\n".encode()
+        request_id = next(self._profile_ids)
+        waiter = self._profiles[request_id] = {'done': threading.Event(), 'result': None}
+        self._queues[index].put(('profile', request_id, seconds, mode))
+        # Запас на очередь обработчика и на доставку ответа (отчеты принимаются раз в секунду)
+        if not waiter['done'].wait(min(seconds, profiling.PROFILE_MAX_SECONDS) + 30):
+            self._profiles.pop(request_id, None)
+            return 504, f"Обработчик {index} не ответил\n".encode()
+        return waiter['result']
+
+    def stop(self, timeout: float = 30):
+        """Просит процессы завершиться после обработки очереди и дожидается их."""
+        self._stopping = True
+        for updates in self._queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self._processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Обработчик шарда %d не завершился вовремя и будет остановлен принудительно.", index)
+                process.terminate()
+
+    def backlog(self) -> int:
+        """Обновления, ждущие в очередях процессов-обработчиков."""
+        return sum(updates.qsize() for updates in self._queues)
+
+    def stats(self) -> list:
+        return [
+            {
+                'worker': str(index),
+                'alive': process is not None and process.is_alive(),
+                'routed': self.routed[index],
+                'dropped': self.dropped[index],
+                'restarts': self.restarts[index],
+            }
+            for index, process in enumerate(self._processes)
+        ]
+
+
+async def _poll(bot, pool: WorkerPool, stop_event: asyncio.Event):
+    """Long polling в приемнике: обновления не разбираются, а сразу уходят в шарды."""
+    from telegram import Update
+    from telegram.error import NetworkError, RetryAfter, TimedOut
+
+    await bot.delete_webhook()
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except TimedOut:
+            continue
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+            continue
+        except NetworkError as e:
+            logger.warning("Ошибка получения обновлений: %s; повтор через 1 с.", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await pool.submit(update.to_dict())
+
+
+async def _run_ingress(token: str, pool: WorkerPool, webhook_url: str, port: int, url_path: str, secret_token: str,
+                       sock=None, pending_updates=()):
+    from telegram import Bot, Update
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    watcher = asyncio.create_task(pool.watch())
+    # /readyz приемника: запаздывание его цикла и очереди процессов-обработчиков
+    loop_watchdog.watchdog.start(backlog=pool.backlog)
+    profiling.profiler.attach()
+    runner = None
+    async with Bot(token) as bot:
+        try:
+            if webhook_url:
+                from aiohttp import web
+                from webhook_server import build_web_app
+
+                runner = web.AppRunner(build_web_app(pool.submit, url_path, secret_token))
+                await runner.setup()
+                site = web.SockSite(runner, sock) if sock is not None else web.TCPSite(runner, host='0.0.0.0', port=port)
+                await site.start()
+                for data in pending_updates:
+                    await pool.submit(data)
+                await bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+                logger.info("Приемник webhook слушает порт %s, обновления распределяются по %d процессам.", port, pool.count)
+                startup.ready()
+                await stop_event.wait()
+            else:
+                logger.info("Приемник в режиме опроса, обновления распределяются по %d процессам.", pool.count)
+                polling = asyncio.create_task(_poll(bot, pool, stop_event))
+                startup.ready()
+                await stop_event.wait()
+                polling.cancel()
+        finally:
+            watcher.cancel()
+            await loop_watchdog.watchdog.stop()
+            if runner is not None:
+                await runner.cleanup()
+
+
+def run_sharded(token: str, count: int, webhook_url: str = None, port: int = 8080, url_path: str = "telegram",
+                secret_token: str = None, sock=None, pending_updates=()):
+    """
+    Запускает приемник и count процессов-обработчиков; блокирует поток до SIGINT/SIGTERM.
+    sock и pending_updates — открытый при запуске сокет и принятые до этого обновления (см. webhook_server.run_webhook).
+    """
+    pool = WorkerPool(count)
+    metrics.register_stats('worker', pool.stats, label_key='worker')
+    loop_watchdog.register_check(pool.readiness)
+    profiling.worker_profiler = pool.profile_worker
+    pool.start()
+    try:
+        asyncio.run(_run_ingress(token, pool, webhook_url, port, url_path, secret_token, sock, pending_updates))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Остановка процессов-обработчиков...")
+        pool.stop()